@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+"""
+Measures the cost of building requests and parsing responses for every
+service in :py:mod:`oiccli.oauth2.service` and :py:mod:`oiccli.oic.service`.
+
+No network traffic is involved, responses come from a stand-in OP built on
+tests/MockOP.py. For each service and phase the number of operations per
+second, the 50th and 99th percentile latency and the memory allocated per
+operation is reported.
+
+Usage::
+
+    python benchmarks/bench_services.py
+    python benchmarks/bench_services.py --save baseline.json
+    python benchmarks/bench_services.py --compare baseline.json
+
+When comparing, phases that have become slower than the threshold are
+listed and the exit code is 1.
+"""
+import argparse
+import inspect
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+BASE_PATH = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(BASE_PATH, '..', 'src'))
+sys.path.insert(0, os.path.join(BASE_PATH, '..', 'tests'))
+
+from MockOP import HTTPResponse
+from MockOP import MockOP
+
+from oiccli import oauth2
+from oiccli.client_auth import CLIENT_AUTHN_METHOD
+from oiccli.oauth2 import service as oauth2_service
+from oiccli.oauth2 import ClientInfo
+from oiccli.oic import DEFAULT_SERVICES as OIC_SERVICES
+from oiccli.oic import service as oic_service
+from oiccli.service import Service
+from oiccli.service import build_services
+from oicmsg import oic
+from oicmsg.oauth2 import AccessTokenResponse
+from oicmsg.oauth2 import ASConfigurationResponse
+from oicmsg.oauth2 import AuthorizationResponse
+
+__author__ = 'Roland Hedberg'
+
+BASEURL = 'https://example.com/'
+ISSUER = BASEURL + 'as'
+REDIRECT_URI = 'https://example.com/cli/authz_cb'
+
+CLIENT_CONFIG = {'client_id': 'client_id', 'client_secret': 'password',
+                 'redirect_uris': [REDIRECT_URI], 'issuer': ISSUER,
+                 'base_url': 'https://example.com/cli/',
+                 'resource': 'joe@example.com'}
+
+JSON = {'content-type': 'application/json'}
+URLENCODED = {'content-type': 'application/x-www-form-urlencoded'}
+
+ACCESS_TOKEN_RESPONSE = AccessTokenResponse(
+    access_token='access_token', token_type='Bearer', expires_in=3600,
+    refresh_token='refresh_token', state='state').to_json()
+
+# Per service: request arguments, extra keyword arguments and a canned
+# response. Services that only build requests have no response.
+SCENARIOS = {
+    'Authorization': {
+        'request_args': {'response_type': 'code', 'state': 'state'},
+        'response': (AuthorizationResponse(code='code', state='state')
+                     .to_urlencoded(), URLENCODED, 'urlencoded')
+    },
+    'AccessToken': {
+        'request_args': {'redirect_uri': REDIRECT_URI, 'code': 'code'},
+        'kwargs': {'state': 'state', 'authn_method': 'client_secret_basic'},
+        'response': (ACCESS_TOKEN_RESPONSE, JSON, 'json')
+    },
+    'RefreshAccessToken': {
+        'kwargs': {'state': 'state', 'authn_method': 'client_secret_basic'},
+        'response': (ACCESS_TOKEN_RESPONSE, JSON, 'json')
+    },
+    'ProviderInfoDiscovery': {
+        'conf': {'cache': None},
+        'response': (ASConfigurationResponse(
+            issuer=ISSUER, response_types_supported=['code'],
+            token_endpoint=ISSUER + '/token').to_json(), JSON, 'json'),
+        'oic_response': (oic.ProviderConfigurationResponse(
+            issuer=ISSUER, response_types_supported=['code'],
+            subject_types_supported=['public'],
+            id_token_signing_alg_values_supported=['RS256'],
+            authorization_endpoint=ISSUER + '/authorization',
+            token_endpoint=ISSUER + '/token',
+            jwks_uri=ISSUER + '/jwks.json').to_json(), JSON, 'json')
+    },
+    'Registration': {
+        'response': (oic.RegistrationResponse(
+            client_id='client_id', client_secret='password',
+            redirect_uris=[REDIRECT_URI]).to_json(), JSON, 'json')
+    },
+    'UserInfo': {
+        'kwargs': {'state': 'state'},
+        'response': (oic.OpenIDSchema(sub='diana', given_name='Diana',
+                                      family_name='Krall').to_json(),
+                     JSON, 'json')
+    },
+    'WebFinger': {
+        'response': (json.dumps({
+            'subject': 'acct:joe@example.com',
+            'links': [{'rel': 'http://openid.net/specs/connect/1.0/issuer',
+                       'href': ISSUER}]}), JSON, 'json')
+    },
+    'CheckSession': {'kwargs': {'state': 'state'}},
+    'CheckID': {'kwargs': {'state': 'state'}},
+    'EndSession': {'kwargs': {'state': 'state'}},
+}
+
+
+class BenchOP(MockOP):
+    """
+    Returns the same canned response to every request.
+    """
+
+    def __init__(self, response, baseurl=BASEURL):
+        MockOP.__init__(self, baseurl)
+        self.response = response
+
+    def __call__(self, url, method, **kwargs):
+        return self.response
+
+
+def services(module):
+    for name, obj in inspect.getmembers(module):
+        if inspect.isclass(obj) and issubclass(obj, Service) and \
+                obj.__module__ == module.__name__:
+            yield name
+
+
+def client_info(module):
+    cli_info = ClientInfo(config=dict(CLIENT_CONFIG))
+    if module is oic_service:
+        _services = OIC_SERVICES
+    else:
+        _services = oauth2.DEFAULT_SERVICES
+    cli_info.service = build_services(_services, module.factory, None, None,
+                                      CLIENT_AUTHN_METHOD)
+    cli_info.state_db['state'] = {
+        'code': 'code', 'redirect_uri': REDIRECT_URI,
+        'id_token': 'a.signed.jwt', 'refresh_token': 'refresh_token',
+        'token': {'access_token': 'access_token', 'token_type': 'Bearer'}}
+    return cli_info
+
+
+def allocated(func):
+    """
+    :return: The number of bytes allocated while func runs. Where
+        tracemalloc can't reset the peak, before Python 3.9, that is what
+        is still allocated when it returns.
+    """
+    _before = tracemalloc.get_traced_memory()[0]
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+        func()
+        return tracemalloc.get_traced_memory()[1] - _before
+
+    func()
+    return max(tracemalloc.get_traced_memory()[0] - _before, 0)
+
+
+def measure(func, iterations, alloc_iterations):
+    """
+    :return: Dictionary with ops/sec, p50 and p99 latency in microseconds
+        and the average number of bytes allocated per operation.
+    """
+    func()  # warm up, and fail early
+
+    _times = []
+    _clock = time.perf_counter
+    _start = _clock()
+    for _ in range(iterations):
+        _t = _clock()
+        func()
+        _times.append(_clock() - _t)
+    _total = _clock() - _start
+
+    _alloc = 0
+    tracemalloc.start()
+    try:
+        for _ in range(alloc_iterations):
+            _alloc += allocated(func)
+    finally:
+        tracemalloc.stop()
+
+    _times.sort()
+    return {
+        'ops_per_sec': round(iterations / _total, 1),
+        'p50_us': round(_times[len(_times) // 2] * 1e6, 1),
+        'p99_us': round(_times[int(len(_times) * 0.99) - 1] * 1e6, 1),
+        'alloc_bytes': _alloc // max(alloc_iterations, 1)
+    }
+
+
+def phases(module, name):
+    """
+    Set up one service and return the functions that run each phase.
+    """
+    _scenario = SCENARIOS.get(name, {})
+    cli_info = client_info(module)
+    srv = module.factory(name, client_authn_method=CLIENT_AUTHN_METHOD,
+                         conf=_scenario.get('conf'))
+    srv.endpoint = '{}{}'.format(BASEURL, srv.request or 'endpoint')
+
+    request_args = _scenario.get('request_args', {})
+    kwargs = dict(_scenario.get('kwargs', {}))
+    authn_method = kwargs.pop('authn_method', '')
+
+    def construct():
+        return srv.construct(cli_info, request_args=dict(request_args),
+                             **kwargs)
+
+    def gather_request_args():
+        return srv.gather_request_args(cli_info, **request_args)
+
+    _request = construct()
+
+    def init_authentication_method():
+        return srv.init_authentication_method(
+            srv.msg_type(**_request.to_dict()), cli_info,
+            authn_method or srv.default_authn_method, **kwargs)
+
+    def uri_and_body():
+        return srv.uri_and_body(_request, srv.http_method)
+
+    def do_request_init():
+        return srv.do_request_init(cli_info, request_args=dict(request_args),
+                                   authn_method=authn_method, **kwargs)
+
+    _phases = [('construct', construct),
+               ('gather_request_args', gather_request_args)]
+    if authn_method or srv.default_authn_method:
+        _phases.append(
+            ('init_authentication_method', init_authentication_method))
+    _phases.extend([('uri_and_body', uri_and_body),
+                    ('do_request_init', do_request_init)])
+
+    if module is oic_service and 'oic_response' in _scenario:
+        _response = _scenario['oic_response']
+    else:
+        _response = _scenario.get('response')
+
+    if _response:
+        text, headers, body_type = _response
+        _http_response = HTTPResponse(text, 200, headers)
+        srv.httplib = BenchOP(_http_response)
+        _info = do_request_init()
+
+        def parse_request_response():
+            return srv.parse_request_response(
+                _http_response, cli_info, response_body_type=body_type,
+                state='state')
+
+        def service_request():
+            return srv.service_request(
+                _info['uri'], method=srv.http_method,
+                body=_info.get('body'), response_body_type=body_type,
+                http_args=_info['http_args'], client_info=cli_info,
+                state='state')
+
+        _phases.extend([('parse_request_response', parse_request_response),
+                        ('service_request', service_request)])
+
+    return _phases
+
+
+def run(iterations, alloc_iterations, only=None):
+    results = {}
+    for module in [oauth2_service, oic_service]:
+        _mod = module.__name__.split('.')[1]
+        for name in services(module):
+            _id = '{}.{}'.format(_mod, name)
+            if only and not any(o in _id for o in only):
+                continue
+            try:
+                _phases = phases(module, name)
+            except Exception as err:
+                print('{:40} skipped: {}'.format(_id, err), file=sys.stderr)
+                continue
+
+            for phase, func in _phases:
+                _key = '{}.{}'.format(_id, phase)
+                try:
+                    results[_key] = measure(func, iterations, alloc_iterations)
+                except Exception as err:
+                    print('{:40} failed: {}'.format(_key, err),
+                          file=sys.stderr)
+    return results
+
+
+def report(results, baseline=None):
+    _head = '{:58} {:>10} {:>9} {:>9} {:>9}'.format(
+        'service.phase', 'ops/sec', 'p50 us', 'p99 us', 'alloc B')
+    if baseline:
+        _head += ' {:>8}'.format('change')
+    print(_head)
+    for key in sorted(results):
+        _res = results[key]
+        line = '{:58} {:>10} {:>9} {:>9} {:>9}'.format(
+            key, _res['ops_per_sec'], _res['p50_us'], _res['p99_us'],
+            _res['alloc_bytes'])
+        if baseline and key in baseline:
+            line += ' {:>+7.1f}%'.format(change(baseline[key], _res))
+        print(line)
+
+
+def change(old, new):
+    """
+    :return: Change in operations per second in percent
+    """
+    return (new['ops_per_sec'] - old['ops_per_sec']) * 100.0 / \
+        old['ops_per_sec']
+
+
+def regressions(baseline, results, threshold):
+    return [key for key in sorted(results)
+            if key in baseline and
+            change(baseline[key], results[key]) < -threshold]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', dest='iterations', type=int, default=2000,
+                        help='Number of timed iterations per phase')
+    parser.add_argument('-a', dest='alloc_iterations', type=int, default=50,
+                        help='Number of iterations used to measure allocation')
+    parser.add_argument('--save', dest='save',
+                        help='Save the results as a JSON baseline')
+    parser.add_argument('--compare', dest='compare',
+                        help='Compare the results with a JSON baseline')
+    parser.add_argument('--threshold', dest='threshold', type=float,
+                        default=10.0,
+                        help='Slowdown, in percent, reported as a regression')
+    parser.add_argument('only', nargs='*',
+                        help='Only run services/phases matching these')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)['results']
+
+    results = run(args.iterations, args.alloc_iterations, args.only)
+    report(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump({'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'iterations': args.iterations,
+                       'created': int(time.time()),
+                       'results': results}, fp, indent=2, sort_keys=True)
+
+    if baseline:
+        _slow = regressions(baseline, results, args.threshold)
+        if _slow:
+            print('\nSlower than the baseline by more than {}%:'.format(
+                args.threshold))
+            for key in _slow:
+                print('  {}'.format(key))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
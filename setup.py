@@ -61,7 +61,6 @@ setup(
     classifiers=[
         "Development Status :: 4 - Beta",
         "License :: OSI Approved :: Apache Software License",
-        "Programming Language :: Python :: 3.4",
         "Programming Language :: Python :: 3.5",
         "Programming Language :: Python :: 3.6",
         "Topic :: Software Development :: Libraries :: Python Modules"],
@@ -70,10 +69,14 @@ setup(
         "future",
         "six",
     ],
+    extras_require={
+        'async': ["aiohttp"],
+    },
     tests_require=[
         "responses",
         "testfixtures",
     ],
     zip_safe=False,
+    python_requires='>=3.5',
     cmdclass={'test': PyTest},
 )
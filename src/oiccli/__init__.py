@@ -1,4 +1,5 @@
 import hashlib
+import re
 import string
 
 # Since SystemRandom is not available on all systems
@@ -57,5 +58,76 @@ def unreserved(size=64):
     return "".join([rnd.choice(BASECH) for _ in range(size)])
 
 
-def sanitize(str):
-    return str
+# Parameters and headers whose values must never end up in a log
+SENSITIVE = ['access_token', 'refresh_token', 'id_token', 'code',
+             'code_verifier', 'client_secret', 'password', 'assertion',
+             'client_assertion', 'request', 'authorization', 'cookie',
+             'set-cookie', 'keyjar', 'key']
+
+REDACTED = '<REDACTED>'
+
+# A sensitive parameter in a urlencoded or JSON string or in a header
+SENSITIVE_PATTERN = re.compile(
+    r'(?i)(?<![\w-])(["\']?(?:{})["\']?\s*[=:]\s*)'
+    r'(?:(?:Bearer|Basic)\s+)?("[^"]*"|[^&\s,;}}]+)'.format(
+        '|'.join([re.escape(p) for p in SENSITIVE])))
+
+
+def _redact(match):
+    if match.group(2).startswith('"'):
+        return '{}"{}"'.format(match.group(1), REDACTED)
+    return '{}{}'.format(match.group(1), REDACTED)
+
+
+def sanitize(info):
+    """
+    Replace the values of sensitive parameters, like secrets and tokens,
+    with a placeholder so that they can be logged.
+
+    :param info: A string, a dictionary, a :py:class:`oicmsg.message.Message`
+        instance or a list of those.
+    :return: A sanitized copy of info
+    """
+    if isinstance(info, str):
+        return SENSITIVE_PATTERN.sub(_redact, info)
+
+    try:
+        info = info.to_dict()
+    except AttributeError:
+        pass
+
+    if isinstance(info, dict):
+        return dict([(k, REDACTED if str(k).lower() in SENSITIVE
+                      else sanitize(v)) for k, v in info.items()])
+    if isinstance(info, (list, tuple)):
+        return [sanitize(v) for v in info]
+
+    try:
+        # For instance the case insensitive headers dictionary
+        return sanitize(dict(info.items()))
+    except (AttributeError, TypeError, ValueError):
+        return info
+
+
+class LazyFormat(object):
+    """
+    A log message that is only formatted, and sanitized, if the log record
+    is actually emitted. So building debug messages costs next to nothing
+    when debug logging is turned off. Usage::
+
+        logger.debug(LazyFormat('Got response: {}', resp))
+
+    The arguments should be the objects themselves, not something derived
+    from them, since that would be computed whether it's logged or not.
+    """
+    __slots__ = ['fmt', 'args', 'kwargs']
+
+    def __init__(self, fmt, *args, **kwargs):
+        self.fmt = fmt
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return self.fmt.format(
+            *[sanitize(a) for a in self.args],
+            **dict([(k, sanitize(v)) for k, v in self.kwargs.items()]))
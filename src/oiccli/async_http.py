@@ -0,0 +1,265 @@
+import asyncio
+import logging
+import os
+import ssl
+import time
+
+from requests.structures import CaseInsensitiveDict
+
+from oiccli import sanitize
+from oiccli.exception import DeadlineExceeded
+from oiccli.http import HTTPLib
+from oiccli.http import DEFAULT_TIMEOUT
+from oiccli.http import POOL_MAXSIZE
+from oiccli.http import deadline_timeout
+from oiccli.metrics import METRICS
+
+try:
+    import aiohttp
+except ImportError:  # Only needed if asynchronous requests are used
+    aiohttp = None
+
+__author__ = 'roland'
+
+logger = logging.getLogger(__name__)
+
+# Request arguments that can be handed over to aiohttp as is.
+AIOHTTP_ARGS = ['data', 'headers', 'cookies', 'allow_redirects', 'params']
+
+
+class AsyncResponse(object):
+    """
+    The parts of a HTTP response that the services use, presented the
+    same way as a :py:class:`requests.Response` does it.
+    """
+
+    def __init__(self, status_code, text, headers, url):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers
+        self.url = url
+
+
+class AsyncHTTPLib(HTTPLib):
+    """
+    A HTTP library to be used with asyncio. Calling an instance returns a
+    coroutine, which makes it usable with
+    :py:meth:`oiccli.service.Service.async_service_request`.
+    """
+
+    def __init__(self, ca_certs=None, verify_ssl=True, keyjar=None,
+                 client_cert=None, session=None, limit=100,
+                 limit_per_host=POOL_MAXSIZE, keep_alive=True, retry=None,
+                 timeout=DEFAULT_TIMEOUT, metrics=METRICS):
+        """
+        :param ca_certs: the path to a CA_BUNDLE file or directory with
+            certificates of trusted CAs
+        :param verify_ssl: If True then the server SSL certificate is not
+            verfied
+        :param keyjar: A place to keep keys for signing/encrypting messages
+        :param client_cert: local cert to use as client side certificate
+        :param session: A :py:class:`aiohttp.ClientSession` instance. Allows
+            several instances to share one connection pool.
+        :param limit: Maximum number of simultaneous connections
+        :param limit_per_host: Maximum number of simultaneous connections
+            to one host
+        :param keep_alive: Whether connections should be kept open between
+            requests.
+        :param retry: A :py:class:`oiccli.http.RetryPolicy` instance. If not
+            given every request is sent once.
+        :param timeout: Default connect and read timeouts, in seconds, as a
+            tuple or one number used for both. None means wait forever.
+        :param metrics: A :py:class:`oiccli.metrics.Metrics` instance, None
+            means that nothing is counted.
+        """
+        if aiohttp is None:
+            raise ImportError('AsyncHTTPLib requires aiohttp')
+
+        HTTPLib.__init__(self, ca_certs=ca_certs, verify_ssl=verify_ssl,
+                         keyjar=keyjar, client_cert=client_cert,
+                         session=session, retry=retry, timeout=timeout,
+                         metrics=metrics)
+        self.connection_errors = (aiohttp.ClientConnectionError,)
+        self.pool_args = {'limit': limit, 'limit_per_host': limit_per_host,
+                          'force_close': not keep_alive}
+        self._ssl = self._ssl_context()
+
+    def _ssl_context(self):
+        """
+        Translate the requests style verify and cert arguments into
+        something aiohttp understands. Done once since creating a SSL context
+        is expensive.
+
+        :return: A :py:class:`ssl.SSLContext` instance, False if server
+            certificates should not be verified or None if the default
+            should be used.
+        """
+        _verify = self.request_args.get('verify', True)
+        if _verify is False:
+            return False
+
+        try:
+            _cert = self.request_args['cert']
+        except KeyError:
+            _cert = None
+
+        if _verify is True and _cert is None:
+            return None
+
+        if _verify is True:
+            context = ssl.create_default_context()
+        elif os.path.isdir(_verify):
+            context = ssl.create_default_context(capath=_verify)
+        else:
+            context = ssl.create_default_context(cafile=_verify)
+
+        if isinstance(_cert, tuple):
+            context.load_cert_chain(*_cert)
+        elif _cert:
+            context.load_cert_chain(_cert)
+
+        return context
+
+    @property
+    def session(self):
+        """
+        The session used to send requests. Created on first use, that is
+        when an event loop is running.
+        """
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(**self.pool_args),
+                cookie_jar=aiohttp.DummyCookieJar())
+        return self._session
+
+    async def close(self):
+        """
+        Close the connections held by the session.
+        """
+        if self._session is not None:
+            await self._session.close()
+
+    def _aiohttp_kwargs(self, _kwargs):
+        """
+        Convert requests style request arguments into aiohttp ones.
+
+        :param _kwargs: Request arguments
+        :return: Dictionary with aiohttp request arguments
+        """
+        _args = dict([(k, v) for k, v in _kwargs.items() if k in AIOHTTP_ARGS])
+
+        if self._ssl is not None:
+            _args['ssl'] = self._ssl
+
+        try:
+            _timeout = _kwargs['timeout']
+        except KeyError:
+            pass
+        else:
+            if isinstance(_timeout, tuple):
+                _args['timeout'] = aiohttp.ClientTimeout(
+                    sock_connect=_timeout[0], sock_read=_timeout[1])
+            elif _timeout is not None:
+                _args['timeout'] = aiohttp.ClientTimeout(total=_timeout)
+
+        return _args
+
+    async def _request(self, url, method, _kwargs):
+        async with self.session.request(
+                method, url, **self._aiohttp_kwargs(_kwargs)) as resp:
+            _text = await resp.text()
+            _headers = CaseInsensitiveDict()
+            for key in resp.headers.keys():
+                if key not in _headers:
+                    _headers[key] = ', '.join(resp.headers.getall(key))
+            return AsyncResponse(resp.status, _text, _headers, str(resp.url))
+
+    async def _async_send(self, url, method, _kwargs, deadline=0):
+        _started = time.monotonic()
+        try:
+            if not deadline:
+                r = await self._request(url, method, _kwargs)
+            else:
+                # Cancel the request if it's not finished at the deadline
+                _timeout = deadline_timeout(_kwargs.get('timeout'), deadline)
+                _kwargs = dict(_kwargs, timeout=_timeout)
+                try:
+                    r = await asyncio.wait_for(
+                        self._request(url, method, _kwargs),
+                        deadline_timeout(None, deadline))
+                except asyncio.TimeoutError:
+                    raise DeadlineExceeded(
+                        'No response from {} before the deadline'.format(url))
+        except Exception as err:
+            if self.metrics is not None:
+                self._record(url, method, _started, error=err)
+            logger.error(
+                "http_request failed: %s, url: %s, htargs: %s, method: %s" % (
+                    err, url, sanitize(_kwargs), method))
+            raise
+
+        if self.metrics is not None:
+            self._record(url, method, _started, r)
+        return r
+
+    async def __call__(self, url, method="GET", **kwargs):
+        """
+        Send a HTTP request to a URL using a specified method
+
+        :param url: The URL to access
+        :param method: The method to use (GET, POST, ..)
+        :param kwargs: extra HTTP request parameters
+        :return: A :py:class:`AsyncResponse` instance
+        """
+
+        _deadline = kwargs.pop('deadline', 0)
+        _retry = self._retry_policy(method, kwargs)
+        _kwargs = self._request_kwargs(url, method, **kwargs)
+
+        if _retry is None:
+            r = await self._async_send(url, method, _kwargs, _deadline)
+        else:
+            _started = time.time()
+            attempt = 0
+            while True:
+                try:
+                    r = await self._async_send(url, method, _kwargs,
+                                               _deadline)
+                except Exception as err:
+                    if not _retry.retry_on(error=err,
+                                           errors=self.connection_errors):
+                        raise
+                    _delay = _retry.delay(attempt, _started,
+                                          deadline=_deadline)
+                    if _delay is None:
+                        raise
+                else:
+                    if not _retry.retry_on(response=r):
+                        break
+                    _delay = _retry.delay(attempt, _started, r,
+                                          deadline=_deadline)
+                    if _delay is None:
+                        break
+
+                attempt += 1
+                logger.warning('Retrying {} {} in {:.2f} seconds'.format(
+                    method, url, _delay))
+                await asyncio.sleep(_delay)
+
+        if self.events is not None:
+            self.events.store('HTTP response', r, ref=url)
+
+        self._response_cookies(r, url)
+
+        return r
+
+    async def send(self, url, method="GET", **kwargs):
+        """
+        Another name for the send method
+
+        :param url: URL
+        :param method: HTTP method
+        :param kwargs: HTTP request argument
+        :return: Request response
+        """
+        return await self(url, method, **kwargs)
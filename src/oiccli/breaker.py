@@ -0,0 +1,220 @@
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+from oiccli.exception import CircuitOpen
+from oiccli.exception import HostBusy
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+"""
+Protection against OPs that are down or slow. A circuit breaker per host
+stops requests to a host that keeps failing, so that threads don't pile up
+waiting for it, and a semaphore per host limits the number of requests to
+it that can be in flight at the same time.
+"""
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    """
+    Closed: requests are let through. After failure_threshold failures in a
+    row the breaker opens.
+    Open: requests are refused. After reset_timeout seconds the breaker
+    becomes half-open.
+    Half-open: a limited number of trial requests are let through. If one
+    of them succeeds the breaker closes, if one fails it opens again.
+
+    A request fails if it raises an exception, gets a response with a 5xx
+    status code or takes longer than slow_call_time seconds.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30,
+                 slow_call_time=0, half_open_calls=1, clock=time.monotonic):
+        """
+        :param failure_threshold: The number of failures in a row that
+            opens the breaker
+        :param reset_timeout: For how many seconds the breaker stays open
+        :param slow_call_time: Requests taking longer than this are counted
+            as failures. 0 means that the time is not considered.
+        :param half_open_calls: The number of trial requests let through
+            when half-open
+        :param clock: Function returning the present time in seconds
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_call_time = slow_call_time
+        self.half_open_calls = half_open_calls
+        self.clock = clock
+
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.trials = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        :return: True if a request may be sent now
+        """
+        with self._lock:
+            if self.state == OPEN:
+                if self.clock() - self.opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self.state = HALF_OPEN
+                self.trials = 0
+
+            if self.state == HALF_OPEN:
+                if self.trials >= self.half_open_calls:
+                    self.rejected += 1
+                    return False
+                self.trials += 1
+            return True
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = self.clock()
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.state = CLOSED
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or \
+                    self.failures >= self.failure_threshold:
+                self._open()
+
+    def record(self, elapsed, response=None, error=None):
+        """
+        Record the outcome of a request.
+
+        :param elapsed: How long, in seconds, the request took
+        :param response: The response if one was received
+        :param error: The exception raised, if any
+        """
+        if error is not None or (response is not None and
+                                 response.status_code >= 500):
+            self.failure()
+        elif self.slow_call_time and elapsed > self.slow_call_time:
+            self.failure()
+        else:
+            self.success()
+
+
+class HostGuard(object):
+    """
+    Keeps one :py:class:`CircuitBreaker` and one semaphore per host.
+    One instance can be shared by several :py:class:`oiccli.http.HTTPLib`
+    instances, for example by all the clients in a
+    :py:class:`oiccli.client_pool.ClientPool`.
+    """
+
+    def __init__(self, max_in_flight=0, acquire_timeout=0, **breaker_args):
+        """
+        :param max_in_flight: The maximum number of requests to a host that
+            may be in flight at the same time. 0 means no limit.
+        :param acquire_timeout: How long to wait for a request to a busy
+            host to be allowed before giving up.
+        :param breaker_args: Arguments to the :py:class:`CircuitBreaker`
+            constructor
+        """
+        self.max_in_flight = max_in_flight
+        self.acquire_timeout = acquire_timeout
+        self.breaker_args = breaker_args
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def host(url):
+        return urlsplit(url).netloc.lower()
+
+    def _get(self, host):
+        with self._lock:
+            try:
+                return self._hosts[host]
+            except KeyError:
+                if self.max_in_flight:
+                    _sem = threading.BoundedSemaphore(self.max_in_flight)
+                else:
+                    _sem = None
+                _info = {'breaker': CircuitBreaker(**self.breaker_args),
+                         'semaphore': _sem, 'in_flight': 0, 'busy': 0}
+                self._hosts[host] = _info
+                return _info
+
+    def breaker(self, url):
+        return self._get(self.host(url))['breaker']
+
+    def call(self, url, func, *args, **kwargs):
+        """
+        Send a request, if the host is not known to be failing and not
+        too busy.
+
+        :param url: The URL the request is sent to
+        :param func: The function that sends the request and returns the
+            response
+        :return: What func returns
+        """
+        _host = self.host(url)
+        _info = self._get(_host)
+        _breaker = _info['breaker']
+
+        _sem = _info['semaphore']
+        if _sem is not None:
+            if self.acquire_timeout:
+                _acquired = _sem.acquire(timeout=self.acquire_timeout)
+            else:
+                _acquired = _sem.acquire(blocking=False)
+            if not _acquired:
+                with self._lock:
+                    _info['busy'] += 1
+                raise HostBusy(
+                    'Too many requests in flight to {}'.format(_host))
+
+        if not _breaker.allow():
+            if _sem is not None:
+                _sem.release()
+            raise CircuitOpen('Circuit breaker open for {}'.format(_host))
+
+        with self._lock:
+            _info['in_flight'] += 1
+        _start = time.monotonic()
+        try:
+            resp = func(*args, **kwargs)
+        except Exception as err:
+            _breaker.record(time.monotonic() - _start, error=err)
+            raise
+        else:
+            _breaker.record(time.monotonic() - _start, response=resp)
+            return resp
+        finally:
+            with self._lock:
+                _info['in_flight'] -= 1
+            if _sem is not None:
+                _sem.release()
+
+    def stats(self):
+        """
+        :return: Dictionary with hosts as keys and the breaker state and
+            counters for the host as values.
+        """
+        with self._lock:
+            _hosts = list(self._hosts.items())
+
+        return dict([(host, {'state': _info['breaker'].state,
+                             'failures': _info['breaker'].failures,
+                             'rejected': _info['breaker'].rejected,
+                             'in_flight': _info['in_flight'],
+                             'busy': _info['busy']})
+                     for host, _info in _hosts])
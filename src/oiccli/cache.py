@@ -0,0 +1,414 @@
+import copy
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from http.cookiejar import http2time
+
+from cryptojwt import as_bytes
+from cryptojwt import b64d
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+"""
+Caches for information fetched from an OP that is the same for every
+client talking to that OP.
+"""
+
+
+def _now():
+    return int(time.time())
+
+
+def _header(headers, name):
+    """
+    Get a header value. Works with the case insensitive dictionary used
+    by requests as well as with plain dictionaries with lower case keys.
+    """
+    if not headers:
+        return None
+    try:
+        return headers[name]
+    except KeyError:
+        return headers.get(name.lower())
+
+
+def cache_control(headers):
+    """
+    Parse the Cache-Control header.
+
+    :param headers: HTTP response headers
+    :return: Dictionary with directive names as keys. Directives that have
+        no value gets the value True.
+    """
+    _val = _header(headers, 'Cache-Control')
+    if not _val:
+        return {}
+
+    res = {}
+    for part in _val.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '=' in part:
+            key, val = part.split('=', 1)
+            res[key.strip().lower()] = val.strip().strip('"')
+        else:
+            res[part.lower()] = True
+    return res
+
+
+def freshness_lifetime(headers, default=0, now=0):
+    """
+    How long, in seconds, a response may be used without asking the server
+    again.
+
+    :param headers: HTTP response headers
+    :param default: What to use if the server says nothing
+    :param now: The present time, seconds since epoch
+    :return: Number of seconds or None if the response must not be stored.
+    """
+    _cc = cache_control(headers)
+    if 'no-store' in _cc:
+        return None
+    if 'no-cache' in _cc:
+        return 0
+
+    for directive in ['s-maxage', 'max-age']:
+        try:
+            return max(int(_cc[directive]), 0)
+        except KeyError:
+            pass
+        except ValueError:
+            return 0
+
+    _expires = _header(headers, 'Expires')
+    if _expires:
+        _exp = http2time(_expires)
+        if _exp is None:  # An invalid date means already expired
+            return 0
+        return max(_exp - (now or _now()), 0)
+
+    return default
+
+
+# For how long a provider configuration is used when the OP doesn't say
+# anything about caching it.
+DEFAULT_TTL = 300
+
+
+class CacheEntry(object):
+    def __init__(self, info, etag='', expires=0):
+        """
+        :param info: The response as a dictionary
+        :param etag: The entity tag the server attached to the response
+        :param expires: When the entry must be revalidated, seconds since
+            epoch.
+        """
+        self.info = info
+        self.etag = etag
+        self.expires = expires
+
+    def fresh(self, now=0):
+        return self.expires > (now or _now())
+
+    def message(self, cls):
+        """
+        Get the response as an instance of a specific message class.
+        Every caller gets an instance of its own, so a client that changes
+        it doesn't change it for the other clients.
+
+        :param cls: A :py:class:`oicmsg.Message` subclass
+        :return: A cls instance
+        """
+        return cls().from_dict(copy.deepcopy(self.info))
+
+    def to_dict(self):
+        return {'info': self.info, 'etag': self.etag, 'expires': self.expires}
+
+
+class ProviderInfoCache(object):
+    """
+    A cache of provider configuration responses, keyed by the URL they
+    were fetched from, that is by issuer.
+
+    The lifetime of an entry is what the OP says in Cache-Control or
+    Expires. When an entry has expired but the OP sent an ETag, the next
+    request is a conditional one and a 304 Not Modified response renews
+    the entry.
+
+    The cache can be written to a file so that it survives restarts.
+    """
+
+    def __init__(self, filename='', default_ttl=DEFAULT_TTL, max_ttl=86400):
+        """
+        :param filename: If given the cache is kept in this file, in JSON
+            format.
+        :param default_ttl: For how many seconds a response is used if the
+            OP gives no caching information, at most max_ttl. 0 means that
+            such responses are only kept for revalidation.
+        :param max_ttl: Never use a response for longer than this without
+            asking the OP.
+        """
+        self.filename = filename
+        self.default_ttl = default_ttl
+        self.max_ttl = max_ttl
+        self._db = {}
+        self._lock = threading.Lock()
+
+        if filename:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.filename) as fp:
+                _info = json.load(fp)
+        except IOError:
+            return
+        except ValueError as err:
+            logger.warning(
+                'Could not read cache file {}: {}'.format(self.filename, err))
+            return
+
+        for url, item in _info.items():
+            try:
+                self._db[url] = CacheEntry(item['info'], item['etag'],
+                                           item['expires'])
+            except (KeyError, TypeError):
+                continue
+
+    def _dump(self):
+        """
+        Write the cache to a temporary file and then move it in place so
+        that a reader never sees a half written file.
+        """
+        _info = dict([(url, entry.to_dict()) for url, entry in self._db.items()])
+        _dir = os.path.dirname(os.path.abspath(self.filename))
+        fd, tmp = tempfile.mkstemp(dir=_dir)
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(_info, fp)
+            os.replace(tmp, self.filename)
+        except Exception as err:
+            logger.warning(
+                'Could not write cache file {}: {}'.format(self.filename, err))
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def __contains__(self, url):
+        return url in self._db
+
+    def entries(self):
+        return list(self._db.values())
+
+    def get(self, url):
+        """
+        :param url: The URL the response was fetched from
+        :return: A :py:class:`CacheEntry` instance or None
+        """
+        return self._db.get(url)
+
+    def _expires(self, headers, now):
+        _ttl = freshness_lifetime(headers, self.default_ttl, now)
+        if _ttl is None:
+            return None
+        return now + min(_ttl, self.max_ttl)
+
+    def set(self, url, response, headers=None, now=0):
+        """
+        Add a response to the cache, if the OP allows that.
+
+        :param url: The URL the response was fetched from
+        :param response: The response as a :py:class:`oicmsg.Message`
+            instance
+        :param headers: The HTTP response headers
+        :param now: The present time, seconds since epoch
+        :return: The :py:class:`CacheEntry` instance or None if the response
+            was not stored.
+        """
+        if not now:
+            now = _now()
+
+        _exp = self._expires(headers, now)
+        _etag = _header(headers, 'ETag') or ''
+
+        with self._lock:
+            if _exp is None or (_exp <= now and not _etag):
+                # Nothing to reuse or revalidate
+                self._db.pop(url, None)
+                entry = None
+            else:
+                entry = CacheEntry(copy.deepcopy(response.to_dict()), _etag,
+                                   _exp)
+                self._db[url] = entry
+            if self.filename:
+                self._dump()
+        return entry
+
+    def revalidated(self, url, headers=None, now=0):
+        """
+        The OP said that the cached response is still valid.
+
+        :param url: The URL the response was fetched from
+        :param headers: The headers of the 304 Not Modified response
+        :param now: The present time, seconds since epoch
+        """
+        if not now:
+            now = _now()
+
+        _exp = self._expires(headers, now)
+        with self._lock:
+            try:
+                entry = self._db[url]
+            except KeyError:
+                return
+            entry.expires = _exp or now
+            _etag = _header(headers, 'ETag')
+            if _etag:
+                entry.etag = _etag
+            if self.filename:
+                self._dump()
+
+    def remove(self, url):
+        with self._lock:
+            self._db.pop(url, None)
+            if self.filename:
+                self._dump()
+
+    def clear(self):
+        with self._lock:
+            self._db = {}
+            if self.filename:
+                self._dump()
+
+
+def unverified_payload(token):
+    """
+    Read the payload of a signed JWT without verifying the signature.
+
+    :param token: A signed JWT
+    :return: The payload as a dictionary or None if it can't be read, for
+        instance because the JWT is encrypted.
+    """
+    _parts = token.split('.')
+    if len(_parts) != 3:
+        return None
+    try:
+        _payload = json.loads(b64d(as_bytes(_parts[1])).decode('utf-8'))
+    except Exception:
+        return None
+    if not isinstance(_payload, dict):
+        return None
+    return _payload
+
+
+def key_fingerprint(keyjar, issuer):
+    """
+    Something that changes when the keys of an issuer changes. Each key
+    is represented by its JWK thumbprint, RFC 7638, so a key that is
+    replaced by another with the same key ID is noticed.
+
+    :param keyjar: A :py:class:`oicmsg.key_jar.KeyJar` instance
+    :param issuer: The issuer ID
+    :return: A tuple
+    """
+    return tuple(sorted(
+        [(k.thumbprint('SHA-256'), k.inactive_since)
+         for k in keyjar.get_issuer_keys(issuer)]))
+
+
+class VerifiedJWTCache(object):
+    """
+    A bounded cache of the claims in JWTs whose signature has been
+    verified, keyed by a digest of the JWT. An entry is kept until the JWT
+    expires, or for default_ttl seconds if it doesn't, and is not used if
+    the signing keys of the issuer have changed since it was added.
+    When the cache is full the least recently used entry is removed.
+    """
+
+    def __init__(self, max_size=1000, default_ttl=300):
+        """
+        :param max_size: The maximum number of entries
+        :param default_ttl: How long to keep the claims from a JWT without
+            an exp claim
+        """
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self._db = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._db)
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(as_bytes(token)).hexdigest()
+
+    def get(self, token, fingerprint, now=0):
+        """
+        :param token: The JWT
+        :param fingerprint: The present fingerprint of the issuer's keys
+        :param now: The present time, seconds since epoch
+        :return: A copy of the claims or None if there is no valid entry
+        """
+        _key = self.digest(token)
+        with self._lock:
+            try:
+                exp, _fp, claims = self._db[_key]
+            except KeyError:
+                return None
+
+            if exp <= (now or _now()) or _fp != fingerprint:
+                del self._db[_key]
+                return None
+            self._db.move_to_end(_key)
+
+        return copy.deepcopy(claims)
+
+    def set(self, token, claims, fingerprint, now=0):
+        """
+        Add the claims from a verified JWT.
+
+        :param token: The JWT
+        :param claims: The claims as a dictionary
+        :param fingerprint: The fingerprint of the issuer's keys used when
+            verifying
+        :param now: The present time, seconds since epoch
+        """
+        if not now:
+            now = _now()
+
+        try:
+            exp = int(claims['exp'])
+        except (KeyError, TypeError, ValueError):
+            exp = now + self.default_ttl
+        if exp <= now:
+            return
+
+        _key = self.digest(token)
+        with self._lock:
+            self._db[_key] = (exp, fingerprint, copy.deepcopy(claims))
+            self._db.move_to_end(_key)
+            while len(self._db) > self.max_size:
+                self._db.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._db = OrderedDict()
+
+
+# The cache used by all ProviderInfoDiscovery services that are not
+# configured to use some other.
+PROVIDER_INFO_CACHE = ProviderInfoCache()
+
+# The cache of verified aggregated claims used by all UserInfo services
+# that are not configured to use some other.
+VERIFIED_JWT_CACHE = VerifiedJWTCache()
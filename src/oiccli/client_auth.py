@@ -1,10 +1,13 @@
 import base64
 import logging
+import threading
+from collections import deque
 
 from cryptojwt.jws import alg2keytype
 from oiccli.exception import MissingRequiredAttribute
 
 from oiccli import rndstr
+from oiccli import LazyFormat
 from oiccli import sanitize
 from oiccli import DEF_SIGN_ALG
 from oiccli import JWT_BEARER
@@ -48,10 +51,143 @@ def assertion_jwt(client_id, keys, audience, algorithm, lifetime=600):
     at = AuthnToken(iss=client_id, sub=client_id,
                     aud=audience, jti=rndstr(32),
                     exp=_now + lifetime, iat=_now)
-    logger.debug('AuthnToken: {}'.format(at.to_dict()))
+    logger.debug(LazyFormat('AuthnToken: {}', at))
     return at.to_jwt(key=keys, algorithm=algorithm)
 
 
+class AssertionPool(object):
+    """
+    Keeps a number of signed client assertions ready for use, so that
+    signing, which for asymmetric keys is expensive, is done in the
+    background and not while a token request is being made.
+
+    There is one pool of assertions per client ID, audience, signing
+    algorithm, signing keys and lifetime. A pool is created the first time
+    an assertion for that combination is asked for and is then kept filled
+    by :py:meth:`refill`, normally called by the worker thread started
+    with :py:meth:`start`. Every assertion has a unique jti and is only
+    handed out once. Assertions that are about to expire are thrown away.
+    If a pool is empty an assertion is signed on the spot.
+    """
+
+    def __init__(self, size=10, min_remaining=60, idle=3600):
+        """
+        :param size: The number of assertions to keep per pool
+        :param min_remaining: An assertion is thrown away when it has
+            less than this many seconds left to live.
+        :param idle: A pool that hasn't been used for this many seconds
+            is removed.
+        """
+        self.size = size
+        self.min_remaining = min_remaining
+        self.idle = idle
+        self._pools = {}
+        self._cond = threading.Condition()
+        self._stop = False
+        self._thread = None
+
+    @staticmethod
+    def pool_key(client_id, keys, audience, algorithm, lifetime):
+        # Keys are identified by their JWK thumbprint, RFC 7638, as in
+        # oiccli.cache.key_fingerprint
+        return (client_id, audience, algorithm, lifetime,
+                tuple([(k.kid, k.thumbprint('SHA-256')) for k in keys]))
+
+    def get(self, client_id, keys, audience, algorithm, lifetime=600):
+        """
+        Get a signed assertion. Arguments are the same as for
+        :py:func:`assertion_jwt`.
+
+        :return: A Signed Json Web Token
+        """
+        _key = self.pool_key(client_id, keys, audience, algorithm, lifetime)
+        _now = utc_time_sans_frac()
+
+        with self._cond:
+            try:
+                _pool = self._pools[_key]
+            except KeyError:
+                _pool = {'args': (client_id, keys, audience, algorithm,
+                                  lifetime),
+                         'queue': deque()}
+                self._pools[_key] = _pool
+            _pool['used'] = _now
+
+            _queue = _pool['queue']
+            while _queue:
+                exp, _jwt = _queue.popleft()
+                if exp - _now >= self.min_remaining:
+                    if len(_queue) < self.size // 2:
+                        self._cond.notify()
+                    return _jwt
+
+            self._cond.notify()
+
+        logger.debug('Assertion pool empty, signing inline')
+        return assertion_jwt(client_id, keys, audience, algorithm, lifetime)
+
+    def refill(self):
+        """
+        Remove unused pools and expired assertions and fill up the pools.
+
+        :return: The number of assertions signed
+        """
+        _now = utc_time_sans_frac()
+        _todo = []
+        with self._cond:
+            for _key, _pool in list(self._pools.items()):
+                if _now - _pool['used'] > self.idle:
+                    del self._pools[_key]
+                    continue
+                _queue = _pool['queue']
+                while _queue and _queue[0][0] - _now < self.min_remaining:
+                    _queue.popleft()
+                if len(_queue) < self.size:
+                    _todo.append((_pool, self.size - len(_queue)))
+
+        n = 0
+        for _pool, _count in _todo:
+            client_id, keys, audience, algorithm, lifetime = _pool['args']
+            for _ in range(_count):
+                _exp = utc_time_sans_frac() + lifetime
+                _jwt = assertion_jwt(client_id, keys, audience, algorithm,
+                                     lifetime)
+                with self._cond:
+                    _pool['queue'].append((_exp, _jwt))
+                n += 1
+        return n
+
+    def run(self):
+        while True:
+            with self._cond:
+                if self._stop:
+                    return
+                # Also wake up now and then to throw away old assertions
+                self._cond.wait(self.min_remaining)
+                if self._stop:
+                    return
+
+            try:
+                self.refill()
+            except Exception as err:
+                logger.error('Failed to sign assertions: {}'.format(err))
+
+    def start(self):
+        self._stop = False
+        self._thread = threading.Thread(target=self.run, name='AssertionPool')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
 class ClientAuthnMethod(object):
     """
     Basic Client Authentication Method class.
@@ -393,11 +529,21 @@ class JWSAuthnMethod(ClientAuthnMethod):
             except KeyError:
                 _args = {}
 
+            try:
+                _pool = cli_info.assertion_pool
+            except AttributeError:
+                _pool = None
+
             # construct the signed JWT with the assertions and add
             # it as value to the 'client_assertion' claim of the request
-            request["client_assertion"] = assertion_jwt(
-                cli_info.client_id, signing_key, audience,
-                algorithm, **_args)
+            if _pool is None:
+                request["client_assertion"] = assertion_jwt(
+                    cli_info.client_id, signing_key, audience,
+                    algorithm, **_args)
+            else:
+                request["client_assertion"] = _pool.get(
+                    cli_info.client_id, signing_key, audience,
+                    algorithm, **_args)
 
             request["client_assertion_type"] = JWT_BEARER
 
@@ -5,6 +5,7 @@ from cryptojwt import as_bytes
 from cryptojwt.jwk import import_private_rsa_key_from_file
 from cryptojwt.jwk import RSAKey
 from oiccli import DEF_SIGN_ALG
+from oiccli.key_refresh import RefreshingKeyBundle
 from oiccli.state import State
 from oicmsg.key_bundle import KeyBundle
 from oicmsg.key_jar import build_keyjar
@@ -60,6 +61,9 @@ class ClientInfo(object):
         self._c_id = ''
         self._c_secret = ''
         self.issuer = ''
+        self.key_refresher = None
+        self.assertion_pool = None
+        self.request_object_store = None
 
         for key, val in kwargs.items():
             setattr(self, key, val)
@@ -223,7 +227,9 @@ class ClientInfo(object):
         The client needs it's own set of keys. It can either dynamically
         create them or load them from local storage.
         This method can also fetch other entities keys provided the
-        URL points to a JWKS.
+        URL points to a JWKS. Remote key sets are kept up to date by
+        self.key_refresher, a :py:class:`oiccli.key_refresh.KeyRefresher`
+        instance, if there is one.
 
         :param keyspec:
         """
@@ -240,5 +246,6 @@ class ClientInfo(object):
                             self.keyjar.add_kb('', _kb)
             elif where == 'url':
                 for iss, url in spec.items():
-                    kb = KeyBundle(source=url)
+                    kb = RefreshingKeyBundle(source=url,
+                                             refresher=self.key_refresher)
                     self.keyjar.add_kb(iss, kb)
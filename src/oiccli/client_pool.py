@@ -0,0 +1,306 @@
+import logging
+import sys
+import threading
+import types
+from collections import OrderedDict
+
+from oiccli.cache import PROVIDER_INFO_CACHE
+from oiccli.client_auth import CLIENT_AUTHN_METHOD
+from oiccli.http import POOL_CONNECTIONS, HTTPLib, pooled_session
+from oiccli.metrics import METRICS
+from oiccli.oic import DEFAULT_SERVICES, Client
+from oiccli.state import State
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+# Things that are never counted as belonging to a client
+SKIP_TYPES = (type, types.ModuleType, types.FunctionType,
+              types.BuiltinFunctionType, types.MethodType)
+
+
+def deep_size(obj, exclude=None):
+    """
+    Estimate how much memory an object and everything it refers to uses.
+
+    :param obj: The object
+    :param exclude: Set of ids of objects that should not be counted,
+        for instance because they are shared.
+    :return: Size in bytes
+    """
+    _seen = set(exclude or [])
+    _size = 0
+    _todo = [obj]
+    while _todo:
+        _obj = _todo.pop()
+        if id(_obj) in _seen or isinstance(_obj, SKIP_TYPES):
+            continue
+        _seen.add(id(_obj))
+        try:
+            _size += sys.getsizeof(_obj)
+        except TypeError:
+            continue
+
+        if isinstance(_obj, dict):
+            _todo.extend(_obj.keys())
+            _todo.extend(_obj.values())
+        elif isinstance(_obj, (list, tuple, set, frozenset)):
+            _todo.extend(_obj)
+
+        try:
+            _todo.append(_obj.__dict__)
+        except AttributeError:
+            pass
+    return _size
+
+
+class ClientPool(object):
+    """
+    Keeps one client per OP, keyed by issuer.
+
+    Clients are created the first time they are asked for. All clients
+    share one HTTP connection pool and one provider info cache, so a client
+    that is created again for an OP that has been seen before doesn't have
+    to fetch the provider configuration.
+
+    When there are more than max_clients clients, or they together use more
+    memory than memory_budget, the least recently used clients are removed.
+    State information is lost when a client is removed unless a state store
+    shared by all clients is given.
+    """
+
+    def __init__(self, configs=None, config_loader=None, client_cls=Client,
+                 services=None, max_clients=100, memory_budget=0,
+                 session=None, provider_info_cache=PROVIDER_INFO_CACHE,
+                 state_store=None, guard=None, **client_args):
+        """
+        :param configs: Dictionary with client configurations, issuers as
+            keys.
+        :param config_loader: A function that given an issuer returns the
+            client configuration for that issuer. Used for issuers that are
+            not in configs.
+        :param client_cls: The client class
+        :param services: Services the clients should have
+        :param max_clients: The maximum number of clients to keep
+        :param memory_budget: The maximum number of bytes the clients may
+            use together. 0 means no limit.
+        :param session: A :py:class:`requests.Session` instance shared by
+            all clients. One, caching connection pools for at least
+            max_clients hosts, is created if not given.
+        :param provider_info_cache: A
+            :py:class:`oiccli.cache.ProviderInfoCache` instance
+        :param state_store: A :py:class:`oiccli.state_store.StateStore`
+            instance in which all clients keeps their state information.
+        :param guard: A :py:class:`oiccli.breaker.HostGuard` instance shared
+            by all clients, so that one failing OP can't tie up all threads.
+        :param client_args: Extra arguments to the client class constructor
+        """
+        self.configs = configs or {}
+        self.config_loader = config_loader
+        self.client_cls = client_cls
+        self.services = services or DEFAULT_SERVICES
+        self.max_clients = max_clients
+        self.memory_budget = memory_budget
+        self.session = session or pooled_session(
+            pool_connections=max(max_clients, POOL_CONNECTIONS))
+        self.provider_info_cache = provider_info_cache
+        self.state_store = state_store
+        self.guard = guard
+        self.client_args = client_args
+
+        self._clients = OrderedDict()
+        self._sizes = {}
+        self._building = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, issuer):
+        return issuer in self._clients
+
+    def __len__(self):
+        return len(self._clients)
+
+    def __getitem__(self, issuer):
+        return self.get(issuer)
+
+    def issuers(self):
+        return list(self._clients.keys())
+
+    def config(self, issuer):
+        """
+        :param issuer: The issuer ID of an OP
+        :return: The client configuration to use with that OP
+        """
+        try:
+            _conf = self.configs[issuer]
+        except KeyError:
+            if self.config_loader is None:
+                raise KeyError(issuer)
+            _conf = self.config_loader(issuer)
+            if _conf is None:
+                raise KeyError(issuer)
+
+        _conf = dict(_conf)
+        _conf.setdefault('issuer', issuer)
+        return _conf
+
+    def _services(self):
+        _srvs = []
+        for name, conf in self.services:
+            if name == 'ProviderInfoDiscovery':
+                conf = dict(conf, cache=self.provider_info_cache)
+            _srvs.append((name, conf))
+        return _srvs
+
+    def _cached_provider_info(self, client):
+        """
+        If the provider info for the client's OP is in the cache, use it.
+        """
+        if self.provider_info_cache is None:
+            return
+
+        try:
+            _srv = client.service['provider_info']
+        except KeyError:
+            return
+
+        _url = _srv.request_info(client.client_info)['uri']
+        entry = self.provider_info_cache.get(_url)
+        if entry is not None and entry.fresh():
+            _srv._cached_response(entry, client.client_info)
+
+    def build(self, issuer):
+        """
+        Create a new client for an OP.
+
+        :param issuer: The issuer ID of the OP
+        :return: A client_cls instance
+        """
+        _conf = self.config(issuer)
+        _http = HTTPLib(session=self.session,
+                        verify_ssl=self.client_args.get('verify_ssl', True),
+                        ca_certs=self.client_args.get('ca_certs'),
+                        client_cert=self.client_args.get('client_cert'),
+                        guard=self.guard)
+        client = self.client_cls(config=_conf, httplib=_http,
+                                 services=self._services(),
+                                 **self.client_args)
+
+        if self.state_store is not None:
+            client.client_info.state_db = State(client.client_info.client_id,
+                                                db=self.state_store)
+
+        self._cached_provider_info(client)
+        return client
+
+    def get(self, issuer):
+        """
+        Get the client for an OP, creating it if necessary. Only one client
+        is created for an OP even if several threads ask for it at the same
+        time.
+
+        :param issuer: The issuer ID of the OP
+        :return: A client_cls instance
+        """
+        while True:
+            with self._lock:
+                try:
+                    client = self._clients[issuer]
+                except KeyError:
+                    pass
+                else:
+                    self._clients.move_to_end(issuer)
+                    return client
+
+                try:
+                    _event = self._building[issuer]
+                except KeyError:
+                    _event = threading.Event()
+                    self._building[issuer] = _event
+                    break
+            # Someone else is creating the client
+            _event.wait()
+
+        try:
+            client = self.build(issuer)
+            self.add(issuer, client)
+        finally:
+            with self._lock:
+                del self._building[issuer]
+            _event.set()
+        return client
+
+    def _exclude(self):
+        """
+        :return: ids of the objects that are shared between clients
+        """
+        _shared = [self.session, self.state_store, self.guard, METRICS,
+                   CLIENT_AUTHN_METHOD]
+        # Whatever is given to every client, like an event store, a tracer
+        # or service configurations.
+        _shared.extend(self.client_args.values())
+        for _, conf in self.services:
+            _shared.append(conf)
+            _shared.extend(conf.values())
+
+        _ids = set([id(obj) for obj in _shared])
+        if self.provider_info_cache is not None:
+            _ids.add(id(self.provider_info_cache))
+        return _ids
+
+    def add(self, issuer, client):
+        """
+        Add a client, removing least recently used clients if needed.
+
+        :param issuer: The issuer ID of the OP
+        :param client: The client
+        """
+        _size = 0
+        if self.memory_budget:
+            _size = deep_size(client, self._exclude())
+
+        with self._lock:
+            self._clients[issuer] = client
+            self._clients.move_to_end(issuer)
+            self._sizes[issuer] = _size
+            self._evict()
+
+    def _evict(self):
+        _total = sum(self._sizes.values())
+        while len(self._clients) > 1:
+            if len(self._clients) <= self.max_clients and (
+                    not self.memory_budget or _total <= self.memory_budget):
+                break
+            issuer, _ = self._clients.popitem(last=False)
+            _total -= self._sizes.pop(issuer, 0)
+            logger.debug('Removed client for {}'.format(issuer))
+
+    def measure(self):
+        """
+        Measure the memory used by each client again, clients grow as they
+        collect state, and remove clients if over budget.
+
+        :return: The total number of bytes used by the clients
+        """
+        _exclude = self._exclude()
+        with self._lock:
+            _clients = list(self._clients.items())
+
+        _sizes = dict([(issuer, deep_size(client, _exclude))
+                       for issuer, client in _clients])
+        with self._lock:
+            for issuer, _size in _sizes.items():
+                if issuer in self._sizes:
+                    self._sizes[issuer] = _size
+            self._evict()
+            return sum(self._sizes.values())
+
+    def remove(self, issuer):
+        with self._lock:
+            del self._clients[issuer]
+            self._sizes.pop(issuer, None)
+
+    def clear(self):
+        with self._lock:
+            self._clients = OrderedDict()
+            self._sizes = {}
@@ -0,0 +1,282 @@
+import json
+import logging
+import queue
+import random
+import socket
+import threading
+import time
+from collections import deque
+
+from oiccli import sanitize
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+"""
+An event store that can be given to services, HTTP libraries and client
+info instances, as their events attribute, and be left on in production.
+
+The events are kept in a ring buffer of fixed size so the oldest ones are
+dropped when it's full. What is stored is not the HTTP response or
+message instance but a small summary of it, with secrets redacted and
+long values cut, so the store doesn't keep large objects alive.
+Events can also be exported, by a background thread, to a file or a
+socket.
+"""
+
+# What is added to a value that has been cut
+TRUNCATED = '...'
+
+
+def shrink(value, max_size):
+    """
+    Cut long strings in a value.
+
+    :param value: A string, a dictionary or a list
+    :param max_size: The maximum length of a string
+    :return: A copy of value with no string longer than max_size
+    """
+    if isinstance(value, str):
+        if len(value) > max_size:
+            return value[:max_size] + TRUNCATED
+        return value
+    if isinstance(value, dict):
+        return dict([(k, shrink(v, max_size)) for k, v in value.items()])
+    if isinstance(value, (list, tuple)):
+        return [shrink(v, max_size) for v in value]
+    return value
+
+
+def summarize(data, max_size=1024):
+    """
+    Make a lightweight, JSON serializable, copy of what is stored in an
+    event.
+
+    :param data: An HTTP response, a :py:class:`oicmsg.message.Message`
+        instance, a dictionary or a string
+    :param max_size: The maximum length of a string in the summary
+    :return: A string or a dictionary
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf-8', 'replace')
+    if isinstance(data, str):
+        return sanitize(shrink(data, max_size))
+
+    try:
+        _status = data.status_code
+    except AttributeError:
+        pass
+    else:
+        # An HTTP response
+        _summary = {'status_code': _status,
+                    'url': getattr(data, 'url', ''),
+                    'text': shrink(getattr(data, 'text', '') or '', max_size)}
+        try:
+            _summary['headers'] = dict(data.headers.items())
+        except AttributeError:
+            pass
+        return sanitize(_summary)
+
+    if isinstance(data, (int, float, bool)) or data is None:
+        return data
+
+    _info = sanitize(data)
+    if isinstance(_info, (dict, list)):
+        return shrink(_info, max_size)
+    return shrink(repr(_info), max_size)
+
+
+class Event(object):
+    __slots__ = ['timestamp', 'typ', 'ref', 'data']
+
+    def __init__(self, timestamp, typ, data, ref=''):
+        """
+        :param timestamp: When the event happened, seconds since epoch
+        :param typ: What kind of event it is, like 'HTTP response'
+        :param data: A summary of the stored data
+        :param ref: A reference, for instance the URL a response came from
+        """
+        self.timestamp = timestamp
+        self.typ = typ
+        self.data = data
+        self.ref = ref
+
+    def to_dict(self):
+        return {'timestamp': self.timestamp, 'type': self.typ,
+                'ref': self.ref, 'data': self.data}
+
+
+class FileExporter(object):
+    """
+    Appends events, one JSON document per line, to a file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fp = None
+
+    def export(self, event):
+        if self._fp is None:
+            self._fp = open(self.filename, 'a')
+        self._fp.write(json.dumps(event, default=str) + '\n')
+        self._fp.flush()
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+
+class SocketExporter(object):
+    """
+    Sends events, one JSON document per line, over a TCP connection, for
+    instance to a log collector. The connection is opened on first use and
+    reopened if it's lost.
+    """
+
+    def __init__(self, host, port, timeout=5):
+        """
+        :param host: The host to connect to
+        :param port: The port to connect to
+        :param timeout: Connect and send timeout in seconds
+        """
+        self.address = (host, port)
+        self.timeout = timeout
+        self._sock = None
+
+    def export(self, event):
+        _line = (json.dumps(event, default=str) + '\n').encode('utf-8')
+        if self._sock is None:
+            self._sock = socket.create_connection(self.address,
+                                                  self.timeout)
+        try:
+            self._sock.sendall(_line)
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+
+class EventStore(object):
+    """
+    Keeps the latest events in a ring buffer. Can be shared by several
+    services, HTTP libraries and client info instances.
+    """
+
+    def __init__(self, max_events=1000, sample_rate=1.0, max_size=1024,
+                 types=None, exporter=None, queue_size=10000):
+        """
+        :param max_events: How many events to keep
+        :param sample_rate: The fraction, between 0 and 1, of the events
+            that are stored
+        :param max_size: The maximum length of a string in a stored event
+        :param types: If given only events of these types are stored
+        :param exporter: Something with an export method, like
+            :py:class:`FileExporter` or :py:class:`SocketExporter`, that
+            is given each stored event as a dictionary. Exporting is done
+            by a background thread.
+        :param queue_size: How many events may wait to be exported. If the
+            exporter can't keep up events are dropped.
+        """
+        self.sample_rate = sample_rate
+        self.max_size = max_size
+        self.types = types
+        self.exporter = exporter
+        self.dropped = 0
+        self._events = deque(maxlen=max_events)
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._events)
+
+    def store(self, typ, data, ref=''):
+        """
+        Store an event.
+
+        :param typ: What kind of event it is
+        :param data: The data connected to the event, only a summary of it
+            is kept.
+        :param ref: A reference, for instance a URL
+        """
+        if self.types is not None and typ not in self.types:
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+
+        _event = Event(time.time(), typ, summarize(data, self.max_size), ref)
+        self._events.append(_event)
+
+        if self.exporter is not None:
+            self._start()
+            try:
+                self._queue.put_nowait(_event)
+            except queue.Full:
+                self.dropped += 1
+
+    def events(self, typ=None):
+        """
+        :param typ: If given only events of this type are returned
+        :return: The stored events, oldest first
+        """
+        _events = list(self._events)
+        if typ is None:
+            return _events
+        return [e for e in _events if e.typ == typ]
+
+    def clear(self):
+        self._events.clear()
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._export,
+                                                name='oiccli-events')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _export(self):
+        while not self._stop.is_set():
+            _event = self._queue.get()
+            if _event is None:
+                break
+            try:
+                self.exporter.export(_event.to_dict())
+            except Exception as err:
+                self.dropped += 1
+                logger.warning('Could not export event: {}'.format(err))
+
+    def close(self, timeout=5):
+        """
+        Export the events that are waiting and stop the export thread.
+
+        :param timeout: How long to wait for the export to finish
+        """
+        if self._thread is not None:
+            _end = time.time() + timeout
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                # The exporter can't keep up, the events still waiting
+                # are not exported.
+                logger.warning('Event export queue full when closing')
+                self._stop.set()
+            self._thread.join(max(_end - time.time(), 0))
+            if self._thread.is_alive():
+                logger.warning('Event export thread did not stop')
+            self._thread = None
+        if self.exporter is not None:
+            self.exporter.close()
@@ -113,4 +113,16 @@ class ConfigurationError(OicCliError):
 
 
 class WrongContentType(OicCliError):
-    pass
\ No newline at end of file
+    pass
+
+
+class CircuitOpen(OicCliError):
+    pass
+
+
+class HostBusy(OicCliError):
+    pass
+
+
+class DeadlineExceeded(OicCliError):
+    pass
@@ -1,13 +1,28 @@
 import copy
 import logging
+import random
+import time
+from http.cookiejar import DefaultCookiePolicy
 from http.cookiejar import FileCookieJar
+from http.cookiejar import http2time
 from http.cookies import CookieError
 from http.cookies import SimpleCookie
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from oiccli import sanitize
+from oiccli.exception import CircuitOpen
+from oiccli.exception import DeadlineExceeded
+from oiccli.exception import HostBusy
 from oiccli.exception import NonFatalException
+from oiccli.metrics import HTTP_DURATION
+from oiccli.metrics import HTTP_ERRORS
+from oiccli.metrics import HTTP_REJECTED
+from oiccli.metrics import HTTP_REQUESTS
+from oiccli.metrics import METRICS
+from oiccli.util import cookies_for
 from oiccli.util import set_cookie
 from oicmsg.key_jar import KeyJar
 
@@ -15,10 +30,222 @@ __author__ = 'roland'
 
 logger = logging.getLogger(__name__)
 
+# Default number of per host connection pools and the number of
+# connections kept in each of them.
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 10
+
+# Default connect and read timeouts in seconds. The read timeout is the
+# longest time to wait for the server to send anything, not the time it
+# may take to receive the whole response.
+DEFAULT_TIMEOUT = (5, 30)
+
+# Responses that mean that the server may be able to handle the request if
+# it's sent again a bit later.
+RETRY_STATUS_CODES = [429, 503]
+
+# Methods that can be sent more than once without changing the outcome.
+IDEMPOTENT_METHODS = ['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE']
+
+
+class NoCookiePolicy(DefaultCookiePolicy):
+    """
+    Cookies are handled by :py:class:`HTTPLib` itself, so the cookie jar of
+    a :py:class:`requests.Session` must neither store nor return any.
+    Otherwise cookies would leak between clients sharing a session.
+    """
+
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+
+def pooled_session(pool_connections=POOL_CONNECTIONS,
+                   pool_maxsize=POOL_MAXSIZE, pool_block=False,
+                   keep_alive=True):
+    """
+    Create a :py:class:`requests.Session` that keeps persistent connections
+    to the hosts it talks to. One session can be shared by any number of
+    :py:class:`HTTPLib` instances and therefore by many clients.
+
+    :param pool_connections: The number of hosts for which connection pools
+        are cached.
+    :param pool_maxsize: The maximum number of connections kept per host.
+    :param pool_block: If True, never open more than pool_maxsize
+        connections to a host, instead wait for one to be freed.
+    :param keep_alive: If False the connection is closed after each request.
+    :return: A :py:class:`requests.Session` instance
+    """
+    session = requests.Session()
+    session.cookies.set_policy(NoCookiePolicy())
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+
+    for scheme in ['https://', 'http://']:
+        session.mount(scheme, HTTPAdapter(pool_connections=pool_connections,
+                                          pool_maxsize=pool_maxsize,
+                                          pool_block=pool_block))
+    return session
+
+
+def deadline_timeout(timeout, deadline, now=0):
+    """
+    Shorten a timeout so that a request is given up at the deadline.
+
+    :param timeout: A timeout as used by requests, a number, a tuple of
+        connect and read timeouts or None.
+    :param deadline: When the request must be finished, seconds since epoch
+    :param now: The present time, seconds since epoch
+    :return: The new timeout
+    """
+    _left = deadline - (now or time.time())
+    if _left <= 0:
+        raise DeadlineExceeded('Deadline passed before the request was sent')
+
+    if timeout is None:
+        return _left
+    if isinstance(timeout, tuple):
+        return tuple([_left if t is None else min(t, _left) for t in timeout])
+    return min(timeout, _left)
+
+
+class RetryPolicy(object):
+    """
+    Decides whether, and after how long, a request should be sent again
+    when it failed with a connection error or was answered with one of the
+    status codes in status_codes.
+
+    The time between attempts grows exponentially and a random part of it
+    is used (full jitter) so that many clients don't retry in step. If the
+    server sends Retry-After that is honored. No more attempts are made
+    once max_time seconds have passed since the first one.
+
+    Only idempotent requests are retried unless retry_non_idempotent is
+    True or the request is marked as idempotent.
+    """
+
+    def __init__(self, max_retries=3, backoff_factor=0.5, max_backoff=10,
+                 max_time=30, status_codes=None, methods=None,
+                 retry_non_idempotent=False, sleep=time.sleep):
+        """
+        :param max_retries: The maximum number of times a request is resent
+        :param backoff_factor: The longest wait before the first retry,
+            doubled for every following retry.
+        :param max_backoff: The longest wait between two attempts unless
+            the server says otherwise using Retry-After.
+        :param max_time: For how many seconds, counted from the first
+            attempt, a request may be retried.
+        :param status_codes: Response status codes that trigger a retry
+        :param methods: HTTP methods that are regarded as idempotent
+        :param retry_non_idempotent: Retry all requests
+        :param sleep: The function used to wait
+        """
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.max_time = max_time
+        self.status_codes = status_codes or RETRY_STATUS_CODES
+        self.methods = methods or IDEMPOTENT_METHODS
+        self.retry_non_idempotent = retry_non_idempotent
+        self.sleep = sleep
+
+    def allowed(self, method, idempotent=None):
+        """
+        :param method: The HTTP method
+        :param idempotent: True/False if the caller knows whether the
+            request can be sent more than once, otherwise None.
+        :return: True if the request may be retried
+        """
+        if idempotent is not None:
+            return idempotent or self.retry_non_idempotent
+        return self.retry_non_idempotent or method.upper() in self.methods
+
+    @staticmethod
+    def retry_after(response, now=0):
+        """
+        :param response: A HTTP response
+        :param now: The present time, seconds since epoch
+        :return: The number of seconds the server asked us to wait or None
+        """
+        try:
+            _val = response.headers['Retry-After']
+        except (AttributeError, KeyError):
+            return None
+
+        try:
+            return max(int(_val), 0)
+        except ValueError:
+            pass
+
+        _when = http2time(_val)
+        if _when is None:
+            return None
+        return max(_when - (now or time.time()), 0)
+
+    def backoff(self, attempt):
+        """
+        :param attempt: The number of retries done so far
+        :return: A random number of seconds to wait
+        """
+        _max = min(self.backoff_factor * (2 ** attempt), self.max_backoff)
+        return random.uniform(0, _max)
+
+    def retry_on(self, error=None, response=None,
+                 errors=(requests.ConnectionError,)):
+        """
+        :param error: The exception raised when sending the request
+        :param response: The response to the request
+        :param errors: The exception classes that mean that the server
+            could not be reached
+        :return: True if the error or response warrants a retry
+        """
+        if error is not None:
+            return isinstance(error, errors)
+        return response.status_code in self.status_codes
+
+    def delay(self, attempt, started, response=None, now=0, deadline=0):
+        """
+        How long to wait before the next attempt.
+
+        :param attempt: The number of retries done so far
+        :param started: When the first attempt was made, seconds since epoch
+        :param response: The response, if one was received
+        :param now: The present time, seconds since epoch
+        :param deadline: If given no attempt is made after this time,
+            seconds since epoch
+        :return: Number of seconds or None if no more attempts should be
+            made.
+        """
+        if attempt >= self.max_retries:
+            return None
+
+        if not now:
+            now = time.time()
+
+        _delay = None
+        if response is not None:
+            _delay = self.retry_after(response, now)
+        if _delay is None:
+            _delay = self.backoff(attempt)
+
+        if now + _delay - started > self.max_time:
+            return None
+        if deadline and now + _delay >= deadline:
+            return None
+        return _delay
+
 
 class HTTPLib(object):
+    # Exceptions raised by the HTTP library when a server can't be reached
+    connection_errors = (requests.ConnectionError,)
+
     def __init__(self, ca_certs=None, verify_ssl=True, keyjar=None,
-                 client_cert=None):
+                 client_cert=None, session=None,
+                 pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                 pool_block=False, keep_alive=True, retry=None, guard=None,
+                 timeout=DEFAULT_TIMEOUT, metrics=METRICS):
         """
         A base class for OAuth2 clients and servers
 
@@ -30,11 +257,29 @@ class HTTPLib(object):
         :param client_cert: local cert to use as client side certificate, as a
             single file (containing the private key and the certificate) or as
             a tuple of both file's path
+        :param session: A :py:class:`requests.Session` instance, typically
+            one created by :py:func:`pooled_session`. Allows several
+            HTTPLib instances to share one connection pool.
+        :param pool_connections: Number of per host connection pools to cache
+        :param pool_maxsize: Maximum number of connections per host
+        :param pool_block: Whether to block when a host's pool is exhausted
+        :param keep_alive: Whether connections should be kept open between
+            requests.
+        :param retry: A :py:class:`RetryPolicy` instance. If not given every
+            request is sent once.
+        :param guard: A :py:class:`oiccli.breaker.HostGuard` instance that
+            limits the number of requests in flight to a host and stops
+            sending requests to hosts that keep failing.
+        :param timeout: Default connect and read timeouts, in seconds, as a
+            tuple or one number used for both. None means wait forever.
+        :param metrics: A :py:class:`oiccli.metrics.Metrics` instance where
+            the number of requests and their latency per host and status
+            are counted. None means that nothing is counted.
         """
 
         self.keyjar = keyjar or KeyJar(verify_ssl=verify_ssl)
 
-        self.request_args = {"allow_redirects": False}
+        self.request_args = {"allow_redirects": False, "timeout": timeout}
 
         self.cookiejar = FileCookieJar()
         self.ca_certs = ca_certs
@@ -64,12 +309,43 @@ class HTTPLib(object):
         if client_cert:
             self.request_args['cert'] = client_cert
 
-    def _cookies(self):
+        self.pool_args = {'pool_connections': pool_connections,
+                          'pool_maxsize': pool_maxsize,
+                          'pool_block': pool_block,
+                          'keep_alive': keep_alive}
+        self._session = session
+        self.retry = retry
+        self.guard = guard
+        self.metrics = metrics
+
+    @property
+    def session(self):
+        """
+        The session used to send requests. Created on first use if none
+        was given when this instance was constructed.
+        """
+        if self._session is None:
+            self._session = pooled_session(**self.pool_args)
+        return self._session
+
+    def close(self):
+        """
+        Close the connections held by the session.
+        """
+        if self._session is not None:
+            self._session.close()
+
+    def _cookies(self, url=''):
         """
-        Return a dictionary of all the cookies I have keyed on cookie name
+        Return a dictionary of the cookies I have keyed on cookie name
 
+        :param url: If given only the cookies that should be sent to this
+            URL are returned.
         :return: Dictionary
         """
+        if url:
+            return cookies_for(self.cookiejar, url)
+
         cookie_dict = {}
 
         for _, a in list(self.cookiejar._cookies.items()):
@@ -79,54 +355,168 @@ class HTTPLib(object):
 
         return cookie_dict
 
-    def __call__(self, url, method="GET", **kwargs):
+    def _request_kwargs(self, url, method, **kwargs):
         """
-        Send a HTTP request to a URL using a specified method
+        Gather the arguments that should be used when sending a request.
 
         :param url: The URL to access
         :param method: The method to use (GET, POST, ..)
         :param kwargs: extra HTTP request parameters
-        :return: A Response
+        :return: Dictionary with request arguments
         """
-
         # copy the default set before starting to modify it.
         _kwargs = copy.copy(self.request_args)
         if kwargs:
             _kwargs.update(kwargs)
 
-        # If I have cookies add them all to the request
-        if self.cookiejar:
-            _kwargs["cookies"] = self._cookies()
-            logger.debug("SENT {} COOKIES".format(len(_kwargs["cookies"])))
+        # If I have cookies add those that match the URL to the request
+        if self.cookiejar._cookies:
+            _cookies = self._cookies(url)
+            if _cookies:
+                _kwargs["cookies"] = _cookies
+                logger.debug("SENT {} COOKIES".format(len(_cookies)))
 
         # If I want to modify the request arguments based on URL, method
         # and current arguments I can use this call back function.
         if self.req_callback is not None:
             _kwargs = self.req_callback(method, url, **_kwargs)
 
+        return _kwargs
+
+    def _response_cookies(self, response, url=''):
+        """
+        Add cookies received in a response to the cookie jar.
+
+        :param response: The HTTP response
+        :param url: The URL the request was sent to
+        """
+        try:
+            _cookie = response.headers["set-cookie"]
+            logger.debug("RECEIVED COOKIE")
+            try:
+                # add received cookies to the cookie jar
+                set_cookie(self.cookiejar, SimpleCookie(_cookie),
+                           urlsplit(url).hostname or '')
+            except CookieError as err:
+                logger.error(err)
+                raise NonFatalException(response, "{}".format(err))
+        except (AttributeError, KeyError) as err:
+            pass
+
+    def _retry_policy(self, method, kwargs):
+        """
+        Remove the retry related arguments from the request arguments and
+        find out which retry policy, if any, that applies.
+
+        :param method: The HTTP method
+        :param kwargs: The request arguments
+        :return: A :py:class:`RetryPolicy` instance or None
+        """
+        _retry = kwargs.pop('retry', self.retry)
+        _idempotent = kwargs.pop('idempotent', None)
+        if _retry is None or not _retry.allowed(method, _idempotent):
+            return None
+        return _retry
+
+    def _record(self, url, method, started, response=None, error=None):
+        """
+        Count a request sent, or that couldn't be sent, and how long it took.
+        Requests refused by the host guard are only counted as rejected.
+        """
+        _host = urlsplit(url).netloc.lower()
+        if isinstance(error, (CircuitOpen, HostBusy)):
+            self.metrics.inc(HTTP_REJECTED, {'host': _host,
+                                             'reason': type(error).__name__})
+            return
+
+        if error is None:
+            _status = response.status_code
+        else:
+            _status = 'error'
+            self.metrics.inc(HTTP_ERRORS, {'host': _host,
+                                           'error': type(error).__name__})
+        self.metrics.inc(HTTP_REQUESTS, {'host': _host, 'method': method,
+                                         'status': _status})
+        self.metrics.observe(HTTP_DURATION, time.monotonic() - started,
+                             {'host': _host})
+
+    def _send(self, url, method, _kwargs, deadline=0):
+        if deadline:
+            _kwargs = dict(_kwargs, timeout=deadline_timeout(
+                _kwargs.get('timeout'), deadline))
+
+        _started = time.monotonic()
         try:
             # Do the request
-            r = requests.request(method, url, **_kwargs)
+            if self.guard is None:
+                r = self.session.request(method, url, **_kwargs)
+            else:
+                r = self.guard.call(url, self.session.request, method, url,
+                                    **_kwargs)
         except Exception as err:
+            if self.metrics is not None:
+                self._record(url, method, _started, error=err)
             logger.error(
                 "http_request failed: %s, url: %s, htargs: %s, method: %s" % (
                     err, url, sanitize(_kwargs), method))
             raise
 
+        if self.metrics is not None:
+            self._record(url, method, _started, r)
+        return r
+
+    def __call__(self, url, method="GET", **kwargs):
+        """
+        Send a HTTP request to a URL using a specified method
+
+        :param url: The URL to access
+        :param method: The method to use (GET, POST, ..)
+        :param kwargs: extra HTTP request parameters. Three are not
+            handed to the HTTP library: 'retry', a :py:class:`RetryPolicy`
+            instance to use instead of the default one, 'idempotent'
+            which can be used to allow or forbid retrying the request and
+            'deadline', the time, in seconds since epoch, when waiting for
+            a response should stop.
+        :return: A Response
+        """
+
+        _deadline = kwargs.pop('deadline', 0)
+        _retry = self._retry_policy(method, kwargs)
+        _kwargs = self._request_kwargs(url, method, **kwargs)
+
+        if _retry is None:
+            r = self._send(url, method, _kwargs, _deadline)
+        else:
+            _started = time.time()
+            attempt = 0
+            while True:
+                try:
+                    r = self._send(url, method, _kwargs, _deadline)
+                except Exception as err:
+                    if not _retry.retry_on(error=err,
+                                           errors=self.connection_errors):
+                        raise
+                    _delay = _retry.delay(attempt, _started,
+                                          deadline=_deadline)
+                    if _delay is None:
+                        raise
+                else:
+                    if not _retry.retry_on(response=r):
+                        break
+                    _delay = _retry.delay(attempt, _started, r,
+                                          deadline=_deadline)
+                    if _delay is None:
+                        break
+
+                attempt += 1
+                logger.warning('Retrying {} {} in {:.2f} seconds'.format(
+                    method, url, _delay))
+                _retry.sleep(_delay)
+
         if self.events is not None:
             self.events.store('HTTP response', r, ref=url)
 
-        try:
-            _cookie = r.headers["set-cookie"]
-            logger.debug("RECEIVED COOKIE")
-            try:
-                # add received cookies to the cookie jar
-                set_cookie(self.cookiejar, SimpleCookie(_cookie))
-            except CookieError as err:
-                logger.error(err)
-                raise NonFatalException(r, "{}".format(err))
-        except (AttributeError, KeyError) as err:
-            pass
+        self._response_cookies(r, url)
 
         # return the response
         return r
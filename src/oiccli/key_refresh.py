@@ -0,0 +1,307 @@
+import logging
+import threading
+import time
+
+from oicmsg.key_bundle import KeyBundle
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshingKeyBundle(KeyBundle):
+    """
+    A key bundle for a remote JWKS that never makes a user of the keys
+    wait for a refresh if it can be avoided.
+
+    * When the cached keys have expired they are still used while new ones
+      are fetched in the background (stale-while-revalidate).
+    * Only one fetch is done at the time, other threads wanting fresh keys
+      wait for the result of that fetch (single-flight).
+    * If a key with an unknown key ID is asked for, the keys are fetched
+      immediately, since the remote end has probably rotated its keys.
+    * The keys are replaced in one go so a reader never sees an empty
+      bundle.
+
+    If a :py:class:`KeyRefresher` is used the bundle is refreshed before it
+    expires.
+    """
+
+    def __init__(self, keys=None, source="", cache_time=300, verify_ssl=True,
+                 fileformat="jwk", keytype="RSA", keyusage=None,
+                 refresher=None, max_stale=3600, retry_interval=60,
+                 kid_refetch_interval=10, remove_after=3600):
+        """
+        :param refresher: A :py:class:`KeyRefresher` instance
+        :param max_stale: For how many seconds after the keys have expired
+            they can be used while waiting for new ones. After that a
+            reader waits for the fetch.
+        :param retry_interval: How long to wait after a failed fetch before
+            trying again.
+        :param kid_refetch_interval: The minimum number of seconds between
+            two fetches caused by unknown key IDs.
+        :param remove_after: For how many seconds a key that is no longer
+            in the JWKS is kept, as inactive, before it's removed.
+        """
+        KeyBundle.__init__(self, keys=keys, source=source,
+                           cache_time=cache_time, verify_ssl=verify_ssl,
+                           fileformat=fileformat, keytype=keytype,
+                           keyusage=keyusage)
+        self.max_stale = max_stale
+        self.retry_interval = retry_interval
+        self.kid_refetch_interval = kid_refetch_interval
+        self.remove_after = remove_after
+        self.next_try = 0
+        self.last_kid_refetch = 0
+
+        self._cond = threading.Condition()
+        self._updating = False
+        self._pending = False
+        self._result = False
+
+        self.refresher = None
+        if refresher is not None:
+            refresher.add(self)
+
+    def _fetch_remote(self):
+        """
+        Fetch the JWKS into a new bundle, such that this bundle is left
+        untouched while the fetch is in progress.
+
+        :return: Tuple of a :py:class:`oicmsg.key_bundle.KeyBundle`
+            instance and whether anything changed.
+        """
+        _kb = KeyBundle(source=self.source, cache_time=self.cache_time,
+                        verify_ssl=self.verify_ssl)
+        # Makes it a conditional request
+        _kb.etag = self.etag
+        _kb.imp_jwks = self.imp_jwks
+        return _kb, _kb.do_remote()
+
+    def _fetch(self):
+        try:
+            _kb, changed = self._fetch_remote()
+        except Exception as err:
+            logger.error(
+                'Fetching keys from {} failed: {}'.format(self.source, err))
+            self.next_try = time.time() + self.retry_interval
+            return False
+
+        now = time.time()
+        if changed:
+            _keys = list(_kb._keys)
+            for _key in self._keys:
+                if _key not in _keys:
+                    if not _key.inactive_since:
+                        _key.inactive_since = now
+                    _keys.append(_key)
+            self.imp_jwks = _kb.imp_jwks
+        else:
+            # Not modified, the bundle used for the request has no keys
+            _keys = list(self._keys)
+
+        self._keys = [k for k in _keys if not k.inactive_since or
+                      now - k.inactive_since < self.remove_after]
+        self.etag = _kb.etag or self.etag
+        self.time_out = now + self.cache_time
+        self.next_try = 0
+        return changed
+
+    def update(self):
+        """
+        Fetch the keys. If a fetch is already in progress wait for it
+        to finish and use its result.
+
+        :return: True if the set of keys may have changed
+        """
+        if not self.remote:
+            return KeyBundle.update(self)
+
+        with self._cond:
+            if self._updating:
+                while self._updating:
+                    self._cond.wait()
+                return self._result
+            self._updating = True
+            self._pending = False
+
+        res = False
+        try:
+            res = self._fetch()
+        finally:
+            with self._cond:
+                self._result = res
+                self._updating = False
+                self._cond.notify_all()
+        return res
+
+    def update_later(self):
+        """
+        Have the keys fetched in the background.
+        """
+        with self._cond:
+            if self._updating or self._pending:
+                return
+            self._pending = True
+
+        if self.refresher is not None:
+            self.refresher.refresh_soon(self)
+        else:
+            _thread = threading.Thread(target=self.update,
+                                       name='KeyBundle update')
+            _thread.daemon = True
+            _thread.start()
+
+    def _uptodate(self):
+        if not self.remote:
+            return KeyBundle._uptodate(self)
+
+        now = time.time()
+        if now < self.time_out or now < self.next_try:
+            return False
+
+        if not self._keys or now > self.time_out + self.max_stale:
+            # Nothing usable to hand out in the meantime
+            return self.update()
+
+        self.update_later()
+        return False
+
+    def get_key_with_kid(self, kid):
+        """
+        Return the key that has a specific key ID. If no such key is known
+        the keys are fetched right away, though not more often than once
+        every kid_refetch_interval seconds.
+
+        :param kid: The Key ID
+        :return: The key or None
+        """
+        for key in self._keys:
+            if key.kid == kid:
+                return key
+
+        if not self.remote:
+            return None
+
+        now = time.time()
+        if now < self.last_kid_refetch + self.kid_refetch_interval:
+            return None
+        self.last_kid_refetch = now
+
+        self.update()
+        for key in self._keys:
+            if key.kid == kid:
+                return key
+        return None
+
+
+class KeyRefresher(object):
+    """
+    Refreshes remote key bundles a while before they expire, using one
+    worker thread.
+    """
+
+    def __init__(self, margin=30):
+        """
+        :param margin: How many seconds before the keys expire they
+            should be fetched.
+        """
+        self.margin = margin
+        self.bundles = []
+        self._soon = []
+        self._cond = threading.Condition()
+        self._stop = False
+        self._thread = None
+
+    def add(self, kb):
+        """
+        :param kb: A :py:class:`RefreshingKeyBundle` instance
+        """
+        with self._cond:
+            if not any(b is kb for b in self.bundles):
+                self.bundles.append(kb)
+            kb.refresher = self
+            self._cond.notify()
+
+    def remove(self, kb):
+        with self._cond:
+            self.bundles = [b for b in self.bundles if b is not kb]
+            self._soon = [b for b in self._soon if b is not kb]
+            kb.refresher = None
+
+    def refresh_soon(self, kb):
+        """
+        Have a bundle refreshed without waiting for its turn.
+        """
+        with self._cond:
+            if not any(b is kb for b in self._soon):
+                self._soon.append(kb)
+            self._cond.notify()
+
+    def _due_at(self, kb):
+        # Never refresh more often than every cache_time/2 seconds
+        _margin = min(self.margin, kb.cache_time / 2)
+        return max(kb.time_out - _margin, kb.next_try)
+
+    def due(self, now=0):
+        """
+        :param now: The present time, seconds since epoch
+        :return: The bundles that should be refreshed now
+        """
+        if not now:
+            now = time.time()
+
+        with self._cond:
+            _due = list(self._soon)
+            self._soon = []
+            for kb in self.bundles:
+                if kb.remote and self._due_at(kb) <= now:
+                    if not any(b is kb for b in _due):
+                        _due.append(kb)
+        return _due
+
+    def refresh(self, now=0):
+        """
+        Refresh all bundles that are due.
+
+        :param now: The present time, seconds since epoch
+        :return: The number of bundles refreshed
+        """
+        _due = self.due(now)
+        for kb in _due:
+            kb.update()
+        return len(_due)
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._stop and not self._soon:
+                    _remote = [kb for kb in self.bundles if kb.remote]
+                    if _remote:
+                        _due = min([self._due_at(kb) for kb in _remote])
+                        _wait = _due - time.time()
+                        if _wait <= 0:
+                            break
+                        self._cond.wait(_wait)
+                    else:
+                        self._cond.wait()
+
+                if self._stop:
+                    return
+
+            self.refresh()
+
+    def start(self):
+        self._stop = False
+        self._thread = threading.Thread(target=self.run, name='KeyRefresher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
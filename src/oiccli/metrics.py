@@ -0,0 +1,282 @@
+import logging
+import threading
+import weakref
+from bisect import bisect_left
+from collections import deque
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+"""
+Counters and latency histograms for the requests sent by services and
+HTTP libraries. Every thread records into its own set of counters so no
+lock is taken when a request is recorded, the sets are only summed when
+the numbers are read. When a thread is gone its counters are added to a
+shared total, so threads that come and go, in thread pools or servers
+with one thread per request, don't make the number of sets grow.
+
+The numbers can be read as dictionaries, exported in the Prometheus text
+format or passed on, as they are recorded, to a callback for instance
+one that sends them to statsd.
+"""
+
+# Upper bounds, in seconds, of the latency histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                    30)
+
+# The names of the metrics recorded by this package
+HTTP_REQUESTS = 'http_requests_total'
+HTTP_ERRORS = 'http_errors_total'
+HTTP_DURATION = 'http_request_duration_seconds'
+# Requests not sent because of an open circuit breaker or a busy host
+HTTP_REJECTED = 'http_requests_rejected_total'
+SERVICE_REQUESTS = 'service_requests_total'
+SERVICE_DURATION = 'service_request_duration_seconds'
+
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+
+
+def label_key(labels):
+    """
+    :param labels: Dictionary with label names and values
+    :return: A hashable and ordered version of labels
+    """
+    if not labels:
+        return ()
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n',
+                                                                   '\\n')
+
+
+def _format_labels(labels, extra=()):
+    _labels = list(labels) + list(extra)
+    if not _labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, _escape(v)) for k, v in _labels) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Metrics(object):
+    def __init__(self, buckets=DURATION_BUCKETS, callback=None):
+        """
+        :param buckets: Upper bounds of the histogram buckets
+        :param callback: A function that is called with the kind of metric
+            (counter or histogram), the name, the labels and the value each
+            time something is recorded.
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.callback = callback
+        self._local = threading.local()
+        self._shards = []
+        # The counters of the threads that are gone
+        self._total = ({}, {})
+        self._retired = deque()
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            _shard = ({}, {})
+            with self._lock:
+                self._fold()
+                self._shards.append(_shard)
+            self._local.shard = _shard
+            # Called when the thread object is garbage collected, which may
+            # happen in any thread, so only queues the shard
+            weakref.finalize(threading.current_thread(),
+                             self._retired.append, _shard)
+            return _shard
+
+    def _fold(self):
+        """
+        Add the counters of the threads that are gone to the total. Must
+        be called with the lock held.
+        """
+        while self._retired:
+            _counters, _histograms = self._retired.popleft()
+            self._shards = [s for s in self._shards if s[0] is not _counters]
+
+            _total = self._total[0]
+            for key, value in _counters.items():
+                _total[key] = _total.get(key, 0) + value
+
+            _total = self._total[1]
+            for key, hist in _histograms.items():
+                try:
+                    _sum = _total[key]
+                except KeyError:
+                    _total[key] = list(hist)
+                else:
+                    for i, val in enumerate(hist):
+                        _sum[i] += val
+
+    def _callback(self, kind, name, labels, value):
+        try:
+            self.callback(kind, name, labels, value)
+        except Exception as err:
+            logger.warning('Metrics callback failed: {}'.format(err))
+
+    def inc(self, name, labels=None, value=1):
+        """
+        Add to a counter.
+
+        :param name: The name of the counter
+        :param labels: Dictionary with label names and values
+        :param value: What to add
+        """
+        _counters = self._shard()[0]
+        _key = (name, label_key(labels))
+        try:
+            _counters[_key] += value
+        except KeyError:
+            _counters[_key] = value
+
+        if self.callback is not None:
+            self._callback(COUNTER, name, labels or {}, value)
+
+    def observe(self, name, value, labels=None):
+        """
+        Add a value, typically a duration in seconds, to a histogram.
+
+        :param name: The name of the histogram
+        :param value: The value
+        :param labels: Dictionary with label names and values
+        """
+        _histograms = self._shard()[1]
+        _key = (name, label_key(labels))
+        try:
+            _hist = _histograms[_key]
+        except KeyError:
+            # One count per bucket, one for larger values and the sum
+            _hist = [0] * (len(self.buckets) + 2)
+            _histograms[_key] = _hist
+
+        _hist[bisect_left(self.buckets, value)] += 1
+        _hist[-1] += value
+
+        if self.callback is not None:
+            self._callback(HISTOGRAM, name, labels or {}, value)
+
+    @staticmethod
+    def _copy(shard):
+        # dict.copy is atomic, a thread may go on recording while it's done
+        _counters, _histograms = shard
+        return (_counters.copy(),
+                dict((k, list(v)) for k, v in _histograms.copy().items()))
+
+    def _snapshot(self):
+        with self._lock:
+            self._fold()
+            _shards = list(self._shards)
+            _total = self._copy(self._total)
+        return [_total] + [self._copy(s) for s in _shards]
+
+    def counters(self):
+        """
+        :return: Dictionary with (name, labels) tuples as keys and the sums
+            over all threads as values.
+        """
+        res = {}
+        for _counters, _ in self._snapshot():
+            for key, value in _counters.items():
+                res[key] = res.get(key, 0) + value
+        return res
+
+    def histograms(self):
+        """
+        :return: Dictionary with (name, labels) tuples as keys and
+            dictionaries with the cumulative bucket counts, the count and
+            the sum as values.
+        """
+        _sums = {}
+        for _, _histograms in self._snapshot():
+            for key, hist in _histograms.items():
+                try:
+                    _sum = _sums[key]
+                except KeyError:
+                    _sums[key] = hist
+                else:
+                    for i, val in enumerate(hist):
+                        _sum[i] += val
+
+        res = {}
+        for key, hist in _sums.items():
+            _cumulative = []
+            _count = 0
+            for val in hist[:-1]:
+                _count += val
+                _cumulative.append(_count)
+            res[key] = {'buckets': list(zip(self.buckets + (float('inf'),),
+                                            _cumulative)),
+                        'count': _count, 'sum': hist[-1]}
+        return res
+
+    def get(self, name, **labels):
+        """
+        :param name: The name of a counter
+        :param labels: The labels of the counter
+        :return: The value of the counter
+        """
+        return self.counters().get((name, label_key(labels)), 0)
+
+    def prometheus(self, prefix='oiccli_'):
+        """
+        Export all the metrics in the Prometheus text exposition format.
+
+        :param prefix: Added to the names of the metrics
+        :return: A string
+        """
+        lines = []
+        _counters = self.counters()
+        for name in sorted(set(n for n, _ in _counters.keys())):
+            lines.append('# TYPE {}{} counter'.format(prefix, name))
+            for (_name, labels), value in sorted(_counters.items()):
+                if _name == name:
+                    lines.append('{}{}{} {}'.format(
+                        prefix, name, _format_labels(labels),
+                        _format_value(value)))
+
+        _histograms = self.histograms()
+        for name in sorted(set(n for n, _ in _histograms.keys())):
+            lines.append('# TYPE {}{} histogram'.format(prefix, name))
+            for (_name, labels), hist in sorted(_histograms.items()):
+                if _name != name:
+                    continue
+                for bound, count in hist['buckets']:
+                    _le = '+Inf' if bound == float('inf') else str(bound)
+                    lines.append('{}{}_bucket{} {}'.format(
+                        prefix, name, _format_labels(labels, [('le', _le)]),
+                        count))
+                lines.append('{}{}_sum{} {}'.format(
+                    prefix, name, _format_labels(labels),
+                    _format_value(hist['sum'])))
+                lines.append('{}{}_count{} {}'.format(
+                    prefix, name, _format_labels(labels), hist['count']))
+
+        if lines:
+            lines.append('')
+        return '\n'.join(lines)
+
+    def reset(self):
+        with self._lock:
+            self._fold()
+            for _counters, _histograms in [self._total] + self._shards:
+                _counters.clear()
+                _histograms.clear()
+
+
+# The metrics used by all services and HTTP libraries that are not
+# configured to use some other.
+METRICS = Metrics()
@@ -1,11 +1,16 @@
 import logging
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 
+from oiccli import LazyFormat
 from oiccli.client_auth import CLIENT_AUTHN_METHOD
 from oiccli.client_info import ClientInfo
 from oiccli.exception import OicCliError
 from oiccli.http import HTTPLib
 from oiccli.oauth2 import service
 from oiccli.service import Service, build_services
+from oiccli.service import run_in_executor
 
 from oicmsg.key_jar import KeyJar
 
@@ -27,13 +32,40 @@ class ExpiredToken(OicCliError):
     pass
 
 
+class BatchResult(object):
+    """
+    The outcome of one item in a :py:meth:`Client.do_batch` call.
+    Either response or error is set.
+    """
+
+    def __init__(self, index, request_type, state='', response=None,
+                 error=None):
+        """
+        :param index: The position of the item in the batch
+        :param request_type: The service used
+        :param state: The state the request belonged to
+        :param response: The parsed response
+        :param error: The exception raised while doing the request
+        """
+        self.index = index
+        self.request_type = request_type
+        self.state = state
+        self.response = response
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
 # =============================================================================
 
 
 class Client(object):
     def __init__(self, ca_certs=None, client_authn_method=None,
                  keyjar=None, verify_ssl=True, config=None, client_cert=None,
-                 httplib=None, services=None, service_factory=None):
+                 httplib=None, services=None, service_factory=None,
+                 events=None):
         """
 
         :param ca_certs: Certificates used to verify HTTPS certificates
@@ -41,6 +73,9 @@ class Client(object):
             authenticate itself. It's a dictionary with method names as
             keys and method classes as values.
         :param verify_ssl: Whether the SSL certificate should be verified.
+        :param events: An event store, like
+            :py:class:`oiccli.events.EventStore`, used by the HTTP library,
+            the client info and the services.
         :return: Client instance
         """
 
@@ -52,8 +87,8 @@ class Client(object):
         if not keyjar:
             keyjar = KeyJar()
 
-        self.events = None
-        self.client_info = ClientInfo(keyjar, config=config)
+        self.events = events
+        self.client_info = ClientInfo(keyjar, config=config, events=events)
         if self.client_info.client_id:
             self.client_id = self.client_info.client_id
         _cam = client_authn_method or CLIENT_AUTHN_METHOD
@@ -65,6 +100,11 @@ class Client(object):
 
         self.client_info.service = self.service
 
+        if events is not None:
+            self.http.events = events
+            for _srv in self.service.values():
+                _srv.events = events
+
         self.verify_ssl = verify_ssl
 
     def construct(self, request_type, request_args=None, extra_args=None,
@@ -77,10 +117,15 @@ class Client(object):
         met = getattr(self, 'construct_{}_request'.format(request_type))
         return met(self.client_info, request_args, extra_args, **kwargs)
 
-    def do_request(self, request_type, scope="", response_body_type="",
-                   method="", request_args=None, extra_args=None,
-                   http_args=None, authn_method="", **kwargs):
+    def _request_init(self, request_type, scope="", response_body_type="",
+                      method="", request_args=None, extra_args=None,
+                      http_args=None, authn_method="", **kwargs):
+        """
+        Construct a request and gather the arguments needed to send it.
 
+        :return: A tuple of the service instance and a dictionary with the
+            arguments to the service's service_request method.
+        """
         _srv = self.service[request_type]
         if not method:
             method = _srv.http_method
@@ -93,17 +138,129 @@ class Client(object):
         if not response_body_type:
             response_body_type = _srv.response_body_type
 
-        logger.debug('do_request info: {}'.format(_info))
+        logger.debug(LazyFormat('do_request info: {}', _info))
 
         try:
             _body = _info['body']
         except KeyError:
             _body = None
 
-        return _srv.service_request(
-            _info['uri'], method, _body, response_body_type,
-            http_args=_info['http_args'], client_info=self.client_info,
-            **kwargs)
+        _args = {'url': _info['uri'], 'method': method, 'body': _body,
+                 'response_body_type': response_body_type,
+                 'http_args': _info['http_args'],
+                 'client_info': self.client_info}
+        _args.update(kwargs)
+        return _srv, _args
+
+    def do_request(self, request_type, scope="", response_body_type="",
+                   method="", request_args=None, extra_args=None,
+                   http_args=None, authn_method="", deadline=0, **kwargs):
+        """
+        Construct and send a request and parse the response.
+
+        :param deadline: When to give up waiting for the response, seconds
+            since epoch. A :py:class:`oiccli.exception.DeadlineExceeded`
+            exception is raised if it passes before the request is sent.
+        """
+
+        _srv, _args = self._request_init(
+            request_type, scope=scope, response_body_type=response_body_type,
+            method=method, request_args=request_args, extra_args=extra_args,
+            http_args=http_args, authn_method=authn_method, **kwargs)
+
+        return _srv.service_request(deadline=deadline, **_args)
+
+    async def async_do_request(self, request_type, scope="",
+                               response_body_type="", method="",
+                               request_args=None, extra_args=None,
+                               http_args=None, authn_method="", deadline=0,
+                               **kwargs):
+        """
+        The awaitable version of :py:meth:`do_request`. Requires that the
+        client was given an asynchronous HTTP library, like
+        :py:class:`oiccli.async_http.AsyncHTTPLib`. Constructing and
+        signing the request is done in the default executor of the event
+        loop.
+        """
+
+        _srv, _args = await run_in_executor(
+            None, self._request_init, request_type, scope=scope,
+            response_body_type=response_body_type, method=method,
+            request_args=request_args, extra_args=extra_args,
+            http_args=http_args, authn_method=authn_method, **kwargs)
+
+        return await _srv.async_service_request(deadline=deadline, **_args)
+
+    def _batch_request(self, index, item, deadline=0):
+        request_type, state, kwargs = item
+        _kwargs = dict(kwargs or {})
+        if state:
+            _kwargs['state'] = state
+        if deadline and 'deadline' not in _kwargs:
+            _kwargs['deadline'] = deadline
+
+        try:
+            resp = self.do_request(request_type, **_kwargs)
+        except Exception as err:
+            logger.warning(LazyFormat('Batch item {} ({}) failed: {}', index,
+                                      request_type, err))
+            return BatchResult(index, request_type, state, error=err)
+        return BatchResult(index, request_type, state, response=resp)
+
+    def do_batch(self, items, max_workers=8, ordered=True, deadline=0):
+        """
+        Do many requests, for instance refreshing the access tokens for many
+        states, concurrently. All requests are sent using this client's HTTP
+        connection pool and keys.
+
+        Items are taken from the iterable as workers become free, so it may
+        be a generator producing any number of items. A failing item
+        doesn't stop the batch, the exception is returned in its result.
+
+        :param items: An iterable of (request_type, state, kwargs) tuples.
+            kwargs are extra arguments to :py:meth:`do_request` and may be
+            None.
+        :param max_workers: The maximum number of requests in flight
+        :param ordered: If True the results are returned in the order of
+            the items, otherwise as each request is finished.
+        :param deadline: When to give up on requests that haven't got a
+            response, seconds since epoch
+        :return: A generator of :py:class:`BatchResult` instances
+        """
+        _items = enumerate(items)
+        # How many items may be in flight or waiting to be returned
+        _window = max_workers * 2
+        _pending = {}
+        _done = {}
+        _next = 0
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            def _fill():
+                while len(_pending) + len(_done) < _window:
+                    try:
+                        index, item = next(_items)
+                    except StopIteration:
+                        return
+                    _fut = executor.submit(self._batch_request, index, item,
+                                           deadline)
+                    _pending[_fut] = index
+
+            _fill()
+            while _pending:
+                _finished, _ = wait(list(_pending.keys()),
+                                    return_when=FIRST_COMPLETED)
+                for _fut in _finished:
+                    del _pending[_fut]
+                    res = _fut.result()
+                    if ordered:
+                        _done[res.index] = res
+                    else:
+                        yield res
+
+                while _next in _done:
+                    yield _done.pop(_next)
+                    _next += 1
+                _fill()
 
     def set_client_id(self, client_id):
         self.client_id = client_id
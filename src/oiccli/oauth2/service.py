@@ -1,13 +1,20 @@
-import inspect
 import logging
-import sys
+import time
 
+from oiccli import LazyFormat
 from oiccli import OIDCONF_PATTERN
+from oiccli.cache import PROVIDER_INFO_CACHE
 from oiccli.exception import OicCliError
+from oiccli.key_refresh import RefreshingKeyBundle
+from oiccli.service import REQUEST_INFO
 from oiccli.service import Service
+from oiccli.service import ServiceRegistry
+from oiccli.service import run_in_executor
+from oiccli.tracing import traced
 
 from oicmsg import oauth2
 from oicmsg.exception import MissingParameter
+from oicmsg.key_bundle import KeyBundle
 from oicmsg.key_jar import KeyJar
 from oicmsg.oauth2 import AccessTokenResponse
 from oicmsg.oauth2 import AuthorizationResponse
@@ -16,6 +23,9 @@ __author__ = 'Roland Hedberg'
 
 logger = logging.getLogger(__name__)
 
+REGISTRY = ServiceRegistry(entry_point_group='oiccli.oauth2.services')
+REGISTRY.register(Service)
+
 
 def _post_x_parse_response(resp, cli_info, state=''):
     if isinstance(resp, (AuthorizationResponse, AccessTokenResponse)):
@@ -34,6 +44,7 @@ def get_state(request_args, kwargs):
     return _state
 
 
+@REGISTRY.register
 class Authorization(Service):
     msg_type = oauth2.AuthorizationRequest
     response_cls = oauth2.AuthorizationResponse
@@ -50,6 +61,7 @@ class Authorization(Service):
         self.pre_construct.append(self.oauth_pre_construct)
         self.post_parse_response.append(_post_x_parse_response)
 
+    @traced('gather_request_args')
     def gather_request_args(self, cli_info, **kwargs):
         ar_args = Service.gather_request_args(self, cli_info, **kwargs)
 
@@ -61,6 +73,7 @@ class Authorization(Service):
 
         return ar_args
 
+    @traced('do_request_init')
     def do_request_init(self, cli_info, body_type="", method="GET",
                         authn_method='', request_args=None, http_args=None,
                         **kwargs):
@@ -98,6 +111,7 @@ class Authorization(Service):
         return request_args, {}
 
 
+@REGISTRY.register
 class AccessToken(Service):
     msg_type = oauth2.AccessTokenRequest
     response_cls = oauth2.AccessTokenResponse
@@ -107,6 +121,7 @@ class AccessToken(Service):
     request = 'accesstoken'
     default_authn_method = 'client_secret_basic'
     http_method = 'POST'
+    timeout = (5, 60)
 
     def __init__(self, httplib=None, keyjar=None, client_authn_method=None,
                  conf=None):
@@ -131,6 +146,7 @@ class AccessToken(Service):
         return request_args, {}
 
 
+@REGISTRY.register
 class RefreshAccessToken(Service):
     msg_type = oauth2.RefreshAccessTokenRequest
     response_cls = oauth2.AccessTokenResponse
@@ -140,6 +156,7 @@ class RefreshAccessToken(Service):
     request = 'refresh_token'
     default_authn_method = 'bearer_header'
     http_method = 'POST'
+    timeout = (5, 60)
 
     def __init__(self, httplib=None, keyjar=None, client_authn_method=None,
                  conf=None):
@@ -160,6 +177,7 @@ class RefreshAccessToken(Service):
         return request_args, {}
 
 
+@REGISTRY.register
 class ProviderInfoDiscovery(Service):
     msg_type = oauth2.Message
     response_cls = oauth2.ASConfigurationResponse
@@ -167,6 +185,7 @@ class ProviderInfoDiscovery(Service):
     synchronous = True
     request = 'provider_info'
     http_method = 'GET'
+    timeout = (3.05, 10)
 
     def __init__(self, httplib=None, keyjar=None, client_authn_method=None,
                  conf=None):
@@ -174,7 +193,12 @@ class ProviderInfoDiscovery(Service):
                          client_authn_method=client_authn_method,
                          conf=conf)
         self.post_parse_response.append(self.oauth_post_parse_response)
+        try:
+            self.cache = self.conf['cache']
+        except KeyError:
+            self.cache = PROVIDER_INFO_CACHE
 
+    @traced('request_info')
     def request_info(self, cli_info, method="GET", request_args=None,
                      lax=False, **kwargs):
 
@@ -187,6 +211,154 @@ class ProviderInfoDiscovery(Service):
 
         return {'uri': OIDCONF_PATTERN % _issuer}
 
+    def _cached_response(self, entry, client_info, state='', **kwargs):
+        resp = entry.message(self.response_cls)
+        self.do_post_parse_response(resp, client_info, state=state)
+        return resp
+
+    def _fresh_response(self, url, entry, started, client_info, **kwargs):
+        logger.debug(LazyFormat('Using cached provider info from {}', url))
+        if self.metrics is not None:
+            self._record(started, outcome='cached')
+        return self._cached_response(entry, client_info, **kwargs)
+
+    def _conditional_args(self, entry, http_args, deadline):
+        """
+        Make the request a conditional one, if there is a cached response
+        with an ETag.
+        """
+        http_args = self.http_request_args(http_args, deadline)
+        if entry is not None and entry.etag:
+            _headers = dict(http_args.get('headers', {}))
+            _headers['If-None-Match'] = entry.etag
+            http_args = dict(http_args, headers=_headers)
+        return http_args
+
+    def _handle_response(self, url, resp, entry, started, client_info,
+                         response_body_type='', **kwargs):
+        """
+        Use the cached response if the OP said it's still valid, otherwise
+        parse the response and add it to the cache.
+        """
+        if resp.status_code == 304 and entry is not None:
+            self.cache.revalidated(url, resp.headers)
+            if self.metrics is not None:
+                self._record(started, outcome='revalidated')
+            return self._cached_response(entry, client_info, **kwargs)
+
+        if "keyjar" not in kwargs:
+            kwargs["keyjar"] = self.keyjar
+        if not response_body_type:
+            response_body_type = self.response_body_type
+
+        try:
+            _resp = self.parse_request_response(resp, client_info,
+                                                response_body_type, **kwargs)
+        except Exception as err:
+            if self.metrics is not None:
+                self._record(started, error=err)
+            raise
+
+        if self.metrics is not None:
+            self._record(started, _resp)
+        if isinstance(_resp, self.response_cls):
+            self.cache.set(url, _resp, resp.headers)
+        return _resp
+
+    @traced('service_request')
+    def service_request(self, url, method="GET", body=None,
+                        response_body_type="", http_args=None, client_info=None,
+                        deadline=0, **kwargs):
+        """
+        Like :py:meth:`oiccli.service.Service.service_request` but uses
+        the provider info cache. If there is a fresh response in the cache
+        no request is sent. If the cached response has expired but has an
+        ETag a conditional request is sent.
+
+        :param url: The URL to which the request should be sent
+        :param method: Which HTTP method to use
+        :param body: A message body if any
+        :param response_body_type: The expected format of the body of the
+            return message
+        :param http_args: Arguments for the HTTP client
+        :param client_info: A py:class:`oiccli.client_info.ClientInfo` instance
+        :param deadline: When to stop waiting for the response, seconds
+            since epoch
+        :return: A response_cls or ErrorResponse instance
+        """
+        if self.cache is None:
+            return Service.service_request(
+                self, url, method, body, response_body_type, http_args,
+                client_info, deadline, **kwargs)
+
+        _started = time.monotonic()
+        entry = self.cache.get(url)
+        if entry is not None and entry.fresh():
+            return self._fresh_response(url, entry, _started, client_info,
+                                        **kwargs)
+
+        http_args = self._conditional_args(entry, http_args, deadline)
+        logger.debug(LazyFormat(REQUEST_INFO, url, method, body, http_args))
+
+        try:
+            with self._span('http', method=method,
+                            url=url.split('?')[0]):
+                resp = self.httplib(url, method, data=body, **http_args)
+        except Exception as err:
+            logger.error('Exception on request: {}'.format(err))
+            if self.metrics is not None:
+                self._record(_started, error=err)
+            raise
+
+        return self._handle_response(url, resp, entry, _started, client_info,
+                                     response_body_type, **kwargs)
+
+    async def async_service_request(self, url, method="GET", body=None,
+                                    response_body_type="", http_args=None,
+                                    client_info=None, deadline=0, **kwargs):
+        """
+        The awaitable version of :py:meth:`service_request`, also using
+        the provider info cache.
+        """
+        if self.cache is None:
+            return await Service.async_service_request(
+                self, url, method, body, response_body_type, http_args,
+                client_info, deadline, **kwargs)
+
+        return await self._async_cached_request(
+            url, method, body, response_body_type, http_args, client_info,
+            deadline, **kwargs)
+
+    @traced('service_request')
+    async def _async_cached_request(self, url, method="GET", body=None,
+                                    response_body_type="", http_args=None,
+                                    client_info=None, deadline=0, **kwargs):
+        _started = time.monotonic()
+        entry = self.cache.get(url)
+        if entry is not None and entry.fresh():
+            # The post_parse_response methods may fetch keys
+            return await run_in_executor(
+                self.parse_executor, self._fresh_response, url, entry,
+                _started, client_info, **kwargs)
+
+        http_args = self._conditional_args(entry, http_args, deadline)
+        logger.debug(LazyFormat(REQUEST_INFO, url, method, body, http_args))
+
+        try:
+            with self._span('http', method=method,
+                            url=url.split('?')[0]):
+                resp = await self.httplib(url, method, data=body,
+                                          **http_args)
+        except Exception as err:
+            logger.error('Exception on request: {}'.format(err))
+            if self.metrics is not None:
+                self._record(_started, error=err)
+            raise
+
+        return await run_in_executor(
+            self.parse_executor, self._handle_response, url, resp, entry,
+            _started, client_info, response_body_type, **kwargs)
+
     def oauth_post_parse_response(self, resp, cli_info, **kwargs):
         """
         Deal with Provider Config Response
@@ -233,15 +405,52 @@ class ProviderInfoDiscovery(Service):
         except KeyError:
             kj = KeyJar()
 
-        kj.load_keys(resp, _pcr_issuer)
+        if 'jwks_uri' in resp:
+            self._add_jwks_uri(kj, _pcr_issuer, resp['jwks_uri'], cli_info)
+        elif 'jwks' in resp:
+            self._add_jwks(kj, _pcr_issuer, resp['jwks'])
         cli_info.keyjar = kj
 
+    @staticmethod
+    def _add_jwks(keyjar, issuer, jwks):
+        """
+        Add the keys that are in the provider info, unless there already
+        is a bundle with the same keys, as there is if the provider info
+        is discovered again.
+
+        :param keyjar: A :py:class:`oicmsg.key_jar.KeyJar` instance
+        :param issuer: The provider's issuer ID
+        :param jwks: The provider's JWKS as a dictionary
+        """
+        _kb = KeyBundle(keys=jwks['keys'], verify_ssl=keyjar.verify_ssl)
+        _keys = _kb.keys()
+        for kb in keyjar.issuer_keys.get(issuer, []):
+            if not kb.remote and kb.keys() == _keys:
+                return
+
+        keyjar.add_kb(issuer, _kb)
+
+    @staticmethod
+    def _add_jwks_uri(keyjar, issuer, url, cli_info):
+        """
+        The provider's keys are kept in a
+        :py:class:`oiccli.key_refresh.RefreshingKeyBundle` which, if the
+        client has a key refresher, is refreshed before the keys expire.
+        If the same URL is discovered again the bundle is reused.
+
+        :param keyjar: A :py:class:`oicmsg.key_jar.KeyJar` instance
+        :param issuer: The provider's issuer ID
+        :param url: The provider's jwks_uri
+        :param cli_info: Information about the client/server session
+        """
+        for kb in keyjar.issuer_keys.get(issuer, []):
+            if isinstance(kb, RefreshingKeyBundle) and kb.source == url:
+                return
+
+        keyjar.add_kb(issuer, RefreshingKeyBundle(
+            source=url, verify_ssl=keyjar.verify_ssl,
+            refresher=cli_info.key_refresher))
+
 
 def factory(req_name, **kwargs):
-    for name, obj in inspect.getmembers(sys.modules[__name__]):
-        if inspect.isclass(obj) and issubclass(obj, Service):
-            try:
-                if obj.__name__ == req_name:
-                    return obj(**kwargs)
-            except AttributeError:
-                pass
+    return REGISTRY.factory(req_name, **kwargs)
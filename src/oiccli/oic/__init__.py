@@ -69,7 +69,7 @@ PROVIDER_DEFAULT = {
 class Client(oauth2.Client):
     def __init__(self, ca_certs=None, client_authn_method=None, keyjar=None,
                  verify_ssl=True, config=None, client_cert=None, httplib=None, 
-                 services=None, service_factory=None):
+                 services=None, service_factory=None, events=None):
 
         _srvs = services or DEFAULT_SERVICES
         service_factory = service_factory or service.factory
@@ -78,7 +78,8 @@ class Client(oauth2.Client):
                                keyjar=keyjar, verify_ssl=verify_ssl,
                                config=config, client_cert=client_cert,
                                httplib=httplib, services=_srvs,
-                               service_factory=service_factory)
+                               service_factory=service_factory,
+                               events=events)
 
         # self.wf = WebFinger(OIC_ISSUER)
         # self.wf.httpd = self.http
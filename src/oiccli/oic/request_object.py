@@ -0,0 +1,156 @@
+import logging
+import time
+from urllib.parse import urlsplit
+
+from oiccli import rndstr
+from oiccli.exception import ConfigurationError
+from oiccli.state_store import MemoryStore
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+"""
+Keeps request objects that are passed by reference, using the request_uri
+parameter, so that the OP can fetch them. Instead of writing every request
+object to a file they are kept in a
+:py:class:`oiccli.state_store.StateStore`, in memory or in a store shared
+by several RP instances, and served by :py:class:`RequestURIApp`.
+"""
+
+
+def _now():
+    return int(time.time())
+
+
+class RequestObjectStore(object):
+    def __init__(self, base_url, db=None, lifetime=600, one_time=False):
+        """
+        :param base_url: The absolute https URL under which the request
+            objects are published, that is where :py:class:`RequestURIApp`
+            is mounted.
+        :param db: A :py:class:`oiccli.state_store.StateStore` instance.
+            If not given the request objects are kept in memory.
+        :param lifetime: For how many seconds a request object can be
+            fetched
+        :param one_time: If True a request object is removed when it has
+            been fetched.
+        """
+        _part = urlsplit(base_url)
+        if _part.scheme != 'https' or not _part.netloc:
+            raise ConfigurationError(
+                'base_url must be an absolute https URL: "{}"'.format(
+                    base_url))
+        if not base_url.endswith('/'):
+            base_url += '/'
+        self.base_url = base_url
+        if db is None:
+            db = MemoryStore()
+        self.db = db
+        self.lifetime = lifetime
+        self.one_time = one_time
+
+    def __contains__(self, name):
+        return name in self.db
+
+    def name_from_uri(self, uri):
+        """
+        :param uri: A request_uri
+        :return: The name the request object is stored under
+        """
+        uri = uri.split('#')[0]
+        if not uri.startswith(self.base_url):
+            raise ValueError("request_uri doesn't match base_url")
+        return uri[len(self.base_url):]
+
+    def add(self, request_object, uri='', now=0):
+        """
+        Store a request object.
+
+        :param request_object: The signed and/or encrypted request object
+        :param uri: A request_uri that has been registered with the OP.
+            If given, the request_uri returned is this one followed by
+            a unique path segment, otherwise it's one under base_url.
+        :param now: The present time, seconds since epoch
+        :return: A request_uri unique to this request object
+        """
+        if uri:
+            _prefix = self.name_from_uri(uri).rstrip('/')
+            _name = '{}/{}.jwt'.format(_prefix, rndstr(32)).lstrip('/')
+        else:
+            _name = rndstr(32) + '.jwt'
+        uri = '{}{}'.format(self.base_url, _name)
+
+        _exp = (now or _now()) + self.lifetime if self.lifetime else 0
+        self.db.set(_name, request_object, _exp)
+        return uri
+
+    def get(self, name):
+        """
+        :param name: The name the request object is stored under
+        :return: The request object or None if there is none or it has
+            expired.
+        """
+        try:
+            _ro = self.db[name]
+        except KeyError:
+            return None
+
+        if self.one_time:
+            self.remove(name)
+        return _ro
+
+    def remove(self, name):
+        try:
+            del self.db[name]
+        except KeyError:
+            pass
+
+    def expire(self, now=0, limit=100):
+        return self.db.expire(now, limit)
+
+
+class RequestURIApp(object):
+    """
+    A WSGI application that serves the request objects in a
+    :py:class:`RequestObjectStore`. The path, relative to where the
+    application is mounted, is the name of the request object.
+    """
+
+    def __init__(self, store, prefix=''):
+        """
+        :param store: A :py:class:`RequestObjectStore` instance
+        :param prefix: Path prefix to remove before looking up a request
+            object, if the application is not mounted at the base_url of
+            the store.
+        """
+        self.store = store
+        self.prefix = prefix.strip('/')
+
+    def name(self, path):
+        _name = path.lstrip('/')
+        if self.prefix:
+            if not _name.startswith(self.prefix + '/'):
+                return ''
+            _name = _name[len(self.prefix) + 1:]
+        return _name
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD', 'GET') != 'GET':
+            start_response('405 Method Not Allowed',
+                           [('Allow', 'GET'),
+                            ('Content-Type', 'text/plain')])
+            return [b'Method Not Allowed']
+
+        _name = self.name(environ.get('PATH_INFO', ''))
+        _ro = self.store.get(_name) if _name else None
+        if _ro is None:
+            logger.debug('No request object named "{}"'.format(_name))
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not Found']
+
+        _body = _ro.encode('utf-8')
+        start_response('200 OK', [('Content-Type', 'application/jwt'),
+                                  ('Content-Length', str(len(_body))),
+                                  ('Cache-Control', 'no-store')])
+        return [_body]
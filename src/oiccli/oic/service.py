@@ -1,6 +1,6 @@
-import inspect
 import logging
-import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 import six
 from cryptojwt import jws
 
@@ -11,7 +11,11 @@ except ImportError:  # Only works for >= 3.5
 else:
     _decode_err = JSONDecodeError
 
+from oiccli import LazyFormat
 from oiccli import rndstr, webfinger
+from oiccli.cache import VERIFIED_JWT_CACHE
+from oiccli.cache import key_fingerprint
+from oiccli.cache import unverified_payload
 from oiccli.exception import ConfigurationError
 from oiccli.exception import ParameterError
 from oiccli.oauth2 import service
@@ -19,6 +23,8 @@ from oiccli.oauth2.service import get_state
 from oiccli.oic.utils import construct_request_uri
 from oiccli.oic.utils import request_object_encryption
 from oiccli.service import Service
+from oiccli.service import ServiceRegistry
+from oiccli.tracing import traced
 from oiccli.webfinger import JRD
 from oiccli.webfinger import OIC_ISSUER
 
@@ -33,6 +39,14 @@ __author__ = 'Roland Hedberg'
 
 logger = logging.getLogger(__name__)
 
+# Services not defined here are found among the OAuth2 services
+REGISTRY = ServiceRegistry(parent=service.REGISTRY,
+                           entry_point_group='oiccli.oic.services')
+
+# Where, in a userinfo response, the claim sources that couldn't be
+# fetched are listed
+CLAIM_SOURCE_ERRORS = '_claim_source_errors'
+
 PREFERENCE2PROVIDER = {
     # "require_signed_request_object": "request_object_algs_supported",
     "request_object_signing_alg": "request_object_signing_alg_values_supported",
@@ -67,6 +81,7 @@ PROVIDER_DEFAULT = {
 }
 
 
+@REGISTRY.register
 class Authorization(service.Authorization):
     msg_type = oic.AuthorizationRequest
     response_cls = oic.AuthorizationResponse
@@ -174,6 +189,27 @@ class Authorization(service.Authorization):
             if _request_param == "request":
                 req["request"] = _req
             else:
+                try:
+                    _store = cli_info.request_object_store
+                except AttributeError:
+                    _store = None
+
+                if _store is not None:
+                    try:
+                        _webname = cli_info.registration_response[
+                            'request_uris'][0]
+                    except KeyError:
+                        _webname = ''
+                    try:
+                        req["request_uri"] = _store.add(_req, _webname)
+                    except ValueError:
+                        logger.warning(
+                            'Registered request_uri "{}" is not under the '
+                            'base_url of the request object store'.format(
+                                _webname))
+                        req["request_uri"] = _store.add(_req)
+                    return req
+
                 try:
                     _webname = cli_info.registration_response['request_uris'][0]
                     filename = cli_info.filename_from_webname(_webname)
@@ -187,6 +223,7 @@ class Authorization(service.Authorization):
         return req
 
 
+@REGISTRY.register
 class AccessToken(service.AccessToken):
     msg_type = oic.AccessTokenRequest
     response_cls = oic.AccessTokenResponse
@@ -214,12 +251,14 @@ class AccessToken(service.AccessToken):
                 raise ValueError('Unknown nonce value')
 
 
+@REGISTRY.register
 class RefreshAccessToken(service.RefreshAccessToken):
     msg_type = oic.RefreshAccessTokenRequest
     response_cls = oic.AccessTokenResponse
     error_msg = oic.TokenErrorResponse
 
 
+@REGISTRY.register
 class WebFinger(Service):
     """
     Implements RFC 7033
@@ -231,6 +270,7 @@ class WebFinger(Service):
     request = 'webfinger'
     http_method = 'GET'
     response_body_type = 'json'
+    timeout = (3.05, 10)
 
     def __init__(self, httplib=None, keyjar=None, client_authn_method=None,
                  conf=None):
@@ -254,6 +294,7 @@ class WebFinger(Service):
                     break
         return resp
 
+    @traced('request_info')
     def request_info(self, cli_info, method="GET", request_args=None,
             lax=False, **kwargs):
 
@@ -268,6 +309,7 @@ class WebFinger(Service):
         return {'uri': self.webfinger.query(_resource)}
 
 
+@REGISTRY.register
 class ProviderInfoDiscovery(service.ProviderInfoDiscovery):
     msg_type = oic.Message
     response_cls = oic.ProviderConfigurationResponse
@@ -366,9 +408,10 @@ class ProviderInfoDiscovery(service.ProviderInfoDiscovery):
             if key not in PREFERENCE2PROVIDER:
                 cli_info.behaviour[key] = val
 
-        logger.debug('cli_info behaviour: {}'.format(cli_info.behaviour))
+        logger.debug(LazyFormat('cli_info behaviour: {}', cli_info.behaviour))
 
 
+@REGISTRY.register
 class Registration(Service):
     msg_type = oic.RegistrationRequest
     response_cls = oic.RegistrationResponse
@@ -448,6 +491,7 @@ class Registration(Service):
             pass
 
 
+@REGISTRY.register
 class UserInfo(Service):
     msg_type = Message
     response_cls = oic.OpenIDSchema
@@ -457,6 +501,8 @@ class UserInfo(Service):
     request = 'userinfo'
     default_authn_method = 'bearer_header'
     http_method = 'GET'
+    # Distributed claims
+    claim_source_timeout = 10
 
     def __init__(self, httplib=None, keyjar=None, client_authn_method=None,
                  conf=None):
@@ -465,6 +511,21 @@ class UserInfo(Service):
         self.pre_construct = [self.oic_pre_construct]
         self.post_parse_response.insert(0, self.oic_post_parse_response)
 
+        try:
+            self.claim_source_timeout = self.conf['claim_source_timeout']
+        except KeyError:
+            pass
+
+        try:
+            self.claims_executor = self.conf['claims_executor']
+        except KeyError:
+            self.claims_executor = None
+
+        try:
+            self.jwt_cache = self.conf['jwt_cache']
+        except KeyError:
+            self.jwt_cache = VERIFIED_JWT_CACHE
+
     def oic_pre_construct(self, cli_info, request_args=None, **kwargs):
         if request_args is None:
             request_args = {}
@@ -481,6 +542,38 @@ class UserInfo(Service):
         resp = self.unpack_aggregated_claims(resp, client_info)
         return self.fetch_distributed_claims(resp, client_info)
 
+    def verified_claims(self, token, cli_info):
+        """
+        Verify a signed JWT and return the claims in it. Since the same
+        JWT may be used in many userinfo responses, the result of the
+        verification is cached.
+
+        :param token: The JWT
+        :param cli_info: Client information
+        :return: A :py:class:`oicmsg.message.Message` instance
+        """
+        if self.jwt_cache is None:
+            return Message().from_jwt(token.encode("utf-8"),
+                                      keyjar=cli_info.keyjar)
+
+        _payload = unverified_payload(token)
+        try:
+            _fp = key_fingerprint(cli_info.keyjar, _payload['iss'])
+        except (KeyError, TypeError):
+            # Can't tell whose keys to look at
+            return Message().from_jwt(token.encode("utf-8"),
+                                      keyjar=cli_info.keyjar)
+
+        claims = self.jwt_cache.get(token, _fp)
+        if claims is not None:
+            return Message(**claims)
+
+        msg = Message().from_jwt(token.encode("utf-8"), keyjar=cli_info.keyjar)
+        # Keys may have been fetched while verifying
+        self.jwt_cache.set(token, msg.to_dict(),
+                           key_fingerprint(cli_info.keyjar, _payload['iss']))
+        return msg
+
     def unpack_aggregated_claims(self, userinfo, cli_info):
         try:
             _csrc = userinfo["_claim_sources"]
@@ -489,9 +582,8 @@ class UserInfo(Service):
         else:
             for csrc, spec in _csrc.items():
                 if "JWT" in spec:
-                    aggregated_claims = Message().from_jwt(
-                        spec["JWT"].encode("utf-8"),
-                        keyjar=cli_info.keyjar)
+                    aggregated_claims = self.verified_claims(spec["JWT"],
+                                                             cli_info)
                     claims = [value for value, src in
                               userinfo["_claim_names"].items() if
                               src == csrc]
@@ -501,41 +593,116 @@ class UserInfo(Service):
 
         return userinfo
 
+    def fetch_claim_source(self, spec, cli_info, callback=None):
+        """
+        Fetch claims from one claim source.
+
+        :param spec: The claim source specification, must contain an
+            'endpoint' and may contain an 'access_token'
+        :param cli_info: Client information
+        :param callback: A function that given an endpoint returns the
+            access token to use with it.
+        :return: The response from the claim source
+        """
+        # The time starts now, not when the fetch was asked for
+        _args = {'method': 'GET', 'client_info': cli_info,
+                 'http_args': {'timeout': self.claim_source_timeout},
+                 'deadline': time.time() + self.claim_source_timeout}
+        if "access_token" in spec:
+            _args['token'] = spec["access_token"]
+        elif callback:
+            _args['token'] = callback(spec['endpoint'])
+
+        return self.service_request(spec["endpoint"], **_args)
+
+    def _fetch_claim_sources(self, executor, sources, cli_info, callback):
+        """
+        :param executor: The executor the fetches are run by, if None
+            they are done one after the other in this thread.
+        :return: List of (claim source, response or exception) tuples in
+            the order of the claim sources.
+        """
+        if executor is None:
+            _futures = []
+        else:
+            _futures = [executor.submit(self.fetch_claim_source, spec,
+                                        cli_info, callback)
+                        for _, spec in sources]
+
+        _results = []
+        for i, (csrc, spec) in enumerate(sources):
+            try:
+                if _futures:
+                    _results.append((csrc, _futures[i].result()))
+                else:
+                    _results.append(
+                        (csrc, self.fetch_claim_source(spec, cli_info,
+                                                       callback)))
+            except Exception as err:
+                logger.warning(
+                    'Could not fetch claims from {}: {}'.format(
+                        spec['endpoint'], err))
+                _results.append((csrc, err))
+        return _results
+
     def fetch_distributed_claims(self, userinfo, cli_info, callback=None):
+        """
+        Fetch claims from the distributed claim sources, all at the same
+        time. Each fetch is given claim_source_timeout seconds from when
+        it starts. Unless the service is configured with a
+        claims_executor, every call uses threads of its own, one per claim
+        source, so fetches never wait for each other.
+
+        Claims from sources that fail or don't answer in time are left
+        out and the sources are listed, with the errors, under
+        CLAIM_SOURCE_ERRORS in the response.
+
+        :param userinfo: The userinfo response
+        :param cli_info: Client information
+        :param callback: A function that given an endpoint returns the
+            access token to use with it.
+        :return: The userinfo response with the distributed claims added
+        """
         try:
             _csrc = userinfo["_claim_sources"]
         except KeyError:
-            pass
+            return userinfo
+
+        _sources = [(csrc, spec) for csrc, spec in _csrc.items()
+                    if "endpoint" in spec]
+        if not _sources:
+            return userinfo
+
+        if self.claims_executor is not None:
+            _results = self._fetch_claim_sources(
+                self.claims_executor, _sources, cli_info, callback)
+        elif len(_sources) == 1:
+            _results = self._fetch_claim_sources(None, _sources, cli_info,
+                                                 callback)
         else:
-            for csrc, spec in _csrc.items():
-                if "endpoint" in spec:
-                    if "access_token" in spec:
-                        _uinfo = self.service_request(
-                            spec["endpoint"], method='GET',
-                            token=spec["access_token"], client_info=cli_info)
-                    else:
-                        if callback:
-                            _uinfo = self.service_request(
-                                spec["endpoint"],
-                                method='GET',
-                                token=callback(spec['endpoint']),
-                                client_info=cli_info)
-                        else:
-                            _uinfo = self.service_request(
-                                spec["endpoint"],
-                                method='GET',
-                                client_info=cli_info)
-
-                    claims = [value for value, src in
-                              userinfo["_claim_names"].items() if src == csrc]
-
-                    if set(claims) != set(list(_uinfo.keys())):
-                        logger.warning(
-                            "Claims from claim source doesn't match what's in "
-                            "the userinfo")
-
-                    for key, vals in _uinfo.items():
-                        userinfo[key] = vals
+            with ThreadPoolExecutor(max_workers=len(_sources)) as executor:
+                _results = self._fetch_claim_sources(
+                    executor, _sources, cli_info, callback)
+
+        _errors = dict([(csrc, '{}: {}'.format(type(res).__name__, res))
+                        for csrc, res in _results
+                        if isinstance(res, Exception)])
+        if _errors:
+            userinfo[CLAIM_SOURCE_ERRORS] = _errors
+        _results = [(csrc, res) for csrc, res in _results
+                    if not isinstance(res, Exception)]
+
+        for csrc, _uinfo in _results:
+            claims = [value for value, src in
+                      userinfo["_claim_names"].items() if src == csrc]
+
+            if set(claims) != set(list(_uinfo.keys())):
+                logger.warning(
+                    "Claims from claim source doesn't match what's in "
+                    "the userinfo")
+
+            for key, vals in _uinfo.items():
+                userinfo[key] = vals
 
         return userinfo
 
@@ -561,6 +728,7 @@ def set_id_token(cli_info, request_args, **kwargs):
     return request_args
 
 
+@REGISTRY.register
 class CheckSession(Service):
     msg_type = oic.CheckSessionRequest
     response_cls = Message
@@ -580,6 +748,7 @@ class CheckSession(Service):
         return request_args, {}
 
 
+@REGISTRY.register
 class CheckID(Service):
     msg_type = oic.CheckIDRequest
     response_cls = Message
@@ -599,6 +768,7 @@ class CheckID(Service):
         return request_args, {}
 
 
+@REGISTRY.register
 class EndSession(Service):
     msg_type = oic.EndSessionRequest
     response_cls = Message
@@ -619,12 +789,4 @@ class EndSession(Service):
 
 
 def factory(req_name, **kwargs):
-    for name, obj in inspect.getmembers(sys.modules[__name__]):
-        if inspect.isclass(obj) and issubclass(obj, Service):
-            try:
-                if obj.__name__ == req_name:
-                    return obj(**kwargs)
-            except AttributeError:
-                pass
-
-    return service.factory(req_name, **kwargs)
+    return REGISTRY.factory(req_name, **kwargs)
@@ -1,11 +1,26 @@
+import asyncio
+import functools
 import logging
+import threading
+import time
+
+try:
+    from contextvars import copy_context
+except ImportError:
+    copy_context = None
 
 from future.backports.urllib.parse import urlparse
+from oiccli import LazyFormat
 from oiccli.exception import HttpError, WrongContentType
 from oiccli.exception import MissingEndpoint
 from oiccli.exception import OicCliError
 from oiccli.exception import ParseError
 from oiccli.exception import ResponseError
+from oiccli.metrics import METRICS
+from oiccli.metrics import SERVICE_DURATION
+from oiccli.metrics import SERVICE_REQUESTS
+from oiccli.tracing import NO_SPAN
+from oiccli.tracing import traced
 from oiccli.util import get_or_post
 from oiccli.util import get_response_body_type
 from oiccli.util import JSON_ENCODED
@@ -38,7 +53,7 @@ do_request_init
 
 and this for parsing the response.
 
-service_request
+service_request (or async_service_request)
     - parse_request_response
         - parse_response
              - get_urlinfo
@@ -62,6 +77,23 @@ SPECIAL_ARGS = ['authn_endpoint', 'algs']
 REQUEST_INFO = 'Doing request with: URL:{}, method:{}, data:{}, https_args:{}'
 
 
+async def run_in_executor(executor, func, *args, **kwargs):
+    """
+    Run a function that may block, like parsing and verifying a response,
+    in an executor so that it doesn't stop the event loop. The context
+    variables, for instance the current tracing span, are passed along.
+
+    :param executor: A :py:class:`concurrent.futures.Executor` instance,
+        None means the default executor of the event loop.
+    :param func: The function
+    :return: What the function returns
+    """
+    _func = functools.partial(func, *args, **kwargs)
+    if copy_context is not None:
+        _func = functools.partial(copy_context().run, _func)
+    return await asyncio.get_event_loop().run_in_executor(executor, _func)
+
+
 def update_http_args(http_args, info):
     """
     Extending the header with information gathered during the request
@@ -92,6 +124,38 @@ def update_http_args(http_args, info):
     return info
 
 
+class ArgumentPlan(object):
+    """
+    Where the claims of a message class, that are not given by the caller,
+    can be found. Which ones are attributes of the client info class is
+    decided once and the defaults from the service configuration are
+    gathered into one dictionary. The plan is rebuilt if the configuration
+    changes.
+    """
+
+    def __init__(self, msg_type, cli_info_cls, conf_args, default_args):
+        """
+        :param msg_type: The message class
+        :param cli_info_cls: The client info class
+        :param conf_args: The request_args from the service configuration
+        :param default_args: The service's default request arguments
+        """
+        self.conf_args = dict(conf_args)
+        self.default_args = dict(default_args)
+        self.defaults = {}
+        self.props = []
+        for prop in msg_type.c_param.keys():
+            self.props.append((prop, hasattr(cli_info_cls, prop)))
+            for _args in [self.conf_args, self.default_args]:
+                if prop in _args:
+                    self.defaults[prop] = _args[prop]
+                    break
+
+    def valid(self, conf_args, default_args):
+        return conf_args == self.conf_args and \
+            default_args == self.default_args
+
+
 class Service(object):
     msg_type = Message
     response_cls = Message
@@ -103,6 +167,8 @@ class Service(object):
     http_method = 'GET'
     body_type = 'urlencoded'
     response_body_type = 'json'
+    # Connect and read timeouts, None means the HTTP library's default
+    timeout = None
 
     def __init__(self, httplib=None, keyjar=None, client_authn_method=None,
                  conf=None, **kwargs):
@@ -116,17 +182,37 @@ class Service(object):
             self.conf = conf
             for param in ['msg_type', 'response_cls', 'error_msg',
                           'default_authn_method', 'http_method', 'body_type',
-                          'response_body_type']:
+                          'response_body_type', 'timeout']:
                 if param in conf:
-                    setattr(self, param, conf['param'])
+                    setattr(self, param, conf[param])
         else:
             self.conf = {}
 
+        try:
+            self.metrics = self.conf['metrics']
+        except KeyError:
+            self.metrics = METRICS
+
+        try:
+            self.tracer = self.conf['tracer']
+        except KeyError:
+            self.tracer = None
+
+        # Where the asynchronous methods run the parsing and verification
+        # of responses, None means the default executor of the event loop.
+        try:
+            self.parse_executor = self.conf['parse_executor']
+        except KeyError:
+            self.parse_executor = None
+
+        self._argument_plans = {}
+
         # pull in all the modifiers
         self.pre_construct = []
         self.post_construct = []
         self.post_parse_response = []
 
+    @traced('gather_request_args')
     def gather_request_args(self, cli_info, **kwargs):
         """
         Go through the attributes that the message class can contain and
@@ -139,24 +225,58 @@ class Service(object):
         """
         ar_args = kwargs.copy()
 
+        try:
+            _vars = vars(cli_info)
+        except TypeError:
+            _vars = {}
+        _plan = self.argument_plan(cli_info)
+
         # Go through the list of claims defined for the message class
-        for prop in self.msg_type.c_param.keys():
+        for prop, on_class in _plan.props:
             if prop in ar_args:
                 continue
-            else:
+            if on_class:
                 try:
                     ar_args[prop] = getattr(cli_info, prop)
+                    continue
                 except AttributeError:
-                    try:
-                        ar_args[prop] = self.conf['request_args'][prop]
-                    except KeyError:
-                        try:
-                            ar_args[prop] = self.default_request_args[prop]
-                        except KeyError:
-                            pass
+                    pass
+            elif prop in _vars:
+                ar_args[prop] = _vars[prop]
+                continue
+            if prop in _plan.defaults:
+                ar_args[prop] = _plan.defaults[prop]
 
         return ar_args
 
+    def argument_plan(self, cli_info):
+        """
+        Get the :py:class:`ArgumentPlan` for the message class of this
+        service and the class of the client info, building a new one if
+        there is none or the configuration has changed.
+
+        :param cli_info: Client info
+        :return: A :py:class:`ArgumentPlan` instance
+        """
+        _key = (self.msg_type, type(cli_info))
+        try:
+            _conf_args = self.conf['request_args']
+        except KeyError:
+            _conf_args = {}
+
+        try:
+            _plan = self._argument_plans[_key]
+        except KeyError:
+            pass
+        else:
+            if _plan.valid(_conf_args, self.default_request_args):
+                return _plan
+
+        _plan = ArgumentPlan(self.msg_type, type(cli_info), _conf_args,
+                             self.default_request_args)
+        self._argument_plans[_key] = _plan
+        return _plan
+
     def do_pre_construct(self, cli_info, request_args, **kwargs):
         """
         Will run the pre_construct methods one by one in the order given.
@@ -170,7 +290,9 @@ class Service(object):
         """
         post_args = {}
         for meth in self.pre_construct:
-            request_args, _post_args = meth(cli_info, request_args, **kwargs)
+            with self._hook_span('pre_construct', meth):
+                request_args, _post_args = meth(cli_info, request_args,
+                                                **kwargs)
             post_args.update(_post_args)
 
         return request_args, post_args
@@ -186,7 +308,8 @@ class Service(object):
         :return: Possible modified set of request arguments.
         """
         for meth in self.post_construct:
-            request_args = meth(cli_info, request_args, **post_args)
+            with self._hook_span('post_construct', meth):
+                request_args = meth(cli_info, request_args, **post_args)
 
         return request_args
 
@@ -201,8 +324,10 @@ class Service(object):
         :param kwargs: Extra key word arguments
         """
         for meth in self.post_parse_response:
-            meth(resp, cli_info, state=state, **kwargs)
+            with self._hook_span('post_parse_response', meth):
+                meth(resp, cli_info, state=state, **kwargs)
 
+    @traced('construct')
     def construct(self, cli_info, request_args=None, **kwargs):
         """
         Instantiate the request as a message class instance
@@ -253,6 +378,7 @@ class Service(object):
 
         return uri
 
+    @traced('uri_and_body')
     def uri_and_body(self, request, method="POST", **kwargs):
         """
         Based on the HTTP method place the protocol message in the right
@@ -277,6 +403,7 @@ class Service(object):
 
         return info
 
+    @traced('init_authentication_method')
     def init_authentication_method(self, request, cli_info, authn_method,
                                    http_args=None, **kwargs):
         """
@@ -295,12 +422,13 @@ class Service(object):
             http_args = {}
 
         if authn_method:
-            logger.debug('Client authn method: {}'.format(authn_method))
+            logger.debug(LazyFormat('Client authn method: {}', authn_method))
             return self.client_authn_method[authn_method]().construct(
                 request, cli_info, http_args=http_args, **kwargs)
         else:
             return http_args
 
+    @traced('request_info')
     def request_info(self, cli_info, method="", request_args=None,
                      body_type='', authn_method='', lax=False, **kwargs):
         """
@@ -332,7 +460,7 @@ class Service(object):
 
         request = self.construct(cli_info, request_args, **_args)
 
-        if self.events:
+        if self.events is not None:
             self.events.store('Protocol request', request)
 
         # If I'm to be lenient when verifying the message
@@ -354,6 +482,24 @@ class Service(object):
 
         return self.uri_and_body(request, method, **kwargs)
 
+    def http_request_args(self, http_args=None, deadline=0):
+        """
+        Add the timeouts of this service, unless the caller has given some,
+        and the deadline to the arguments to the HTTP library.
+
+        :param http_args: Arguments for the HTTP client
+        :param deadline: When to stop waiting for the response, seconds
+            since epoch
+        :return: A new dictionary
+        """
+        _args = dict(http_args) if http_args else {}
+        if self.timeout is not None and 'timeout' not in _args:
+            _args['timeout'] = self.timeout
+        if deadline:
+            _args['deadline'] = deadline
+        return _args
+
+    @traced('do_request_init')
     def do_request_init(self, cli_info, body_type="", method="",
                         authn_method='', request_args=None, http_args=None,
                         **kwargs):
@@ -398,6 +544,7 @@ class Service(object):
                 info = fragment
         return info
 
+    @traced('parse_response')
     def parse_response(self, info, client_info, sformat="json", state="",
                        **kwargs):
         """
@@ -418,26 +565,28 @@ class Service(object):
         :return: The parsed and to some extend verified response
         """
 
-        logger.debug('response format: {}'.format(sformat))
+        logger.debug(LazyFormat('response format: {}', sformat))
 
         # If format is urlencoded 'info' may be a URL
         # in which case I have to get at the query/fragment part
         if sformat == "urlencoded":
             info = self.get_urlinfo(info)
 
-        if self.events:
+        if self.events is not None:
             self.events.store('Response', info)
 
-        logger.debug('response_cls: {}'.format(self.response_cls.__name__))
+        logger.debug(
+            LazyFormat('response_cls: {}', self.response_cls.__name__))
         try:
-            resp = self.response_cls().deserialize(info, sformat, **kwargs)
+            with self._span('deserialize', format=sformat):
+                resp = self.response_cls().deserialize(info, sformat,
+                                                       **kwargs)
         except Exception as err:
             logger.error('Error while deserializing: {}'.format(err))
             raise
 
-        msg = 'Initial response parsing => "{}"'
-        logger.debug(msg.format(resp.to_dict()))
-        if self.events:
+        logger.debug(LazyFormat('Initial response parsing => "{}"', resp))
+        if self.events is not None:
             self.events.store('Protocol Response', resp)
 
         # if it's an error message and I didn't expect it recast the
@@ -467,7 +616,7 @@ class Service(object):
             except KeyError:
                 pass
 
-            logger.debug('Error response: {}'.format(resp))
+            logger.debug(LazyFormat('Error response: {}', resp))
         else:
             # Need to add some information before running verify()
             kwargs["client_id"] = client_info.client_id
@@ -478,9 +627,10 @@ class Service(object):
             if "key" not in kwargs and "keyjar" not in kwargs:
                 kwargs["keyjar"] = self.keyjar
 
-            logger.debug("Verify response with {}".format(kwargs))
+            logger.debug(LazyFormat("Verify response with {}", kwargs))
             try:
-                verf = resp.verify(**kwargs)
+                with self._span('verify'):
+                    verf = resp.verify(**kwargs)
             except Exception as err:
                 logger.error(
                     'Got exception while verifying response: {}'.format(err))
@@ -512,6 +662,7 @@ class Service(object):
 
         return resp
 
+    @traced('parse_error_mesg')
     def parse_error_mesg(self, reqresp, body_type):
         """
         Parse an error message.
@@ -547,6 +698,7 @@ class Service(object):
         else:
             return 'urlencoded'
 
+    @traced('parse_request_response')
     def parse_request_response(self, reqresp, client_info,
                                response_body_type='',
                                state="", **kwargs):
@@ -563,7 +715,8 @@ class Service(object):
         """
 
         if reqresp.status_code in SUCCESSFUL:
-            logger.debug('response_body_type: "{}"'.format(response_body_type))
+            logger.debug(
+                LazyFormat('response_body_type: "{}"', response_body_type))
             try:
                 _type = get_response_body_type(reqresp)
             except ValueError as err:
@@ -579,7 +732,7 @@ class Service(object):
                 else:
                     value_type = response_body_type
 
-            logger.debug('Successful response: {}'.format(reqresp.text))
+            logger.debug(LazyFormat('Successful response: {}', reqresp.text))
 
             try:
                 return self.parse_response(reqresp.text, client_info,
@@ -610,9 +763,52 @@ class Service(object):
             raise HttpError("HTTP ERROR: %s [%s] on %s" % (
                 reqresp.text, reqresp.status_code, reqresp.url))
 
+    def _span(self, name, **attributes):
+        """
+        :param name: The name of the span
+        :param attributes: Information about the span
+        :return: A context manager, that creates a span if this service has
+            a tracer.
+        """
+        if self.tracer is None:
+            return NO_SPAN
+        attributes['service'] = self.request or self.__class__.__name__
+        return self.tracer.span(name, attributes)
+
+    def _hook_span(self, phase, meth):
+        if self.tracer is None:
+            return NO_SPAN
+        return self._span(phase, hook=getattr(meth, '__name__', repr(meth)))
+
+    def _record(self, started, response=None, error=None, outcome=''):
+        """
+        Count a request done by this service and how long it took, from
+        sending the request until the response has been parsed.
+
+        :param started: When the request was started, from time.monotonic
+        :param response: The parsed response
+        :param error: The exception raised, if any
+        :param outcome: What to count the request as, if not decided by
+            response and error.
+        """
+        _service = self.request or self.__class__.__name__
+        if outcome:
+            _outcome = outcome
+        elif error is not None:
+            _outcome = type(error).__name__
+        elif isinstance(response, ErrorResponse):
+            _outcome = 'error_response'
+        else:
+            _outcome = 'ok'
+        self.metrics.inc(SERVICE_REQUESTS, {'service': _service,
+                                            'outcome': _outcome})
+        self.metrics.observe(SERVICE_DURATION, time.monotonic() - started,
+                             {'service': _service})
+
+    @traced('service_request')
     def service_request(self, url, method="GET", body=None,
                         response_body_type="", http_args=None, client_info=None,
-                        **kwargs):
+                        deadline=0, **kwargs):
         """
         The method that sends the request and handles the response returned.
         This assumes a synchronous request-response exchange.
@@ -624,19 +820,25 @@ class Service(object):
             return message
         :param http_args: Arguments for the HTTP client
         :param client_info: A py:class:`oiccli.client_info.ClientInfo` instance
+        :param deadline: When to stop waiting for the response, seconds
+            since epoch
         :return: A cls or ErrorResponse instance or the HTTP response
             instance if no response body was expected.
         """
 
-        if http_args is None:
-            http_args = {}
+        http_args = self.http_request_args(http_args, deadline)
 
-        logger.debug(REQUEST_INFO.format(url, method, body, http_args))
+        logger.debug(LazyFormat(REQUEST_INFO, url, method, body, http_args))
 
+        _started = time.monotonic()
         try:
-            resp = self.httplib(url, method, data=body, **http_args)
+            with self._span('http', method=method,
+                            url=url.split('?')[0]):
+                resp = self.httplib(url, method, data=body, **http_args)
         except Exception as err:
             logger.error('Exception on request: {}'.format(err))
+            if self.metrics is not None:
+                self._record(_started, error=err)
             raise
 
         if "keyjar" not in kwargs:
@@ -644,8 +846,95 @@ class Service(object):
         if not response_body_type:
             response_body_type = self.response_body_type
 
-        return self.parse_request_response(resp, client_info,
-                                           response_body_type, **kwargs)
+        try:
+            _resp = self.parse_request_response(resp, client_info,
+                                                response_body_type, **kwargs)
+        except Exception as err:
+            if self.metrics is not None:
+                self._record(_started, error=err)
+            raise
+
+        if self.metrics is not None:
+            self._record(_started, _resp)
+        return _resp
+
+    async def async_parse_request_response(self, reqresp, client_info,
+                                           response_body_type='', state="",
+                                           **kwargs):
+        """
+        The awaitable version of :py:meth:`parse_request_response`.
+        The response body has already been read by the asynchronous HTTP
+        library. The same parsing, verification and post_parse_response
+        methods as in the synchronous case are used but they are run in
+        parse_executor, since verifying signatures, and fetching keys that
+        are missing, would otherwise block the event loop.
+
+        :param reqresp: The HTTP request response
+        :param client_info: Information about the client/server session
+        :param response_body_type: If response in body one of 'json', 'jwt' or
+            'urlencoded'
+        :param state: Session identifier
+        :param kwargs: Extra keyword arguments
+        :return:
+        """
+        return await run_in_executor(
+            self.parse_executor, self.parse_request_response, reqresp,
+            client_info, response_body_type, state, **kwargs)
+
+    @traced('service_request')
+    async def async_service_request(self, url, method="GET", body=None,
+                                    response_body_type="", http_args=None,
+                                    client_info=None, deadline=0, **kwargs):
+        """
+        The awaitable version of :py:meth:`service_request`. The HTTP
+        library used must be an asynchronous one like
+        :py:class:`oiccli.async_http.AsyncHTTPLib`.
+
+        :param url: The URL to which the request should be sent
+        :param method: Which HTTP method to use
+        :param body: A message body if any
+        :param response_body_type: The expected format of the body of the
+            return message
+        :param http_args: Arguments for the HTTP client
+        :param client_info: A py:class:`oiccli.client_info.ClientInfo` instance
+        :param deadline: When to stop waiting for the response, seconds
+            since epoch
+        :return: A cls or ErrorResponse instance or the HTTP response
+            instance if no response body was expected.
+        """
+
+        http_args = self.http_request_args(http_args, deadline)
+
+        logger.debug(LazyFormat(REQUEST_INFO, url, method, body, http_args))
+
+        _started = time.monotonic()
+        try:
+            with self._span('http', method=method,
+                            url=url.split('?')[0]):
+                resp = await self.httplib(url, method, data=body,
+                                          **http_args)
+        except Exception as err:
+            logger.error('Exception on request: {}'.format(err))
+            if self.metrics is not None:
+                self._record(_started, error=err)
+            raise
+
+        if "keyjar" not in kwargs:
+            kwargs["keyjar"] = self.keyjar
+        if not response_body_type:
+            response_body_type = self.response_body_type
+
+        try:
+            _resp = await self.async_parse_request_response(
+                resp, client_info, response_body_type, **kwargs)
+        except Exception as err:
+            if self.metrics is not None:
+                self._record(_started, error=err)
+            raise
+
+        if self.metrics is not None:
+            self._record(_started, _resp)
+        return _resp
 
 
 def build_services(srvs, service_factory, http, keyjar, client_authn_method):
@@ -660,3 +949,129 @@ def build_services(srvs, service_factory, http, keyjar, client_authn_method):
     service['any'] = Service(httplib=http, keyjar=keyjar,
                              client_authn_method=client_authn_method)
     return service
+
+
+class ServiceRegistry(object):
+    """
+    Maps service names to service classes.
+
+    Services are added with :py:meth:`register`, normally used as a class
+    decorator, or by other packages through the setuptools entry point group
+    given when the registry is created::
+
+        [oiccli.oic.services]
+        MyService = mypackage.services:MyService
+
+    Entry points are loaded the first time a name that isn't registered
+    is asked for. A name that is unknown to a registry is looked up in its
+    parent registry if it has one.
+    """
+
+    def __init__(self, parent=None, entry_point_group=''):
+        """
+        :param parent: A :py:class:`ServiceRegistry` instance
+        :param entry_point_group: Name of the entry point group where
+            services provided by other packages are found.
+        """
+        self.parent = parent
+        self.entry_point_group = entry_point_group
+        self._services = {}
+        self._loaded = not entry_point_group
+        self._lock = threading.Lock()
+
+    def register(self, cls=None, name=''):
+        """
+        Register a service class. Can be used as a class decorator with or
+        without arguments.
+
+        :param cls: The service class
+        :param name: The name of the service, the name of the class if not
+            given.
+        :return: The service class
+        """
+        def _register(_cls):
+            self._services[name or _cls.__name__] = _cls
+            return _cls
+
+        if cls is None:
+            return _register
+        return _register(cls)
+
+    def _entry_points(self):
+        try:
+            from importlib.metadata import entry_points
+        except ImportError:
+            # Before Python 3.8
+            import pkg_resources
+            return pkg_resources.iter_entry_points(self.entry_point_group)
+
+        _eps = entry_points()
+        try:
+            return _eps.select(group=self.entry_point_group)
+        except AttributeError:
+            # Before Python 3.10
+            return _eps.get(self.entry_point_group, [])
+
+    def load_entry_points(self):
+        with self._lock:
+            if self._loaded:
+                return
+            for ep in self._entry_points():
+                try:
+                    self._services.setdefault(ep.name, ep.load())
+                except Exception as err:
+                    logger.error(
+                        'Could not load service {}: {}'.format(ep.name, err))
+            self._loaded = True
+
+    def get(self, name):
+        """
+        :param name: The name of a service
+        :return: The service class
+        :raises KeyError: If there is no service by that name
+        """
+        try:
+            return self._services[name]
+        except KeyError:
+            pass
+
+        if not self._loaded:
+            self.load_entry_points()
+            try:
+                return self._services[name]
+            except KeyError:
+                pass
+
+        if self.parent is not None:
+            return self.parent.get(name)
+        raise KeyError(name)
+
+    def __contains__(self, name):
+        try:
+            self.get(name)
+        except KeyError:
+            return False
+        else:
+            return True
+
+    def names(self):
+        if not self._loaded:
+            self.load_entry_points()
+        _names = set(self._services.keys())
+        if self.parent is not None:
+            _names.update(self.parent.names())
+        return sorted(_names)
+
+    def factory(self, req_name, **kwargs):
+        """
+        Create a service instance.
+
+        :param req_name: The name of the service
+        :param kwargs: Arguments to the service class constructor
+        :return: A service instance or None if there is no such service
+        """
+        try:
+            _cls = self.get(req_name)
+        except KeyError:
+            return None
+        return _cls(**kwargs)
@@ -1,18 +1,33 @@
-import shelve
+import hashlib
+import logging
+import threading
+
+from cryptojwt import as_bytes
 
 from oicmsg.message import Message
 from oicmsg.message import SINGLE_OPTIONAL_STRING
 from oicmsg.message import SINGLE_REQUIRED_STRING
 from oicmsg.oauth2 import AuthorizationResponse
+from oicmsg.jwt import JWT
 from oicmsg.oic import JsonWebToken
 from oicmsg.time_util import utc_time_sans_frac
 
 from oiccli import rndstr
+from oiccli.state_store import MemoryStore
+from oiccli.state_store import ShelveStore
+from oiccli.state_store import StateStore
+
+logger = logging.getLogger(__name__)
 
 
 # draft-bradley-oauth-jwt-encoded-state-05
 
 
+# How long, in seconds, information with a refresh token is kept after it
+# was last updated
+REFRESH_LIFETIME = 30 * 86400
+
+
 class StateJwt(JsonWebToken):
     c_param = JsonWebToken.c_param.copy()
     c_param.update({
@@ -43,16 +58,35 @@ class State(object):
     id_token.
     """
 
-    def __init__(self, client_id, db=None, db_name='', lifetime=600):
+    def __init__(self, client_id, db=None, db_name='', lifetime=600,
+                 refresh_lifetime=REFRESH_LIFETIME):
+        """
+        :param client_id: The client ID
+        :param db: A :py:class:`oiccli.state_store.StateStore` instance or
+            a dictionary like object in which the state information is kept.
+        :param db_name: If no db is given, the name of a shelve database
+            to use.
+        :param lifetime: How long, in seconds, a state value is valid.
+            Counted from when the state value was created. If set to 0 state
+            information is kept forever.
+        :param refresh_lifetime: How long, in seconds, state information
+            with a refresh token is kept after the last response was added.
+            If set to 0 it's kept until removed.
+        """
         self.client_id = client_id
-        self._db = db
-        # self._db_name = db_name
-        if self._db is None:
+        if db is None:
             if db_name:
-                self._db = shelve.open(db_name, writeback=True)
+                db = ShelveStore(db_name)
             else:
-                self._db = {}
+                db = MemoryStore()
+        elif not isinstance(db, StateStore):
+            db = MemoryStore(db)
+        self._db = db
         self.lifetime = lifetime
+        self.refresh_lifetime = refresh_lifetime
+        # Functions that are called with the state value and the token
+        # information when new token information has been added.
+        self.on_token_update = []
 
     def create_state(self, receiver, request):
         """
@@ -167,8 +201,18 @@ class State(object):
             except KeyError:
                 pass
 
+        # Information with a refresh token is kept as long as it's used
+        if 'refresh_token' in _state_info and self.refresh_lifetime:
+            _state_info['refresh_exp'] = \
+                utc_time_sans_frac() + self.refresh_lifetime
+
         # Updated the state database
         self[state] = _state_info
+
+        if 'access_token' in response:
+            for func in self.on_token_update:
+                func(state, _state_info['token'])
+
         return _state_info
 
     def add_info(self, state, **kwargs):
@@ -185,11 +229,46 @@ class State(object):
         self[state] = _state_info
         return _state_info
 
+    def expires_at(self, state_info):
+        """
+        Calculate when state information expires. Normally that is lifetime
+        seconds after the state value was created. If an access token that
+        is valid longer was received the information is kept until the
+        access token expires and if there is a refresh token it's kept
+        refresh_lifetime seconds after the last response was added.
+
+        :param state_info: The state information
+        :return: Time of expiration in seconds since epoch, 0 if the
+            information never expires.
+        """
+        if not self.lifetime:
+            return 0
+
+        if 'refresh_token' in state_info:
+            if not self.refresh_lifetime:
+                return 0
+            try:
+                return state_info['refresh_exp']
+            except KeyError:
+                return utc_time_sans_frac() + self.refresh_lifetime
+
+        try:
+            _exp = state_info['iat'] + self.lifetime
+        except KeyError:
+            _exp = utc_time_sans_frac() + self.lifetime
+
+        try:
+            _exp = max(_exp, state_info['token']['exp'])
+        except KeyError:
+            pass
+
+        return _exp
+
     def __getitem__(self, state):
         return self._db['state_{}'.format(state)]
 
     def __setitem__(self, state, value):
-        self._db['state_{}'.format(state)] = value
+        self._db.set('state_{}'.format(state), value, self.expires_at(value))
 
     def bind_nonce_to_state(self, nonce, state):
         """
@@ -199,7 +278,16 @@ class State(object):
         :param nonce: Nonce value
         :param state: State value
         """
-        self._db['nonce_{}'.format(nonce)] = state
+        if self.lifetime:
+            try:
+                _iat = self[state]['iat']
+            except KeyError:
+                _iat = utc_time_sans_frac()
+            _exp = _iat + self.lifetime
+        else:
+            _exp = 0
+
+        self._db.set('nonce_{}'.format(nonce), state, _exp)
 
     def nonce_to_state(self, nonce):
         """
@@ -264,22 +352,184 @@ class State(object):
     def get_id_token(self, state):
         return self[state]['id_token']
 
+    def sweep(self, batch_size=100, now=0):
+        """
+        Remove at most batch_size pieces of expired information.
+
+        :param batch_size: Maximum number of entries to remove
+        :param now: The present time, seconds since epoch
+        :return: The number of entries removed
+        """
+        if not now:
+            now = utc_time_sans_frac()
+        return self._db.expire(now, batch_size)
+
+
+class Sweeper(object):
+    """
+    Removes expired information from a state database in the background.
+    Work is done in small batches with a pause between them so no lock on
+    the database is held for long.
+    """
+
+    def __init__(self, state_db, interval=60, batch_size=100, pause=0.01):
+        """
+        :param state_db: A :py:class:`State` instance
+        :param interval: Seconds between sweeps
+        :param batch_size: Maximum number of entries removed per batch
+        :param pause: Seconds to wait between batches
+        """
+        self.state_db = state_db
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sweep(self):
+        """
+        Remove all information that has expired, one batch at the time.
+
+        :return: The number of entries removed
+        """
+        total = 0
+        while not self._stop.is_set():
+            try:
+                n = self.state_db.sweep(self.batch_size)
+            except Exception as err:
+                logger.error('State sweep failed: {}'.format(err))
+                break
+            total += n
+            if n < self.batch_size:
+                break
+            self._stop.wait(self.pause)
+        return total
+
+    def run(self):
+        while not self._stop.is_set():
+            self.sweep()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='StateSweeper')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class StateLess(State):
+    """
+    Instead of keeping the information about a request in a database it's
+    packed into a signed and encrypted JWT that is used as the state value.
+    Any RP instance that has the keys can then deal with the response.
+    Only information that is added after the request was sent, like
+    the access token, is kept on the server side.
+
+    A state value can't be used after the JWT has expired, lifetime seconds
+    after it was created, and the server side information expires with it.
+    So StateLess can't be used to keep long lived refresh tokens, use
+    :py:class:`State` for that.
+    """
+
+    def __init__(self, issuer, keyjar, db=None, db_name='', lifetime=600,
+                 sign_alg='RS256', enc_alg="ECDH-ES", enc_enc="A128GCM"):
+        """
+        :param issuer: Used both as client ID and as the issuer of the JWT
+        :param keyjar: A :py:class:`oicmsg.key_jar.KeyJar` instance with the
+            keys used to sign/verify and encrypt/decrypt the state JWT.
+        :param db: Where the server side information is kept, see
+            :py:class:`State`
+        :param db_name: If no db is given, the name of a shelve database
+            to use.
+        :param lifetime: How long, in seconds, a state value is valid
+        :param sign_alg: The signing algorithm
+        :param enc_alg: The encryption algorithm
+        :param enc_enc: The content encryption algorithm
+        """
+        State.__init__(self, issuer, db=db, db_name=db_name, lifetime=lifetime)
+        self.keyjar = keyjar
+        self.jwt = JWT(keyjar, issuer, lifetime=lifetime, sign_alg=sign_alg,
+                       encrypt=True, enc_enc=enc_enc, enc_alg=enc_alg)
+
+    @staticmethod
+    def _key(token):
+        # State values are long, the server side information is kept under
+        # a digest of the value.
+        return 'state_{}'.format(hashlib.sha256(as_bytes(token)).hexdigest())
+
+    def _expiration(self, info):
+        """
+        :param info: The content of a state JWT
+        :return: When the state value expires, 0 if never
+        """
+        _exp = []
+        try:
+            _exp.append(int(info['exp']))
+        except (KeyError, TypeError, ValueError):
+            pass
+        if self.lifetime:
+            try:
+                _exp.append(int(info['iat']) + self.lifetime)
+            except (KeyError, TypeError, ValueError):
+                pass
+        if _exp:
+            return min(_exp)
+        return 0
+
+    def _unpack(self, token, now=0):
+        try:
+            _info = self.jwt.unpack(token)
+        except Exception as err:
+            logger.info('Could not unpack state value: {}'.format(err))
+            raise UnknownState(token)
+
+        try:
+            _info = _info.to_dict()
+        except AttributeError:
+            _info = dict(_info)
+
+        _exp = self._expiration(_info)
+        if _exp and _exp <= (now or utc_time_sans_frac()):
+            logger.info('State value has expired')
+            raise UnknownState(token)
+        return _info
+
+    def create_state(self, receiver, request):
+        """
+        Construct a state value which is a JWT containing information about
+        the request.
 
-# class StateLess(State):
-#     def __init__(self, issuer, db=None, db_name='', lifetime=600, keyjar=None):
-#         State.__init__(self, issuer, db=db, db_name=db_name, lifetime=lifetime)
-#         self.keyjar = keyjar
-#         self.jwt = JWT(keyjar, issuer, lifetime=3600, sign_alg='RS256',
-#                        encrypt=True, enc_enc="A128GCM", enc_alg="ECDH-ES")
-#         self.active = []
-#
-#     def create_state(self, receiver, request):
-#         _resp_args = {'as': receiver}
-#         if isinstance(request, Message):
-#             _resp_args.update(request.to_dict())
-#         else:
-#             _resp_args.update(request)
-#         return self.jwt.pack(payload=_resp_args)
-#
-#     def __getitem__(self, token):
-#         return self.jwt.unpack(token)
+        :param receiver: Who is the receiver of a request with this
+            state value.
+        :param request: The request
+        :return: A signed and encrypted JWT
+        """
+        _state_info = {'client_id': self.client_id, 'as': receiver,
+                       'iat': utc_time_sans_frac()}
+        if isinstance(request, Message):
+            _state_info.update(request.to_dict())
+        else:
+            _state_info.update(request)
+        return self.jwt.pack(payload=_state_info)
+
+    def __getitem__(self, token):
+        _info = self._unpack(token)
+        try:
+            _info.update(self._db[self._key(token)])
+        except KeyError:
+            pass
+        return _info
+
+    def __setitem__(self, token, value):
+        # Only keep what's not already in the state value
+        _packed = self._unpack(token)
+        _extra = dict([(k, v) for k, v in value.items() if
+                       k not in _packed or _packed[k] != v])
+        # Can't be reached when the state value has expired
+        self._db.set(self._key(token), _extra, self._expiration(_packed))
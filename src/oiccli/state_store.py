@@ -0,0 +1,359 @@
+import heapq
+import json
+import os
+import re
+import shelve
+import sqlite3
+import threading
+import time
+
+__author__ = 'Roland Hedberg'
+
+"""
+Storage backends for :py:class:`oiccli.state.State`.
+
+A store is a mapping from string keys to state information. The state
+information is always written back explicitly after it has been changed so
+a store does not have to track changes made to the values it has handed out.
+
+Every entry can be given an expiration time. Expired entries are removed
+when someone tries to read them and in batches by the expire method.
+"""
+
+TABLE_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def _now():
+    return int(time.time())
+
+
+class StateStore(object):
+    """
+    The interface a state storage backend must implement.
+    """
+
+    def __getitem__(self, key):
+        raise NotImplementedError()
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        raise NotImplementedError()
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        else:
+            return True
+
+    def set(self, key, value, exp=0):
+        """
+        Store a value.
+
+        :param key: The key
+        :param value: The value
+        :param exp: When the entry expires, as seconds since epoch. 0 means
+            that it never expires.
+        """
+        raise NotImplementedError()
+
+    def keys(self):
+        raise NotImplementedError()
+
+    def expire(self, now=0, limit=100):
+        """
+        Remove entries that have expired.
+
+        :param now: The present time, seconds since epoch
+        :param limit: The maximum number of entries to remove or look at.
+        :return: The number of entries removed
+        """
+        raise NotImplementedError()
+
+    def sync(self):
+        """
+        Make sure everything is written to persistent storage.
+        """
+        pass
+
+    def close(self):
+        """
+        Release any resources held by the store.
+        """
+        pass
+
+
+class MemoryStore(StateStore):
+    """
+    Keeps everything in a dictionary in memory. This is the default store.
+    Expiration times are kept in a heap so that finding expired entries
+    doesn't require looking at all entries.
+    """
+
+    def __init__(self, db=None):
+        """
+        :param db: A dictionary like object to keep the information in.
+        """
+        if db is None:
+            db = {}
+        self._db = db
+        self._exp = {}
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        _exp = self._exp.get(key, 0)
+        if _exp and _exp <= _now():
+            with self._lock:
+                if self._exp.get(key) == _exp:
+                    del self._db[key]
+                    del self._exp[key]
+            raise KeyError(key)
+        return self._db[key]
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._db[key]
+            self._exp.pop(key, None)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        else:
+            return True
+
+    def set(self, key, value, exp=0):
+        with self._lock:
+            self._db[key] = value
+            if exp:
+                if self._exp.get(key) != exp:
+                    self._exp[key] = exp
+                    heapq.heappush(self._heap, (exp, key))
+            else:
+                self._exp.pop(key, None)
+
+    def keys(self):
+        return list(self._db.keys())
+
+    def expire(self, now=0, limit=100):
+        if not now:
+            now = _now()
+
+        n = 0
+        with self._lock:
+            for _ in range(limit):
+                if not self._heap or self._heap[0][0] > now:
+                    break
+                exp, key = heapq.heappop(self._heap)
+                # The entry may have been removed or got a new expiration
+                # time since this heap item was added.
+                if self._exp.get(key) == exp:
+                    del self._exp[key]
+                    try:
+                        del self._db[key]
+                    except KeyError:
+                        pass
+                    n += 1
+        return n
+
+
+class ShelveStore(StateStore):
+    """
+    Keeps the information in a :py:mod:`shelve` database.
+    Since values are written back explicitly, writeback mode is not used.
+    A shelve database can not be shared between processes, for that use
+    :py:class:`SQLiteStore`, and the dbm modules are not thread safe so
+    all access is serialized.
+
+    Values are stored as (exp, value) tuples. Values written by earlier
+    versions, that are not such tuples, are read as never expiring.
+    """
+
+    def __init__(self, db_name):
+        """
+        :param db_name: The name of the database file
+        """
+        self._db = shelve.open(db_name)
+        self._sweep_keys = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _unpack(item):
+        if isinstance(item, tuple) and len(item) == 2:
+            return item
+        return 0, item
+
+    def __getitem__(self, key):
+        with self._lock:
+            exp, value = self._unpack(self._db[key])
+            if exp and exp <= _now():
+                del self._db[key]
+                raise KeyError(key)
+        return value
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._db[key]
+
+    def set(self, key, value, exp=0):
+        with self._lock:
+            self._db[key] = (exp, value)
+
+    def keys(self):
+        with self._lock:
+            return list(self._db.keys())
+
+    def expire(self, now=0, limit=100):
+        if not now:
+            now = _now()
+
+        # A shelve database has no index on the expiration time, so
+        # the keys are checked limit at the time.
+        if not self._sweep_keys:
+            self._sweep_keys = self.keys()
+
+        n = 0
+        _batch = self._sweep_keys[:limit]
+        self._sweep_keys = self._sweep_keys[limit:]
+        for key in _batch:
+            with self._lock:
+                try:
+                    exp, _ = self._unpack(self._db[key])
+                except KeyError:
+                    continue
+                if exp and exp <= now:
+                    del self._db[key]
+                    n += 1
+        return n
+
+    def sync(self):
+        with self._lock:
+            self._db.sync()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class SQLiteStore(StateStore):
+    """
+    Keeps the information in a SQLite database in WAL mode.
+    Keys are the primary key of the table and there is an index on the
+    expiration time, so both lookups and expiration use an index.
+    Each thread and each process use their own connection, which means that
+    the database can be shared by several worker processes.
+    """
+
+    def __init__(self, db_name, table='state', timeout=30.0, serializer=json):
+        """
+        :param db_name: The name of the database file
+        :param table: The name of the table in which the information is kept
+        :param timeout: How long to wait, in seconds, for a lock held by
+            some other connection to be released.
+        :param serializer: Something with a dumps and a loads method used to
+            serialize the values.
+        """
+        if not TABLE_NAME.match(table):
+            raise ValueError('Bad table name: {}'.format(table))
+
+        self.db_name = db_name
+        self.table = table
+        self.timeout = timeout
+        self.serializer = serializer
+        self._local = threading.local()
+
+        _con = self._connection()
+        _con.execute('PRAGMA journal_mode=WAL')
+        _con.execute(
+            'CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, '
+            'value TEXT NOT NULL, exp INTEGER NOT NULL DEFAULT 0) '
+            'WITHOUT ROWID'.format(self.table))
+        _con.execute(
+            'CREATE INDEX IF NOT EXISTS {0}_exp ON {0} (exp) '
+            'WHERE exp > 0'.format(self.table))
+
+    def _connection(self):
+        """
+        Get the connection belonging to this thread. A connection is never
+        used across a fork.
+
+        :return: A :py:class:`sqlite3.Connection` instance
+        """
+        _pid = os.getpid()
+        try:
+            pid, con = self._local.connection
+        except AttributeError:
+            pass
+        else:
+            if pid == _pid:
+                return con
+
+        # autocommit, every statement is its own transaction
+        con = sqlite3.connect(self.db_name, timeout=self.timeout,
+                              isolation_level=None)
+        # Safe in WAL mode and much cheaper than FULL
+        con.execute('PRAGMA synchronous=NORMAL')
+        self._local.connection = (_pid, con)
+        return con
+
+    def __getitem__(self, key):
+        _con = self._connection()
+        _row = _con.execute(
+            'SELECT value, exp FROM {} WHERE key = ?'.format(self.table),
+            (key,)).fetchone()
+        if _row is None:
+            raise KeyError(key)
+
+        value, exp = _row
+        if exp and exp <= _now():
+            _con.execute(
+                'DELETE FROM {} WHERE key = ? AND exp = ?'.format(self.table),
+                (key, exp))
+            raise KeyError(key)
+
+        return self.serializer.loads(value)
+
+    def __delitem__(self, key):
+        _cur = self._connection().execute(
+            'DELETE FROM {} WHERE key = ?'.format(self.table), (key,))
+        if _cur.rowcount == 0:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        _row = self._connection().execute(
+            'SELECT 1 FROM {} WHERE key = ? AND (exp = 0 OR exp > ?)'.format(
+                self.table), (key, _now())).fetchone()
+        return _row is not None
+
+    def set(self, key, value, exp=0):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO {} (key, value, exp) VALUES (?, ?, ?)'.format(
+                self.table), (key, self.serializer.dumps(value), exp))
+
+    def keys(self):
+        return [row[0] for row in self._connection().execute(
+            'SELECT key FROM {}'.format(self.table))]
+
+    def expire(self, now=0, limit=100):
+        if not now:
+            now = _now()
+
+        _cur = self._connection().execute(
+            'DELETE FROM {0} WHERE key IN (SELECT key FROM {0} WHERE exp > 0 '
+            'AND exp <= ? LIMIT ?)'.format(self.table), (now, limit))
+        return _cur.rowcount
+
+    def close(self):
+        try:
+            pid, con = self._local.connection
+        except AttributeError:
+            pass
+        else:
+            if pid == os.getpid():
+                con.close()
+            del self._local.connection
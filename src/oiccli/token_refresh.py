@@ -0,0 +1,209 @@
+import heapq
+import logging
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from oicmsg.oauth2 import ErrorResponse
+from oicmsg.time_util import utc_time_sans_frac
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshScheduler(object):
+    """
+    Refreshes access tokens shortly before they expire, such that a user
+    of the access token never has to wait for a refresh.
+
+    The scheduler is told about new access tokens by the state database
+    (:py:attr:`oiccli.state.State.on_token_update`) and keeps the
+    expiration times in a heap, so the next token to refresh is always
+    known. The refreshes are done by the RefreshAccessToken service of the
+    client using a bounded number of worker threads.
+    """
+
+    def __init__(self, client, margin=60, jitter=10, max_workers=4,
+                 request_type='refresh_token', authn_method=''):
+        """
+        :param client: A :py:class:`oiccli.oauth2.Client` instance
+        :param margin: How many seconds before expiration a token should
+            be refreshed
+        :param jitter: A random number of seconds, at most this large, is
+            added to the margin so that tokens that expire at the same time
+            are not all refreshed at the same time.
+        :param max_workers: The maximum number of refreshes done at the
+            same time.
+        :param request_type: The name of the refresh service
+        :param authn_method: Client authentication method to use. If not
+            given the one registered for the token endpoint is used.
+        """
+        self.client = client
+        self.margin = margin
+        self.jitter = jitter
+        self.max_workers = max_workers
+        self.request_type = request_type
+        self.authn_method = authn_method
+
+        self._heap = []
+        self._scheduled = {}
+        self._in_flight = set()
+        self._cond = threading.Condition()
+        self._stop = False
+        self._thread = None
+        self._executor = None
+
+        self.state_db.on_token_update.append(self.track)
+
+    @property
+    def state_db(self):
+        return self.client.client_info.state_db
+
+    def track(self, state, token_info):
+        """
+        Schedule a refresh of the access token bound to a state value.
+        A new expiration time for the same state value replaces the old one.
+
+        :param state: The state value
+        :param token_info: Token information as stored by
+            :py:meth:`oiccli.state.State.update_token_info`
+        """
+        try:
+            _exp = token_info['exp']
+        except KeyError:
+            return
+
+        _due = _exp - self.margin - random.uniform(0, self.jitter)
+        with self._cond:
+            self._scheduled[state] = _exp
+            heapq.heappush(self._heap, (_due, _exp, state))
+            self._cond.notify()
+
+    def untrack(self, state):
+        """
+        Stop refreshing the access token bound to a state value.
+
+        :param state: The state value
+        """
+        with self._cond:
+            try:
+                del self._scheduled[state]
+            except KeyError:
+                pass
+
+    def pending(self, now=0):
+        """
+        Remove and return the state values whose access token are due to be
+        refreshed.
+
+        :param now: The present time, seconds since epoch
+        :return: List of state values
+        """
+        if not now:
+            now = utc_time_sans_frac()
+
+        _due = []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                _, _exp, state = heapq.heappop(self._heap)
+                # Skip entries that have been replaced or removed
+                if self._scheduled.get(state) != _exp:
+                    continue
+                del self._scheduled[state]
+                if state not in self._in_flight:
+                    _due.append(state)
+        return _due
+
+    def _authn_method(self):
+        if self.authn_method:
+            return self.authn_method
+
+        try:
+            return self.client.client_info.registration_response[
+                'token_endpoint_auth_method']
+        except (KeyError, TypeError):
+            return 'client_secret_basic'
+
+    def refresh(self, state):
+        """
+        Refresh the access token bound to a state value.
+
+        :param state: The state value
+        :return: The response from the token endpoint or None if no
+            refresh was attempted.
+        """
+        with self._cond:
+            if state in self._in_flight:
+                return None
+            self._in_flight.add(state)
+
+        try:
+            try:
+                _state_info = self.state_db[state]
+            except KeyError:
+                logger.info('No state information for {}'.format(state))
+                return None
+
+            if 'refresh_token' not in _state_info:
+                logger.info('No refresh token for {}'.format(state))
+                return None
+
+            resp = self.client.do_request(self.request_type, state=state,
+                                          authn_method=self._authn_method())
+
+            if isinstance(resp, ErrorResponse):
+                logger.warning(
+                    'Refresh for {} failed: {}'.format(state, resp.to_dict()))
+            elif 'access_token' in resp:
+                # Will schedule the next refresh through on_token_update
+                self.state_db.add_response(resp, state=state)
+            return resp
+        except Exception as err:
+            logger.error('Refresh for {} failed: {}'.format(state, err))
+            return None
+        finally:
+            with self._cond:
+                self._in_flight.discard(state)
+
+    def run(self):
+        """
+        Wait for the next token to become due and hand it over to a
+        worker thread.
+        """
+        while True:
+            with self._cond:
+                while not self._stop:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    _wait = self._heap[0][0] - utc_time_sans_frac()
+                    if _wait <= 0:
+                        break
+                    self._cond.wait(_wait)
+
+                if self._stop:
+                    return
+
+            for state in self.pending():
+                self._executor.submit(self.refresh, state)
+
+    def start(self):
+        self._stop = False
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._thread = threading.Thread(target=self.run,
+                                        name='RefreshScheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
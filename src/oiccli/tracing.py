@@ -0,0 +1,272 @@
+import functools
+import inspect
+import logging
+import threading
+import time
+from collections import deque
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+"""
+Spans around the phases of constructing a request and parsing the
+response, see :py:mod:`oiccli.service`, and around each of the service
+specific methods run in those phases.
+
+A tracer is anything with a span(name, attributes) method returning a
+context manager. :py:class:`Tracer` keeps the spans in memory,
+:py:class:`OpenTelemetryTracer` hands them to OpenTelemetry, which then
+is the only place where that package is needed. Services without a tracer
+don't create any spans.
+"""
+
+
+class _NoSpan(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+# What is used instead of a span when there is no tracer
+NO_SPAN = _NoSpan()
+
+
+class Span(object):
+    def __init__(self, name, attributes=None, parent=None, start=0):
+        """
+        :param name: What is done, typically the name of a phase
+        :param attributes: Dictionary with information about the span
+        :param parent: The span this span is part of
+        :param start: When the span started
+        """
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.parent = parent
+        self.start = start
+        self.end = 0
+        # The name of the exception type and the message, if the span
+        # ended with an exception. Not the exception itself, that would
+        # keep its traceback and all the frames in it alive.
+        self.error_type = None
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def to_dict(self):
+        _dict = {'name': self.name, 'attributes': self.attributes,
+                 'start': self.start, 'duration': self.duration}
+        if self.parent is not None:
+            _dict['parent'] = self.parent.name
+        if self.error is not None:
+            _dict['error'] = '{}: {}'.format(self.error_type, self.error)
+        return _dict
+
+
+class _ThreadCurrent(object):
+    """
+    Keeps the current span per thread, used where context variables are
+    not available.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def get(self):
+        return getattr(self._local, 'span', None)
+
+    def set(self, span):
+        _prev = self.get()
+        self._local.span = span
+        return _prev
+
+    def reset(self, prev):
+        self._local.span = prev
+
+
+class _ContextCurrent(object):
+    """
+    Keeps the current span in a context variable, which also works for
+    coroutines running in the same thread.
+    """
+
+    def __init__(self):
+        self._var = ContextVar('oiccli_span', default=None)
+
+    def get(self):
+        return self._var.get()
+
+    def set(self, span):
+        return self._var.set(span)
+
+    def reset(self, token):
+        self._var.reset(token)
+
+
+class _SpanContext(object):
+    def __init__(self, tracer, span):
+        self.tracer = tracer
+        self.span = span
+        self._token = None
+
+    def __enter__(self):
+        self.span.start = self.tracer.clock()
+        self._token = self.tracer._current.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.span.end = self.tracer.clock()
+        if exc_val is not None:
+            self.span.error_type = type(exc_val).__name__
+            self.span.error = str(exc_val)
+        self.tracer._current.reset(self._token)
+        self.tracer.finished(self.span)
+        return False
+
+
+class Tracer(object):
+    """
+    Keeps the latest finished spans in memory and, if given, calls a
+    function with each span as it's finished.
+    """
+
+    def __init__(self, max_spans=1000, callback=None, clock=time.monotonic):
+        """
+        :param max_spans: How many finished spans to keep
+        :param callback: A function that is called with each finished
+            :py:class:`Span`
+        :param clock: Function returning the present time in seconds
+        """
+        self.callback = callback
+        self.clock = clock
+        self._spans = deque(maxlen=max_spans)
+        if ContextVar is None:
+            self._current = _ThreadCurrent()
+        else:
+            self._current = _ContextCurrent()
+
+    def current(self):
+        """
+        :return: The span that is active or None
+        """
+        return self._current.get()
+
+    def span(self, name, attributes=None):
+        """
+        :param name: The name of the span
+        :param attributes: Dictionary with information about the span
+        :return: A context manager, the span is started when it's entered
+            and finished when it's exited.
+        """
+        return _SpanContext(self, Span(name, attributes,
+                                       parent=self._current.get()))
+
+    def finished(self, span):
+        self._spans.append(span)
+        if self.callback is not None:
+            try:
+                self.callback(span)
+            except Exception as err:
+                logger.warning('Tracer callback failed: {}'.format(err))
+
+    def spans(self):
+        """
+        :return: The finished spans, oldest first
+        """
+        return list(self._spans)
+
+    def clear(self):
+        self._spans.clear()
+
+
+class OpenTelemetryTracer(object):
+    """
+    Creates OpenTelemetry spans. Requires the opentelemetry-api package.
+    The spans become children of whatever span is current when a request
+    is constructed or sent, for instance the span of an incoming HTTP
+    request.
+    """
+
+    def __init__(self, tracer=None, name='oiccli'):
+        """
+        :param tracer: An OpenTelemetry tracer. If not given one is
+            gotten from the global tracer provider.
+        :param name: The instrumentation name used when getting a tracer
+        """
+        if tracer is None:
+            if otel_trace is None:
+                raise ImportError(
+                    'OpenTelemetryTracer requires opentelemetry-api')
+            tracer = otel_trace.get_tracer(name)
+        self.tracer = tracer
+
+    def span(self, name, attributes=None):
+        return self.tracer.start_as_current_span(name, attributes=attributes)
+
+
+_active = threading.local()
+
+
+def traced(name):
+    """
+    Decorator for methods of classes that have a tracer attribute and a
+    _span method, like :py:class:`oiccli.service.Service`, that runs the
+    method in a span. A method overriding a traced method, and calling
+    it, gives one span not two. Coroutine methods can be decorated too but
+    the span they get is always a new one.
+
+    :param name: The name of the span
+    """
+
+    def _decorate(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def _async_wrapper(self, *args, **kwargs):
+                if self.tracer is None:
+                    return await func(self, *args, **kwargs)
+                with self._span(name):
+                    return await func(self, *args, **kwargs)
+
+            return _async_wrapper
+
+        @functools.wraps(func)
+        def _wrapper(self, *args, **kwargs):
+            if self.tracer is None:
+                return func(self, *args, **kwargs)
+
+            try:
+                _spans = _active.spans
+            except AttributeError:
+                _spans = _active.spans = set()
+
+            _key = (id(self), name)
+            if _key in _spans:
+                return func(self, *args, **kwargs)
+
+            _spans.add(_key)
+            try:
+                with self._span(name):
+                    return func(self, *args, **kwargs)
+            finally:
+                _spans.discard(_key)
+
+        return _wrapper
+
+    return _decorate
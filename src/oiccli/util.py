@@ -1,4 +1,5 @@
 import logging
+import time
 from urllib.parse import parse_qs
 from urllib.parse import urlsplit
 from urllib.parse import urlunsplit
@@ -7,6 +8,7 @@ from six import string_types
 from future.backports.http.cookiejar import Cookie
 from future.backports.http.cookiejar import http2time
 
+from oiccli import LazyFormat
 from oiccli import sanitize
 from oiccli.exception import TimeFormatError
 from oiccli.exception import WrongContentType
@@ -99,14 +101,66 @@ def get_or_post(uri, method, req, content_type=DEFAULT_POST_CONTENT_TYPE,
     return resp
 
 
-def set_cookie(cookiejar, kaka):
+# Second level domains that, under a two letter country code top level
+# domain, are shared by unrelated sites. The same list as in
+# http.cookiejar.DefaultCookiePolicy.
+SHARED_SLDS = ["co", "ac", "com", "edu", "org", "net", "gov", "mil", "int",
+               "aero", "biz", "cat", "coop", "info", "jobs", "mobi", "museum",
+               "name", "pro", "travel", "eu"]
+
+
+def public_domain(domain):
+    """
+    :param domain: A cookie domain, with or without a leading dot
+    :return: True if the domain has no embedded dot, like com, or is a
+        public second level domain, like co.uk. No site may set cookies
+        for such a domain.
+    """
+    _labels = domain.lstrip('.').lower().split('.')
+    if len(_labels) < 2 or not all(_labels):
+        return True
+    return len(_labels) == 2 and len(_labels[1]) == 2 and \
+        _labels[0] in SHARED_SLDS
+
+
+def domain_match(host, domain):
+    """
+    :param host: A host name
+    :param domain: A cookie domain, with or without a leading dot
+    :return: True if a cookie for the domain may be sent to the host
+    """
+    domain = domain.lstrip('.').lower()
+    if host == domain:
+        return True
+    return host.endswith('.' + domain) and not public_domain(domain)
+
+
+def path_match(path, cookie_path):
+    """
+    :param path: The path of a request
+    :param cookie_path: The path of a cookie
+    :return: True if the cookie may be sent with the request
+    """
+    if not cookie_path or cookie_path == '/':
+        return True
+    if not path.startswith(cookie_path):
+        return False
+    return cookie_path.endswith('/') or len(path) == len(cookie_path) or \
+        path[len(cookie_path)] == '/'
+
+
+def set_cookie(cookiejar, kaka, request_host=''):
     """PLaces a cookie (a cookielib.Cookie based on a set-cookie header
     line) in the cookie jar.
     Always chose the shortest expires time.
 
     :param cookiejar:
     :param kaka: Cookie
+    :param request_host: The host that sent the cookie. If given, cookies
+        without a domain are bound to this host and cookies for a domain
+        the host doesn't belong to are ignored.
     """
+    request_host = request_host.lower()
 
     # default rfc2109=False
     # max-age, httponly
@@ -148,6 +202,15 @@ def set_cookie(cookiejar, kaka):
         if std_attr["domain"] and std_attr["domain"].startswith("."):
             std_attr["domain_initial_dot"] = True
 
+        if request_host:
+            if not std_attr["domain"]:
+                # A host-only cookie
+                std_attr["domain"] = request_host
+            elif not domain_match(request_host, std_attr["domain"]):
+                logger.info("Ignored cookie for {} set by {}".format(
+                    sanitize(std_attr["domain"]), request_host))
+                continue
+
         if morsel["max-age"] is 0:
             try:
                 cookiejar.clear(domain=std_attr["domain"],
@@ -168,6 +231,53 @@ def set_cookie(cookiejar, kaka):
             cookiejar.set_cookie(new_cookie)
 
 
+def cookies_for(cookiejar, url, now=0):
+    """
+    Find the cookies that should be sent with a request. Uses the
+    cookie jar's index on domain so only the cookies for the host and
+    the domains it belongs to are looked at.
+
+    :param cookiejar: A :py:class:`http.cookiejar.CookieJar` instance
+    :param url: The URL the request is sent to
+    :param now: The present time, seconds since epoch
+    :return: Dictionary with cookie names as keys and cookie values as
+        values
+    """
+    _part = urlsplit(url)
+    _host = (_part.hostname or '').lower()
+    _path = _part.path or '/'
+    _secure = _part.scheme == 'https'
+    if not now:
+        now = int(time.time())
+
+    _index = cookiejar._cookies
+    _labels = _host.split('.')
+    res = {}
+    # From the widest domain to the host so the most specific cookie wins
+    for i in range(len(_labels) - 1, -1, -1):
+        _domain = '.'.join(_labels[i:])
+        for key in ['.' + _domain, _domain]:
+            try:
+                _paths = _index[key]
+            except KeyError:
+                continue
+
+            for cookie_path, cookies in _paths.items():
+                if not path_match(_path, cookie_path):
+                    continue
+                for cookie in cookies.values():
+                    # Host-only cookies are only sent to that host
+                    if i and not (cookie.domain_specified or
+                                  cookie.domain_initial_dot):
+                        continue
+                    if cookie.secure and not _secure:
+                        continue
+                    if cookie.is_expired(now):
+                        continue
+                    res[cookie.name] = cookie.value
+    return res
+
+
 def match_to_(val, vlist):
     if isinstance(vlist, string_types):
         if vlist.startswith(val):
@@ -206,8 +316,8 @@ def verify_header(reqresp, body_type):
     :param body_type: If information returned in the body part 
     :return: Verified body content type
     """
-    logger.debug("resp.headers: %s" % (sanitize(reqresp.headers),))
-    logger.debug("resp.txt: %s" % (sanitize(reqresp.text),))
+    logger.debug(LazyFormat("resp.headers: {}", reqresp.headers))
+    logger.debug(LazyFormat("resp.txt: {}", reqresp.text))
 
     try:
         _ctype = reqresp.headers["content-type"]
@@ -217,7 +327,7 @@ def verify_header(reqresp, body_type):
         else:
             return 'txt'  # reasonable default ??
 
-    logger.debug('Expected body type: "{}"'.format(body_type))
+    logger.debug(LazyFormat('Expected body type: "{}"', body_type))
 
     if body_type == "":
         if match_to_("application/json", _ctype) or match_to_(
@@ -255,7 +365,7 @@ def verify_header(reqresp, body_type):
     else:
         raise ValueError("Unknown return format: %s" % body_type)
 
-    logger.debug('Got body type: "{}"'.format(body_type))
+    logger.debug(LazyFormat('Got body type: "{}"', body_type))
     return body_type
 
 
@@ -1,4 +1,5 @@
 import json
+import logging
 
 import pytest
 
@@ -9,6 +10,9 @@ from urllib.parse import parse_qs
 from urllib.parse import urlparse
 
 from oiccli.exception import WrongContentType
+from oiccli import LazyFormat
+from oiccli import REDACTED
+from oiccli import sanitize
 from oiccli import util
 from oiccli.util import JSON_ENCODED
 
@@ -167,6 +171,62 @@ def test_set_cookie():
     assert c_2.value == "v_2"
 
 
+def test_set_cookie_request_host():
+    cookiejar = FileCookieJar()
+    c = SimpleCookie()
+    c.load('host=1; Path=/')
+    util.set_cookie(cookiejar, c, 'op.example.org')
+    c = SimpleCookie()
+    c.load('wide=2; Domain=example.org; Path=/')
+    util.set_cookie(cookiejar, c, 'op.example.org')
+    c = SimpleCookie()
+    c.load('other=3; Domain=example.com; Path=/')
+    util.set_cookie(cookiejar, c, 'op.example.org')
+
+    assert set(cookiejar._cookies.keys()) == {'op.example.org', 'example.org'}
+
+
+def test_set_cookie_public_domain():
+    cookiejar = FileCookieJar()
+    for host, cookie in [('op.example.org', 'tld=1; Domain=org'),
+                         ('op.example.org', 'dot=2; Domain=.org'),
+                         ('op.example.co.uk', 'sld=3; Domain=co.uk'),
+                         ('op.example.co.uk', 'ok=4; Domain=example.co.uk')]:
+        c = SimpleCookie()
+        c.load(cookie)
+        util.set_cookie(cookiejar, c, host)
+
+    assert set(cookiejar._cookies.keys()) == {'example.co.uk'}
+    assert util.public_domain('.com')
+    assert util.public_domain('ac.jp')
+    assert not util.public_domain('example.com')
+
+
+def test_cookies_for():
+    cookiejar = FileCookieJar()
+    for host, cookie in [('op.example.org', 'host=1; Path=/'),
+                         ('op.example.org', 'wide=2; Domain=.example.org'),
+                         ('op.example.org', 'auth=3; Path=/auth'),
+                         ('op.example.org', 'sec=4; Secure'),
+                         ('op.example.org', 'old=5; Domain=example.org; '
+                                            'Expires=Wed, 09 Feb 1994 '
+                                            '22:23:32 GMT'),
+                         ('example.org', 'top=6')]:
+        c = SimpleCookie()
+        c.load(cookie)
+        util.set_cookie(cookiejar, c, host)
+
+    assert util.cookies_for(cookiejar, 'https://op.example.org/auth/x') == {
+        'host': '1', 'wide': '2', 'auth': '3', 'sec': '4'}
+    assert util.cookies_for(cookiejar, 'http://op.example.org/authz') == {
+        'host': '1', 'wide': '2'}
+    assert util.cookies_for(cookiejar, 'https://rp.example.org/') == {
+        'wide': '2'}
+    assert util.cookies_for(cookiejar, 'https://example.org/') == {
+        'wide': '2', 'top': '6'}
+    assert util.cookies_for(cookiejar, 'https://example.com/') == {}
+
+
 def test_match_to():
     str0 = "abc"
     str1 = "123"
@@ -211,3 +271,33 @@ def test_verify_header():
 
     with pytest.raises(ValueError):
         util.verify_header(FakeResponse(json_header), "undefined")
+
+
+def test_sanitize():
+    assert sanitize('code=abc&state=xyz') == 'code={}&state=xyz'.format(
+        REDACTED)
+    assert json.loads(sanitize(json.dumps(
+        {'access_token': 'abc', 'token_type': 'Bearer'}))) == {
+        'access_token': REDACTED, 'token_type': 'Bearer'}
+    assert sanitize({'headers': {'Authorization': 'Basic abc'},
+                     'data': 'client_secret=abc'}) == {
+        'headers': {'Authorization': REDACTED},
+        'data': 'client_secret={}'.format(REDACTED)}
+    assert sanitize('request_uri=https://example.com&response_code=1') == \
+        'request_uri=https://example.com&response_code=1'
+
+
+def test_lazy_format(caplog):
+    class Expensive(object):
+        def to_dict(self):
+            raise AssertionError('Should not be called')
+
+    logger = logging.getLogger('oiccli.test')
+    with caplog.at_level(logging.INFO, logger='oiccli.test'):
+        logger.debug(LazyFormat('response: {}', Expensive()))
+    assert caplog.records == []
+
+    with caplog.at_level(logging.DEBUG, logger='oiccli.test'):
+        logger.debug(LazyFormat('response: {}', {'code': 'abc'}))
+    _msg = caplog.records[0].getMessage()
+    assert _msg == "response: {{'code': '{}'}}".format(REDACTED)
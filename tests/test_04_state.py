@@ -1,5 +1,9 @@
 import pytest
 from oiccli.state import State, ExpiredToken
+from oiccli.state import StateLess
+from oiccli.state import UnknownState
+from oicmsg.key_jar import build_keyjar
+from oicmsg.key_jar import public_keys_keyjar
 from oicmsg.oauth2 import AuthorizationRequest, AccessTokenRequest
 from oicmsg.oauth2 import AuthorizationResponse
 from oicmsg.oauth2 import AccessTokenResponse
@@ -204,4 +208,72 @@ class TestState(object):
 
         resp_args = self.state_db.get_response_args(state, AccessTokenRequest)
 
-        assert set(resp_args.keys()) == {'code', 'client_id', 'redirect_uri'}
\ No newline at end of file
+        assert set(resp_args.keys()) == {'code', 'client_id', 'redirect_uri'}
+
+
+ISSUER = 'https://example.com/rp'
+KEYSPEC = [
+    {"type": "RSA", "use": ["sig"]},
+    {"type": "EC", "crv": "P-256", "use": ["enc"]},
+]
+
+
+class TestStateLess(object):
+    @pytest.fixture(autouse=True)
+    def create_state_db(self):
+        _keyjar = build_keyjar(KEYSPEC)[1]
+        public_keys_keyjar(_keyjar, '', _keyjar, ISSUER)
+        self.state_db = StateLess(ISSUER, keyjar=_keyjar)
+
+    def test_create_state(self):
+        request = AuthorizationRequest(**REQ_ARGS)
+        state = self.state_db.create_state(receiver='https://example.org/op',
+                                           request=request)
+        # A JWE has 5 parts
+        assert len(state.split('.')) == 5
+        _info = self.state_db[state]
+        for key, val in REQ_ARGS.items():
+            assert _info[key] == val
+        assert _info['as'] == 'https://example.org/op'
+
+    def test_unknown_state(self):
+        with pytest.raises(UnknownState):
+            self.state_db['abcdef']
+
+    def test_add_response(self):
+        request = AuthorizationRequest(**REQ_ARGS)
+        state = self.state_db.create_state(receiver='https://example.org/op',
+                                           request=request)
+        aresp = AuthorizationResponse(code="access grant", state=state)
+        self.state_db.add_response(aresp)
+
+        aresp = AccessTokenResponse(access_token='access token',
+                                    token_type='Bearer', expires_in=600)
+        self.state_db.add_response(aresp, state=state)
+
+        assert self.state_db[state]['code'] == 'access grant'
+        assert self.state_db[state]['redirect_uri'] == REQ_ARGS['redirect_uri']
+        _tinfo = self.state_db.get_token_info(state)
+        assert _tinfo['access_token'] == 'access token'
+
+    def test_shared_keys(self):
+        request = AuthorizationRequest(**REQ_ARGS)
+        state = self.state_db.create_state(receiver='https://example.org/op',
+                                           request=request)
+        # Another instance with the same keys but no shared storage
+        other = StateLess(ISSUER, keyjar=self.state_db.keyjar)
+        assert other[state]['response_type'] == 'code'
+
+    def test_expired_state(self):
+        request = AuthorizationRequest(**REQ_ARGS)
+        state = self.state_db.create_state(receiver='https://example.org/op',
+                                           request=request)
+        assert self.state_db._unpack(state)
+        with pytest.raises(UnknownState):
+            self.state_db._unpack(state, now=utc_time_sans_frac() + 601)
+
+    def test_expiration(self):
+        assert self.state_db._expiration({'iat': 1000}) == 1600
+        assert self.state_db._expiration({'iat': 1000, 'exp': 1200}) == 1200
+        assert self.state_db._expiration({'iat': 1000, 'exp': 9000}) == 1600
+        assert self.state_db._expiration({}) == 0
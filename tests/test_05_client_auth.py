@@ -11,6 +11,7 @@ from cryptojwt.jwt import JWT
 
 from oiccli import JWT_BEARER
 from oiccli.client_auth import assertion_jwt
+from oiccli.client_auth import AssertionPool
 from oiccli.client_auth import BearerBody
 from oiccli.client_auth import BearerHeader
 from oiccli.client_auth import CLIENT_AUTHN_METHOD
@@ -249,6 +250,77 @@ class TestPrivateKeyJWT(object):
         assert request['client_assertion_type'] == JWT_BEARER
 
 
+class TestAssertionPool(object):
+    @pytest.fixture(autouse=True)
+    def create_pool(self):
+        _key = rsa_load(os.path.join(BASE_PATH, "data/keys/rsa.key"))
+        self.kb = KeyBundle([{"key": _key, "kty": "RSA", "use": "sig"}])
+        self.pool = AssertionPool(size=3)
+
+    def test_inline_when_empty(self):
+        _ca = self.pool.get(CLIENT_ID, self.kb.get('RSA'),
+                            "https://example.com/token", 'RS256')
+        jso = JWT(rec_keys={CLIENT_ID: self.kb.get('RSA')}).unpack(_ca)
+        assert jso['aud'] == ["https://example.com/token"]
+
+    def test_refill(self):
+        _keys = self.kb.get('RSA')
+        self.pool.get(CLIENT_ID, _keys, "https://example.com/token", 'RS256')
+        assert self.pool.refill() == 3
+        assert self.pool.refill() == 0
+
+        _jtis = set()
+        for _ in range(3):
+            _ca = self.pool.get(CLIENT_ID, _keys, "https://example.com/token",
+                                'RS256')
+            _jtis.add(JWT(rec_keys={CLIENT_ID: _keys}).unpack(_ca)['jti'])
+        # Each assertion handed out once
+        assert len(_jtis) == 3
+        assert self.pool.refill() == 3
+
+    def test_near_expiry_discarded(self):
+        _keys = self.kb.get('RSA')
+        self.pool.get(CLIENT_ID, _keys, "https://example.com/token", 'RS256',
+                      lifetime=30)
+        self.pool.refill()
+        # lifetime is shorter than min_remaining
+        assert self.pool.refill() == 3
+
+    def test_pool_key(self):
+        _keys = self.kb.get('RSA')
+        _pool_key = self.pool.pool_key(CLIENT_ID, _keys,
+                                       "https://example.com/token", 'RS256',
+                                       600)
+        # The same key in a new object
+        _kb = KeyBundle([{"key": _keys[0].key, "kty": "RSA", "use": "sig"}])
+        assert self.pool.pool_key(CLIENT_ID, _kb.get('RSA'),
+                                  "https://example.com/token", 'RS256',
+                                  600) == _pool_key
+        _other = [SYMKey(k=b64e(b'another-signing-key'), use='sig')]
+        assert self.pool.pool_key(CLIENT_ID, _other,
+                                  "https://example.com/token", 'RS256',
+                                  600) != _pool_key
+
+    def test_construct_with_pool(self, client):
+        client.client_info.keyjar[""] = self.kb
+        client.client_info.provider_info = {
+            'issuer': 'https://example.com/',
+            'token_endpoint': "https://example.com/token"}
+        client.client_info.assertion_pool = self.pool
+
+        pkj = PrivateKeyJWT()
+        request = AccessTokenRequest()
+        pkj.construct(request, cli_info=client.client_info, algorithm="RS256",
+                      authn_endpoint='token')
+        self.pool.refill()
+        request = AccessTokenRequest()
+        pkj.construct(request, cli_info=client.client_info, algorithm="RS256",
+                      authn_endpoint='token')
+        assert request['client_assertion_type'] == JWT_BEARER
+        _pool = list(self.pool._pools.values())[0]
+        assert len(_pool['queue']) == 2
+
+
 class TestClientSecretJWT_TE(object):
     def test_client_secret_jwt(self, client):
         _ci = client.client_info
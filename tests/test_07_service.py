@@ -1,5 +1,8 @@
+import asyncio
+
 import pytest
 from oiccli.exception import WrongContentType
+from oiccli.metrics import Metrics
 from oiccli.oauth2 import ClientInfo
 from oicmsg.oauth2 import ErrorResponse
 from oicmsg.oauth2 import Message
@@ -7,6 +10,8 @@ from oicmsg.oauth2 import SINGLE_OPTIONAL_INT
 from oicmsg.oauth2 import SINGLE_OPTIONAL_STRING
 from oicmsg.oauth2 import SINGLE_REQUIRED_STRING
 from oiccli.service import Service
+from oiccli.service import ServiceRegistry
+from oiccli.tracing import Tracer
 
 
 class DummyMessage(Message):
@@ -24,6 +29,24 @@ class Response(object):
         self.headers = headers or {"content-type": "text/plain"}
 
 
+class AsyncHTTPLib(object):
+    def __init__(self, response):
+        self.response = response
+        self.calls = []
+
+    async def __call__(self, url, method="GET", **kwargs):
+        self.calls.append((url, method))
+        return self.response
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
 class DummyService(Service):
     msg_type = DummyMessage
 
@@ -48,6 +71,21 @@ class TestDummyService(object):
         assert isinstance(_req, Message)
         assert set(_req.keys()) == {'foo', 'req_str'}
 
+    def test_gather_request_args(self):
+        self.service.default_request_args = {'opt_str': 'default'}
+        assert self.service.gather_request_args(self.cli_info) == {
+            'opt_str': 'default'}
+
+        # Configuration changes are picked up
+        self.service.conf['request_args'] = {'opt_str': 'conf', 'opt_int': 1}
+        assert self.service.gather_request_args(self.cli_info) == {
+            'opt_str': 'conf', 'opt_int': 1}
+
+        # and so are changes to the client info
+        self.cli_info.opt_str = 'cli_info'
+        assert self.service.gather_request_args(
+            self.cli_info, opt_int=2) == {'opt_str': 'cli_info', 'opt_int': 2}
+
     def test_request_info(self):
         req_args = {'foo': 'bar', 'req_str': 'some string'}
         self.service.endpoint = 'https://example.com/authorize'
@@ -110,6 +148,82 @@ class TestDummyService(object):
                                                        response_body_type='json',
                                                        state='state')
 
+    def test_async_service_request(self):
+        req_resp = Response(200, Message(foo='bar').to_json(),
+                            headers={'content-type': 'application/json'})
+        self.service.httplib = AsyncHTTPLib(req_resp)
+        _coro = self.service.async_service_request(
+            'https://example.com/foo', client_info=self.cli_info,
+            state='state')
+        resp = run(_coro)
+        assert isinstance(resp, Message)
+        assert set(resp.keys()) == {'foo'}
+        assert self.service.httplib.calls == [('https://example.com/foo',
+                                               'GET')]
+
+    def test_async_service_request_post_parse_response(self):
+        _seen = []
+
+        def _post_parse(resp, cli_info, state='', **kwargs):
+            _seen.append(state)
+
+        self.service.post_parse_response.append(_post_parse)
+        req_resp = Response(200, Message(foo='bar').to_json(),
+                            headers={'content-type': 'application/json'})
+        self.service.httplib = AsyncHTTPLib(req_resp)
+        _coro = self.service.async_service_request(
+            'https://example.com/foo', client_info=self.cli_info,
+            state='state')
+        run(_coro)
+        assert _seen == ['state']
+
+    def test_http_request_args(self):
+        assert self.service.http_request_args() == {}
+        service = DummyService(conf={'timeout': (1, 2),
+                                     'http_method': 'POST'})
+        assert service.http_method == 'POST'
+        assert service.http_request_args({'headers': {}}, deadline=10) == {
+            'headers': {}, 'timeout': (1, 2), 'deadline': 10}
+        # The caller's timeout wins
+        assert service.http_request_args({'timeout': 5}) == {'timeout': 5}
+
+    def test_service_request_metrics(self):
+        metrics = Metrics()
+        service = DummyService(conf={'metrics': metrics})
+        responses = [
+            Response(200, Message(foo='bar').to_json(),
+                     headers={'content-type': 'application/json'}),
+            Response(400, ErrorResponse(error='invalid_request').to_json(),
+                     headers={'content-type': 'application/json'})]
+        service.httplib = lambda url, method, **kwargs: responses.pop(0)
+
+        for _ in range(2):
+            service.service_request('https://example.com/foo',
+                                    client_info=self.cli_info, state='state')
+        for outcome in ['ok', 'error_response']:
+            assert metrics.get('service_requests_total',
+                               service='DummyService', outcome=outcome) == 1
+
+    def test_service_request_tracing(self):
+        tracer = Tracer()
+        service = DummyService(conf={'tracer': tracer})
+        service.post_parse_response.append(
+            lambda resp, cli_info, state='', **kwargs: None)
+        service.httplib = lambda url, method, **kwargs: Response(
+            200, Message(foo='bar').to_json(),
+            headers={'content-type': 'application/json'})
+
+        service.service_request('https://example.com/foo',
+                                client_info=self.cli_info, state='state')
+        _spans = dict((s.name, s) for s in tracer.spans())
+        assert set(_spans.keys()) == {
+            'http', 'deserialize', 'verify', 'post_parse_response',
+            'parse_response', 'parse_request_response', 'service_request'}
+        assert _spans['http'].parent is _spans['service_request']
+        assert _spans['verify'].parent is _spans['parse_response']
+        assert _spans['post_parse_response'].attributes == {
+            'service': 'DummyService', 'hook': '<lambda>'}
+
 
 class TestRequest(object):
     @pytest.fixture(autouse=True)
@@ -123,3 +237,36 @@ class TestRequest(object):
         _req = self.service.construct(self.cli_info, request_args=req_args)
         assert isinstance(_req, Message)
         assert list(_req.keys()) == ['foo']
+
+
+class TestServiceRegistry(object):
+    @pytest.fixture(autouse=True)
+    def create_registry(self):
+        self.parent = ServiceRegistry()
+        self.parent.register(Service)
+        self.registry = ServiceRegistry(parent=self.parent)
+
+    def test_register_decorator(self):
+        @self.registry.register
+        class Dummy(Service):
+            pass
+
+        assert self.registry.get('Dummy') is Dummy
+        assert isinstance(self.registry.factory('Dummy'), Dummy)
+
+    def test_register_name(self):
+        @self.registry.register(name='other')
+        class Dummy(Service):
+            pass
+
+        assert 'other' in self.registry
+        assert 'Dummy' not in self.registry
+
+    def test_parent(self):
+        assert self.registry.get('Service') is Service
+        assert self.registry.names() == ['Service']
+
+    def test_unknown(self):
+        with pytest.raises(KeyError):
+            self.registry.get('Unknown')
+        assert self.registry.factory('Unknown') is None
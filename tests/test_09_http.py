@@ -0,0 +1,254 @@
+import time
+
+import pytest
+from requests import ConnectionError
+from requests import Response
+from requests.adapters import BaseAdapter
+
+from oiccli.breaker import HostGuard
+from oiccli.exception import CircuitOpen
+from oiccli.exception import DeadlineExceeded
+from oiccli.http import HTTPLib
+from oiccli.http import RetryPolicy
+from oiccli.http import deadline_timeout
+from oiccli.http import pooled_session
+from oiccli.metrics import Metrics
+
+__author__ = 'roland'
+
+
+class DummyAdapter(BaseAdapter):
+    def __init__(self, status_code=200, headers=None, text=''):
+        BaseAdapter.__init__(self)
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = text
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        self.sent.append(request)
+        resp = Response()
+        resp.status_code = self.status_code
+        resp.headers.update(self.headers)
+        resp._content = self.text.encode('utf-8')
+        resp.url = request.url
+        resp.request = request
+        return resp
+
+    def close(self):
+        pass
+
+
+class SequenceAdapter(BaseAdapter):
+    """
+    Returns, or raises, the items in a list one after the other.
+    """
+
+    def __init__(self, items):
+        BaseAdapter.__init__(self)
+        self.items = items
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        self.sent.append(request)
+        _item = self.items.pop(0)
+        if isinstance(_item, Exception):
+            raise _item
+
+        status_code, headers = _item
+        resp = Response()
+        resp.status_code = status_code
+        resp.headers.update(headers)
+        resp._content = b''
+        resp.url = request.url
+        resp.request = request
+        return resp
+
+    def close(self):
+        pass
+
+
+def test_session_is_reused():
+    httplib = HTTPLib()
+    _session = httplib.session
+    assert httplib.session is _session
+
+
+def test_shared_session():
+    session = pooled_session(pool_maxsize=2)
+    adapter = DummyAdapter(text='OK')
+    session.mount('https://', adapter)
+
+    lib1 = HTTPLib(session=session)
+    lib2 = HTTPLib(session=session)
+    assert lib1.session is lib2.session
+
+    lib1('https://op.example.org/foo')
+    lib2('https://op.example.org/bar')
+    assert len(adapter.sent) == 2
+
+
+def test_no_keep_alive():
+    session = pooled_session(keep_alive=False)
+    assert session.headers['Connection'] == 'close'
+
+
+def test_session_does_not_keep_cookies():
+    session = pooled_session()
+    adapter = DummyAdapter(headers={'set-cookie': 'foo=bar; Path=/'})
+    session.mount('https://', adapter)
+    httplib = HTTPLib(session=session)
+    httplib('https://op.example.org/foo')
+
+    assert len(session.cookies) == 0
+    assert httplib._cookies() == {'foo': 'bar'}
+
+
+def test_cookies_only_sent_to_matching_host():
+    session = pooled_session()
+    adapter = DummyAdapter(headers={'set-cookie': 'foo=bar; Path=/'})
+    session.mount('https://', adapter)
+    httplib = HTTPLib(session=session)
+    httplib('https://op.example.org/foo')
+    httplib('https://op.example.org/bar')
+    httplib('https://op.example.com/bar')
+
+    assert adapter.sent[1].headers['Cookie'] == 'foo=bar'
+    assert 'Cookie' not in adapter.sent[2].headers
+
+
+def test_deadline_timeout():
+    assert deadline_timeout((5, 30), 110, now=100) == (5, 10)
+    assert deadline_timeout(None, 110, now=100) == 10
+    assert deadline_timeout(3, 110, now=100) == 3
+    with pytest.raises(DeadlineExceeded):
+        deadline_timeout((5, 30), 100, now=100)
+
+
+def test_deadline():
+    session = pooled_session()
+    adapter = SequenceAdapter([(503, {'Retry-After': '10'}), (200, {})])
+    session.mount('https://', adapter)
+    httplib = HTTPLib(session=session, retry=RetryPolicy(sleep=lambda x: 0))
+
+    with pytest.raises(DeadlineExceeded):
+        httplib('https://op.example.org/jwks', deadline=time.time() - 1)
+    assert adapter.sent == []
+
+    # No retry after the deadline
+    resp = httplib('https://op.example.org/jwks', deadline=time.time() + 5)
+    assert resp.status_code == 503
+    assert len(adapter.sent) == 1
+
+
+def test_guard():
+    session = pooled_session()
+    adapter = SequenceAdapter([(503, {}), (200, {})])
+    session.mount('https://', adapter)
+    httplib = HTTPLib(session=session, guard=HostGuard(failure_threshold=1))
+
+    assert httplib('https://op.example.org/jwks').status_code == 503
+    with pytest.raises(CircuitOpen):
+        httplib('https://op.example.org/jwks')
+    assert len(adapter.sent) == 1
+
+
+def test_guard_metrics():
+    session = pooled_session()
+    adapter = SequenceAdapter([(503, {})])
+    session.mount('https://', adapter)
+    metrics = Metrics()
+    httplib = HTTPLib(session=session, metrics=metrics,
+                      guard=HostGuard(failure_threshold=1))
+
+    httplib('https://op.example.org/jwks')
+    for _ in range(2):
+        with pytest.raises(CircuitOpen):
+            httplib('https://op.example.org/jwks')
+    assert metrics.get('http_requests_rejected_total', host='op.example.org',
+                       reason='CircuitOpen') == 2
+    # Only the request that was sent
+    assert metrics.get('http_requests_total', host='op.example.org',
+                       method='GET', status='503') == 1
+    assert metrics.get('http_requests_total', host='op.example.org',
+                       method='GET', status='error') == 0
+
+
+def test_metrics():
+    session = pooled_session()
+    adapter = SequenceAdapter([(503, {}), ConnectionError('refused'),
+                               (200, {})])
+    session.mount('https://', adapter)
+    metrics = Metrics()
+    httplib = HTTPLib(session=session, metrics=metrics,
+                      retry=RetryPolicy(sleep=lambda x: 0))
+
+    assert httplib('https://OP.example.org/jwks').status_code == 200
+    for status in ['503', 'error', '200']:
+        assert metrics.get('http_requests_total', host='op.example.org',
+                           method='GET', status=status) == 1
+    assert metrics.get('http_errors_total', host='op.example.org',
+                       error='ConnectionError') == 1
+    _hist = metrics.histograms()[
+        ('http_request_duration_seconds', (('host', 'op.example.org'),))]
+    assert _hist['count'] == 3
+
+
+class TestRetry(object):
+    @pytest.fixture(autouse=True)
+    def create_httplib(self):
+        self.delays = []
+        self.retry = RetryPolicy(max_retries=2, sleep=self.delays.append)
+        self.session = pooled_session()
+        self.httplib = HTTPLib(session=self.session, retry=self.retry)
+
+    def mount(self, items):
+        adapter = SequenceAdapter(items)
+        self.session.mount('https://', adapter)
+        return adapter
+
+    def test_retry_status(self):
+        adapter = self.mount([(503, {}), (429, {'Retry-After': '2'}),
+                              (200, {})])
+        resp = self.httplib('https://op.example.org/jwks')
+        assert resp.status_code == 200
+        assert len(adapter.sent) == 3
+        assert 0 <= self.delays[0] <= 0.5
+        assert self.delays[1] == 2
+
+    def test_retry_connection_error(self):
+        adapter = self.mount([ConnectionError('refused'), (200, {})])
+        assert self.httplib('https://op.example.org/jwks').status_code == 200
+        assert len(adapter.sent) == 2
+
+    def test_give_up(self):
+        adapter = self.mount([(503, {}), (503, {}), (503, {})])
+        assert self.httplib('https://op.example.org/jwks').status_code == 503
+        assert len(adapter.sent) == 3
+
+        self.mount([ConnectionError('refused')] * 3)
+        with pytest.raises(ConnectionError):
+            self.httplib('https://op.example.org/jwks')
+
+    def test_max_time(self):
+        self.retry.max_time = 10
+        adapter = self.mount([(503, {'Retry-After': '60'}), (200, {})])
+        assert self.httplib('https://op.example.org/jwks').status_code == 503
+        assert len(adapter.sent) == 1
+
+    def test_not_idempotent(self):
+        adapter = self.mount([(503, {}), (200, {})])
+        resp = self.httplib('https://op.example.org/token', 'POST')
+        assert resp.status_code == 503
+        assert len(adapter.sent) == 1
+
+        adapter = self.mount([(503, {}), (200, {})])
+        resp = self.httplib('https://op.example.org/token', 'POST',
+                            idempotent=True)
+        assert resp.status_code == 200
+        assert len(adapter.sent) == 2
+
+    def test_retry_after_date(self):
+        _resp = Response()
+        _resp.headers['Retry-After'] = 'Thu, 01 Jan 1970 00:01:40 GMT'
+        assert RetryPolicy.retry_after(_resp, now=40) == 60
@@ -79,3 +79,59 @@ class TestClient(object):
                                  'client_secret': 'abcdefghijklmnop',
                                  'grant_type': 'refresh_token',
                                  'refresh_token': 'refresh_with_me'}
+
+
+class TokenResponse(object):
+    def __init__(self, text):
+        self.status_code = 200
+        self.text = text
+        self.headers = {'content-type': 'application/json'}
+
+
+class TokenEndpoint(object):
+    def __init__(self):
+        self.requests = []
+
+    def __call__(self, url, method='GET', data=None, **kwargs):
+        self.requests.append(data)
+        _req = RefreshAccessTokenRequest().from_urlencoded(data)
+        return TokenResponse(
+            AccessTokenResponse(access_token=_req['refresh_token'],
+                                token_type='Bearer').to_json())
+
+
+class TestBatch(object):
+    @pytest.fixture(autouse=True)
+    def create_client(self):
+        conf = {
+            'redirect_uris': ['https://example.com/cli/authz_cb'],
+            'client_id': 'client_1',
+            'client_secret': 'abcdefghijklmnop'
+        }
+        self.http = TokenEndpoint()
+        self.client = Client(client_authn_method=CLIENT_AUTHN_METHOD,
+                             config=conf, httplib=self.http)
+        self.client.service['refresh_token'].endpoint = \
+            'https://example.com/token'
+        for state in ['A', 'B', 'C']:
+            self.client.client_info.state_db[state] = {'code': 'code'}
+            self.client.client_info.state_db.add_response(
+                AccessTokenResponse(refresh_token='refresh_' + state,
+                                    access_token='access', token_type='Bearer'),
+                state)
+
+    def test_do_batch(self):
+        items = [('refresh_token', state, None) for state in 'ABXC']
+        res = list(self.client.do_batch(items, max_workers=2))
+        assert [r.state for r in res] == ['A', 'B', 'X', 'C']
+        assert [r.ok for r in res] == [True, True, False, True]
+        assert isinstance(res[0].response, AccessTokenResponse)
+        assert res[2].response is None
+        assert len(self.http.requests) == 3
+
+    def test_do_batch_unordered(self):
+        items = (('refresh_token', state, None) for state in 'ABC')
+        res = list(self.client.do_batch(items, max_workers=3, ordered=False))
+        assert sorted(r.index for r in res) == [0, 1, 2]
+        for r in res:
+            assert r.response['access_token'] == 'refresh_' + r.state
@@ -1,5 +1,7 @@
 import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 from oiccli.state import UnknownState
@@ -7,6 +9,9 @@ from oicmsg.jwt import JWT
 from oicmsg.key_jar import build_keyjar
 from oicmsg.key_jar import public_keys_keyjar
 
+from oiccli.cache import VerifiedJWTCache
+from oiccli.cache import key_fingerprint
+from oiccli.cache import unverified_payload
 from oiccli.client_auth import CLIENT_AUTHN_METHOD
 from oiccli.exception import ConfigurationError
 from oiccli.exception import ParameterError
@@ -14,6 +19,8 @@ from oiccli.exception import WrongContentType
 from oiccli.oauth2 import build_services
 from oiccli.oauth2 import ClientInfo
 from oiccli.oauth2 import DEFAULT_SERVICES
+from oiccli.oic.request_object import RequestObjectStore
+from oiccli.oic.service import CLAIM_SOURCE_ERRORS
 from oiccli.oic.service import factory
 from oiccli.service import Service
 
@@ -190,6 +197,53 @@ class TestAuthorization(object):
 
         assert os.path.isfile('request123456.json')
 
+    def test_request_param_store(self):
+        req_args = {'response_type': 'code', 'state': 'state'}
+        self.req.endpoint = 'https://example.com/authorize'
+        self.cli_info.request_object_store = RequestObjectStore(
+            'https://example.com/requests')
+        _info = self.req.do_request_init(self.cli_info, request_args=req_args,
+                                         request_method='reference')
+        _uri = _info['cis']['request_uri']
+        assert _uri.startswith('https://example.com/requests/')
+        _name = self.cli_info.request_object_store.name_from_uri(_uri)
+        assert not os.path.isfile(_name)
+        _ro = self.cli_info.request_object_store.get(_name)
+        assert unverified_payload(_ro)['state'] == 'state'
+
+    def test_request_param_store_registered(self):
+        req_args = {'response_type': 'code', 'state': 'state'}
+        self.req.endpoint = 'https://example.com/authorize'
+        _store = RequestObjectStore('https://example.com/requests')
+        self.cli_info.request_object_store = _store
+        self.cli_info.registration_response = {
+            'redirect_uris': ['https://example.com/cb'],
+            'request_uris': ['https://example.com/requests/ro']
+        }
+        _uris = []
+        for state in ['state', 'state2']:
+            req_args['state'] = state
+            _info = self.req.do_request_init(
+                self.cli_info, request_args=req_args,
+                request_method='reference')
+            _uris.append(_info['cis']['request_uri'])
+        # A request_uri of its own for every request
+        assert _uris[0] != _uris[1]
+        for _uri, state in zip(_uris, ['state', 'state2']):
+            assert _uri.startswith('https://example.com/requests/ro/')
+            _ro = _store.get(_store.name_from_uri(_uri))
+            assert unverified_payload(_ro)['state'] == state
+
+        # Registered request_uri not under the store's base_url
+        self.cli_info.registration_response['request_uris'] = [
+            'https://example.org/ro']
+        _info = self.req.do_request_init(self.cli_info, request_args=req_args,
+                                         request_method='reference')
+        _uri = _info['cis']['request_uri']
+        assert _uri.startswith('https://example.com/requests/')
+        assert _uri not in _uris
+        assert _store.get(_store.name_from_uri(_uri))
+
 
 class TestAccessTokenRequest(object):
     @pytest.fixture(autouse=True)
@@ -604,6 +658,99 @@ class TestUserInfo(object):
                                      '_claim_names', '_claim_sources',
                                      'address', 'phone_number'}
 
+    def test_aggregated_claims_cached(self):
+        _keyjar = build_keyjar(KEYSPEC)[1]
+        srv = JWT(_keyjar, iss='https://example.org/op/', sign_alg='ES256')
+        _jwt = srv.pack(payload={'email': 'diana@example.org'})
+        public_keys_keyjar(_keyjar, '', self.cli_info.keyjar,
+                           'https://example.org/op/')
+
+        _cache = VerifiedJWTCache()
+        self.req.jwt_cache = _cache
+        for _ in range(2):
+            resp = OpenIDSchema(sub='diana', _claim_names={'email': 'src1'},
+                                _claim_sources={'src1': {'JWT': _jwt}})
+            _resp = self.req.parse_response(resp.to_json(), self.cli_info)
+            assert _resp['email'] == 'diana@example.org'
+        assert len(_cache) == 1
+
+        _fp = key_fingerprint(self.cli_info.keyjar, 'https://example.org/op/')
+        assert _cache.get(_jwt, _fp)['email'] == 'diana@example.org'
+        # New keys for the issuer
+        assert _cache.get(_jwt, _fp + ((b'new', 0),)) is None
+
+    def test_unpack_distributed_response(self):
+        def _httplib(url, method, **kwargs):
+            if url.endswith('src2'):
+                raise ConnectionError('Unreachable')
+            if url.endswith('src1'):
+                _claims = {'sub': 'diana',
+                           'address': {'locality': 'Los Angeles'}}
+            else:
+                _claims = {'sub': 'diana', 'phone_number': '+1 (555) 123-4567'}
+            return Response(200, json.dumps(_claims),
+                            headers={'content-type': 'application/json'})
+
+        self.req.httplib = _httplib
+        resp = OpenIDSchema(
+            sub='diana', given_name='Diana', family_name='krall',
+            _claim_names={'address': 'src1', 'phone_number': 'src3',
+                          'email': 'src2'},
+            _claim_sources={
+                'src1': {'endpoint': 'https://example.com/src1'},
+                'src2': {'endpoint': 'https://example.com/src2'},
+                'src3': {'endpoint': 'https://example.com/src3',
+                         'access_token': 'token'}})
+
+        _resp = self.req.parse_response(resp.to_json(), self.cli_info)
+        assert _resp['address'] == {'locality': 'Los Angeles'}
+        assert _resp['phone_number'] == '+1 (555) 123-4567'
+        # The source that failed is left out, and said so
+        assert 'email' not in _resp
+        assert _resp[CLAIM_SOURCE_ERRORS] == {
+            'src2': 'ConnectionError: Unreachable'}
+
+    def test_claim_source_deadline(self):
+        _kwargs = {}
+
+        def _httplib(url, method, **kwargs):
+            _kwargs.update(kwargs)
+            return Response(200, json.dumps({'sub': 'diana'}),
+                            headers={'content-type': 'application/json'})
+
+        self.req.httplib = _httplib
+        self.req.claim_source_timeout = 3
+        _before = time.time()
+        self.req.fetch_claim_source({'endpoint': 'https://example.com/src1'},
+                                    self.cli_info)
+        assert _kwargs['timeout'] <= 3
+        assert _before + 3 <= _kwargs['deadline'] <= time.time() + 3
+
+    def test_claims_executor(self):
+        def _httplib(url, method, **kwargs):
+            return Response(200, json.dumps({'sub': 'diana', 'email': url}),
+                            headers={'content-type': 'application/json'})
+
+        class _Executor(ThreadPoolExecutor):
+            submitted = 0
+
+            def submit(self, *args, **kwargs):
+                self.submitted += 1
+                return ThreadPoolExecutor.submit(self, *args, **kwargs)
+
+        resp = OpenIDSchema(
+            sub='diana', _claim_names={'email': 'src1'},
+            _claim_sources={
+                'src1': {'endpoint': 'https://example.com/src1'}})
+
+        with _Executor(max_workers=1) as executor:
+            srv = factory('UserInfo', conf={'claims_executor': executor})
+            srv.httplib = _httplib
+            _resp = srv.parse_response(resp.to_json(), self.cli_info)
+            assert executor.submitted == 1
+        assert _resp['email'] == 'https://example.com/src1'
+        assert CLAIM_SOURCE_ERRORS not in _resp
+
 
 class TestCheckSession(object):
     @pytest.fixture(autouse=True)
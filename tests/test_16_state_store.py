@@ -0,0 +1,214 @@
+import os
+import shelve
+
+import pytest
+
+from oiccli.state import State
+from oiccli.state import Sweeper
+from oiccli.state_store import MemoryStore
+from oiccli.state_store import ShelveStore
+from oiccli.state_store import SQLiteStore
+from oicmsg.oauth2 import AccessTokenResponse
+from oicmsg.oauth2 import AuthorizationRequest
+from oicmsg.oauth2 import AuthorizationResponse
+from oicmsg.time_util import utc_time_sans_frac
+
+__author__ = 'Roland Hedberg'
+
+REQ_ARGS = {'redirect_uri': 'https://example.com/rp/cb',
+            'response_type': "code"}
+
+
+@pytest.fixture(params=['memory', 'shelve', 'sqlite'])
+def store(request, tmpdir):
+    if request.param == 'memory':
+        _store = MemoryStore()
+    elif request.param == 'shelve':
+        _store = ShelveStore(os.path.join(str(tmpdir), 'state'))
+    else:
+        _store = SQLiteStore(os.path.join(str(tmpdir), 'state.db'))
+    yield _store
+    _store.close()
+
+
+def test_set_get(store):
+    store['foo'] = {'bar': ['a', 'b']}
+    assert store['foo'] == {'bar': ['a', 'b']}
+    assert 'foo' in store
+    assert store.keys() == ['foo']
+
+
+def test_unknown_key(store):
+    with pytest.raises(KeyError):
+        store['foo']
+    assert 'foo' not in store
+
+
+def test_delete(store):
+    store['foo'] = 'bar'
+    del store['foo']
+    assert 'foo' not in store
+    with pytest.raises(KeyError):
+        del store['foo']
+
+
+def test_replace(store):
+    store['foo'] = 'bar'
+    store['foo'] = 'xyz'
+    assert store['foo'] == 'xyz'
+
+
+def test_shelve_legacy_values(tmpdir):
+    _name = os.path.join(str(tmpdir), 'state')
+    _db = shelve.open(_name)
+    _db['state'] = {'exp': 10, 'value': 'foo'}
+    _db.close()
+
+    store = ShelveStore(_name)
+    assert store['state'] == {'exp': 10, 'value': 'foo'}
+    assert store.expire(now=utc_time_sans_frac() + 3600) == 0
+    store.close()
+
+
+def test_sqlite_shared(tmpdir):
+    _name = os.path.join(str(tmpdir), 'state.db')
+    store1 = SQLiteStore(_name)
+    store2 = SQLiteStore(_name)
+    store1['foo'] = 'bar'
+    assert store2['foo'] == 'bar'
+
+
+def test_sqlite_bad_table_name(tmpdir):
+    with pytest.raises(ValueError):
+        SQLiteStore(os.path.join(str(tmpdir), 'state.db'), table='a;b')
+
+
+def test_state_with_sqlite(tmpdir):
+    state_db = State('client_id',
+                     db=SQLiteStore(os.path.join(str(tmpdir), 'state.db')))
+    request = AuthorizationRequest(**REQ_ARGS)
+    state = state_db.create_state(receiver='https://example.org/op',
+                                  request=request)
+    state_db.add_response(AuthorizationResponse(code="access grant",
+                                                state=state))
+    state_db.add_response(
+        AccessTokenResponse(access_token='access token', token_type='Bearer',
+                            expires_in=600), state=state)
+
+    assert state_db[state]['code'] == 'access grant'
+    assert state_db.get_token_info(state)['access_token'] == 'access token'
+
+    state_db.bind_nonce_to_state('nonce', state)
+    assert state_db.nonce_to_state('nonce') == state
+
+
+def test_state_with_dict():
+    _dict = {}
+    state_db = State('client_id', db=_dict)
+    state_db['state'] = {'foo': 'bar'}
+    assert _dict['state_state'] == {'foo': 'bar'}
+
+
+def test_expired_entry_not_returned(store):
+    store.set('foo', 'bar', exp=utc_time_sans_frac() - 1)
+    with pytest.raises(KeyError):
+        store['foo']
+    assert 'foo' not in store
+
+
+def test_expire_in_batches(store):
+    _now = utc_time_sans_frac()
+    for i in range(10):
+        store.set('old_{}'.format(i), i, exp=_now - 10)
+    store.set('new', 'value', exp=_now + 100)
+    store.set('forever', 'value')
+
+    removed = 0
+    while True:
+        n = store.expire(_now, limit=3)
+        assert n <= 3
+        if not n and removed == 10:
+            break
+        removed += n
+
+    assert set(store.keys()) == {'new', 'forever'}
+
+
+def test_expire_updated_entry(store):
+    _now = utc_time_sans_frac()
+    store.set('foo', 'bar', exp=_now - 10)
+    store.set('foo', 'xyz', exp=_now + 100)
+    store.expire(_now)
+    assert store['foo'] == 'xyz'
+
+
+class TestStateExpiration(object):
+    @pytest.fixture(autouse=True)
+    def create_state_db(self):
+        self.state_db = State('client_id', lifetime=600)
+
+    def test_expired_state(self):
+        request = AuthorizationRequest(**REQ_ARGS)
+        state = self.state_db.create_state(receiver='https://example.org/op',
+                                           request=request)
+        self.state_db.bind_nonce_to_state('nonce', state)
+        assert self.state_db.sweep(now=utc_time_sans_frac() + 601) == 2
+        with pytest.raises(KeyError):
+            self.state_db[state]
+        with pytest.raises(KeyError):
+            self.state_db.nonce_to_state('nonce')
+
+    def test_state_kept_while_token_valid(self):
+        request = AuthorizationRequest(**REQ_ARGS)
+        state = self.state_db.create_state(receiver='https://example.org/op',
+                                           request=request)
+        self.state_db.add_response(
+            AccessTokenResponse(access_token='access token',
+                                token_type='Bearer', expires_in=3600),
+            state=state)
+        self.state_db.sweep(now=utc_time_sans_frac() + 601)
+        assert self.state_db[state]['token']['access_token'] == 'access token'
+
+    def test_state_with_refresh_token_kept(self):
+        request = AuthorizationRequest(**REQ_ARGS)
+        state = self.state_db.create_state(receiver='https://example.org/op',
+                                           request=request)
+        self.state_db.add_response(
+            AccessTokenResponse(access_token='access token',
+                                token_type='Bearer',
+                                refresh_token='refresh token'),
+            state=state)
+        assert self.state_db.sweep(now=utc_time_sans_frac() + 86400) == 0
+        assert self.state_db[state]['refresh_token'] == 'refresh token'
+
+    def test_state_with_refresh_token_expires(self):
+        state_db = State('client_id', lifetime=600, refresh_lifetime=3600)
+        state = state_db.create_state(receiver='https://example.org/op',
+                                      request=AuthorizationRequest(**REQ_ARGS))
+        state_db.add_response(
+            AccessTokenResponse(access_token='access token',
+                                token_type='Bearer',
+                                refresh_token='refresh token'),
+            state=state)
+        _exp = state_db[state]['refresh_exp']
+        assert _exp >= utc_time_sans_frac() + 3600 - 1
+        assert state_db.sweep(now=_exp - 1) == 0
+        assert state_db.sweep(now=_exp + 1) == 1
+
+    def test_no_lifetime(self):
+        state_db = State('client_id', lifetime=0)
+        state_db['state'] = {'iat': utc_time_sans_frac() - 86400}
+        assert state_db.sweep() == 0
+        assert state_db['state']
+
+
+def test_sweeper():
+    state_db = State('client_id', lifetime=600)
+    _now = utc_time_sans_frac()
+    for i in range(25):
+        state_db[str(i)] = {'iat': _now - 700}
+    state_db['fresh'] = {'iat': _now}
+
+    sweeper = Sweeper(state_db, batch_size=10, pause=0)
+    assert sweeper.sweep() == 25
+    assert state_db['fresh']
@@ -0,0 +1,79 @@
+import pytest
+
+from oiccli.oauth2 import Client
+from oiccli.token_refresh import RefreshScheduler
+from oicmsg.oauth2 import AccessTokenResponse
+from oicmsg.oauth2 import TokenErrorResponse
+from oicmsg.time_util import utc_time_sans_frac
+
+__author__ = 'Roland Hedberg'
+
+
+class DummyClient(Client):
+    def __init__(self, responses):
+        Client.__init__(self, config={'client_id': 'client_1',
+                                      'client_secret': 'abcdefghijklmnop'})
+        self.responses = responses
+        self.requests = []
+
+    def do_request(self, request_type, **kwargs):
+        self.requests.append((request_type, kwargs))
+        return self.responses.pop(0)
+
+
+class TestRefreshScheduler(object):
+    @pytest.fixture(autouse=True)
+    def create_scheduler(self):
+        self.client = DummyClient([
+            AccessTokenResponse(access_token='2nd access token',
+                                token_type='Bearer', expires_in=3600)])
+        self.state_db = self.client.client_info.state_db
+        self.scheduler = RefreshScheduler(self.client, margin=60, jitter=0)
+        self.state_db['ABCDE'] = {'iat': utc_time_sans_frac()}
+        self.state_db.add_response(
+            AccessTokenResponse(access_token='access token',
+                                token_type='Bearer', expires_in=600,
+                                refresh_token='refresh token'),
+            state='ABCDE')
+        self.exp = self.state_db['ABCDE']['token']['exp']
+
+    def test_tracked(self):
+        assert self.scheduler.pending(now=self.exp - 120) == []
+        assert self.scheduler.pending(now=self.exp - 60) == ['ABCDE']
+        # Only handed out once
+        assert self.scheduler.pending(now=self.exp) == []
+
+    def test_refresh(self):
+        resp = self.scheduler.refresh('ABCDE')
+        assert resp['access_token'] == '2nd access token'
+        assert self.client.requests == [
+            ('refresh_token', {'state': 'ABCDE',
+                               'authn_method': 'client_secret_basic'})]
+        _tinfo = self.state_db.get_token_info('ABCDE')
+        assert _tinfo['access_token'] == '2nd access token'
+        # The new token is scheduled for refresh
+        assert self.scheduler.pending(now=_tinfo['exp'] - 60) == ['ABCDE']
+
+    def test_untrack(self):
+        self.scheduler.untrack('ABCDE')
+        assert self.scheduler.pending(now=self.exp) == []
+
+    def test_replaced_expiration(self):
+        self.state_db.add_response(
+            AccessTokenResponse(access_token='other token',
+                                token_type='Bearer', expires_in=1200),
+            state='ABCDE')
+        assert self.scheduler.pending(now=self.exp) == []
+
+    def test_no_refresh_token(self):
+        self.state_db['FGHIJ'] = {'iat': utc_time_sans_frac(),
+                                  'token': {'access_token': 'token'}}
+        assert self.scheduler.refresh('FGHIJ') is None
+        assert self.client.requests == []
+
+    def test_error_response(self):
+        self.client.responses = [TokenErrorResponse(error='invalid_grant')]
+        resp = self.scheduler.refresh('ABCDE')
+        assert isinstance(resp, TokenErrorResponse)
+        _tinfo = self.state_db.get_token_info('ABCDE')
+        assert _tinfo['access_token'] == 'access token'
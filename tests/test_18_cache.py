@@ -0,0 +1,226 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from oiccli.cache import ProviderInfoCache
+from oiccli.cache import VerifiedJWTCache
+from oiccli.cache import freshness_lifetime
+from oiccli.cache import key_fingerprint
+from oiccli.oauth2 import ClientInfo
+from oiccli.oauth2.service import factory
+from oicmsg.key_bundle import KeyBundle
+from oicmsg.key_jar import KeyJar
+from oicmsg.oauth2 import ASConfigurationResponse
+from oicmsg.time_util import utc_time_sans_frac
+
+__author__ = 'Roland Hedberg'
+
+ISS = 'https://example.com/as'
+URL = '{}/.well-known/openid-configuration'.format(ISS)
+
+
+class Response(object):
+    def __init__(self, status_code, text, headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {"content-type": "text/plain"}
+
+
+class DummyHTTP(object):
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def __call__(self, url, method='GET', **kwargs):
+        self.requests.append((url, kwargs))
+        return self.responses.pop(0)
+
+
+class AsyncDummyHTTP(DummyHTTP):
+    async def __call__(self, url, method='GET', **kwargs):
+        return DummyHTTP.__call__(self, url, method, **kwargs)
+
+
+def provider_info_response(headers):
+    _headers = {'content-type': "application/json"}
+    _headers.update(headers)
+    return Response(
+        200,
+        ASConfigurationResponse(
+            issuer=ISS, response_types_supported=['code'],
+            grant_types_supported=['Bearer'],
+            token_endpoint='{}/token'.format(ISS)).to_json(),
+        headers=_headers)
+
+
+def test_freshness_lifetime():
+    assert freshness_lifetime({}) == 0
+    assert freshness_lifetime({}, default=30) == 30
+    assert freshness_lifetime({'cache-control': 'public, max-age=600'}) == 600
+    assert freshness_lifetime({'cache-control': 'no-store'}) is None
+    assert freshness_lifetime({'cache-control': 'no-cache, max-age=60'}) == 0
+    assert freshness_lifetime(
+        {'expires': 'Thu, 01 Jan 1970 00:00:00 GMT'}) == 0
+
+
+def test_not_stored():
+    cache = ProviderInfoCache(default_ttl=0)
+    _resp = ASConfigurationResponse(issuer=ISS)
+    assert cache.set(URL, _resp, {'cache-control': 'no-store'}) is None
+    assert cache.set(URL, _resp, {}) is None
+    assert URL not in cache
+    # Kept for revalidation
+    assert cache.set(URL, _resp, {'etag': '"1"'})
+    assert not cache.get(URL).fresh()
+
+
+def test_default_ttl():
+    cache = ProviderInfoCache(default_ttl=300, max_ttl=60)
+    _now = utc_time_sans_frac()
+    entry = cache.set(URL, ASConfigurationResponse(issuer=ISS), {}, now=_now)
+    assert entry.expires == _now + 60
+    # The OP says it mustn't be reused
+    assert cache.set(URL, ASConfigurationResponse(issuer=ISS),
+                     {'cache-control': 'no-cache'}, now=_now) is None
+
+
+def test_persistent(tmpdir):
+    _name = os.path.join(str(tmpdir), 'provider_info.json')
+    cache = ProviderInfoCache(_name)
+    cache.set(URL, ASConfigurationResponse(issuer=ISS),
+              {'cache-control': 'max-age=600', 'etag': '"1"'})
+    assert json.load(open(_name))[URL]['etag'] == '"1"'
+
+    other = ProviderInfoCache(_name)
+    entry = other.get(URL)
+    assert entry.fresh()
+    assert entry.message(ASConfigurationResponse)['issuer'] == ISS
+
+
+class TestVerifiedJWTCache(object):
+    @pytest.fixture(autouse=True)
+    def create_cache(self):
+        self.cache = VerifiedJWTCache(max_size=2)
+
+    def test_get(self):
+        self.cache.set('a.b.c', {'foo': ['bar']}, ('fp',))
+        claims = self.cache.get('a.b.c', ('fp',))
+        assert claims == {'foo': ['bar']}
+        # A copy is returned
+        claims['foo'].append('xyz')
+        assert self.cache.get('a.b.c', ('fp',)) == {'foo': ['bar']}
+
+    def test_keys_changed(self):
+        self.cache.set('a.b.c', {'foo': 'bar'}, ('fp',))
+        assert self.cache.get('a.b.c', ('other',)) is None
+        assert len(self.cache) == 0
+
+    def test_expired(self):
+        _now = utc_time_sans_frac()
+        self.cache.set('a.b.c', {'exp': _now - 1}, ('fp',))
+        assert len(self.cache) == 0
+        self.cache.set('a.b.c', {'exp': _now + 10}, ('fp',))
+        assert self.cache.get('a.b.c', ('fp',), now=_now + 11) is None
+
+    def test_bounded(self):
+        for token in ['a.b.c', 'd.e.f', 'g.h.i']:
+            self.cache.set(token, {'foo': 'bar'}, ('fp',))
+        assert len(self.cache) == 2
+        assert self.cache.get('a.b.c', ('fp',)) is None
+        assert self.cache.get('g.h.i', ('fp',))
+
+
+def test_key_fingerprint():
+    keyjar = KeyJar()
+    keyjar.add_kb(ISS, KeyBundle([{'kty': 'oct', 'kid': 'a',
+                                   'k': 'c2VjcmV0LWtleS1udW1iZXItb25l'}]))
+    _fp = key_fingerprint(keyjar, ISS)
+    assert key_fingerprint(keyjar, ISS) == _fp
+
+    # Another key with the same key ID
+    keyjar = KeyJar()
+    keyjar.add_kb(ISS, KeyBundle([{'kty': 'oct', 'kid': 'a',
+                                   'k': 'c2VjcmV0LWtleS1udW1iZXItdHdv'}]))
+    assert key_fingerprint(keyjar, ISS) != _fp
+
+
+class TestProviderInfoDiscovery(object):
+    @pytest.fixture(autouse=True)
+    def create_service(self):
+        # Responses without caching information are only revalidated
+        self.cache = ProviderInfoCache(default_ttl=0)
+        self.httplib = DummyHTTP([])
+        self.service = factory('ProviderInfoDiscovery', httplib=self.httplib,
+                               conf={'cache': self.cache})
+        self.cli_info = self.client_info()
+
+    def client_info(self):
+        client_config = {'client_id': 'client_id', 'client_secret': 'password',
+                         'redirect_uris': ['https://example.com/cli/authz_cb'],
+                         'issuer': ISS}
+        _cli_info = ClientInfo(config=client_config)
+        _cli_info.service = {}
+        return _cli_info
+
+    def test_fresh_response_reused(self):
+        self.httplib.responses = [
+            provider_info_response({'cache-control': 'max-age=600'})]
+        resp = self.service.service_request(URL, client_info=self.cli_info,
+                                            response_body_type='json')
+        assert isinstance(resp, ASConfigurationResponse)
+
+        # A new client for the same OP
+        _cli_info = self.client_info()
+        resp = self.service.service_request(URL, client_info=_cli_info,
+                                            response_body_type='json')
+        assert resp['issuer'] == ISS
+        assert len(self.httplib.requests) == 1
+        # The post parse methods have been run
+        assert _cli_info.provider_info['issuer'] == ISS
+        # Each client has a copy of its own
+        _cli_info.provider_info['issuer'] = 'https://other.example.com'
+        assert self.cache.get(URL).message(
+            ASConfigurationResponse)['issuer'] == ISS
+
+    def test_revalidate(self):
+        self.httplib.responses = [
+            provider_info_response({'etag': '"abc"'}),
+            Response(304, '', {'cache-control': 'max-age=600'})]
+        self.service.service_request(URL, client_info=self.cli_info,
+                                     response_body_type='json')
+        resp = self.service.service_request(URL, client_info=self.cli_info,
+                                            response_body_type='json')
+        assert resp['issuer'] == ISS
+        assert self.httplib.requests[1][1]['headers'] == {
+            'If-None-Match': '"abc"'}
+        assert self.cache.get(URL).expires > utc_time_sans_frac()
+
+    def test_no_cache(self):
+        service = factory('ProviderInfoDiscovery', httplib=self.httplib,
+                          conf={'cache': None})
+        self.httplib.responses = [
+            provider_info_response({'cache-control': 'max-age=600'}),
+            provider_info_response({'cache-control': 'max-age=600'})]
+        service.service_request(URL, client_info=self.cli_info,
+                                response_body_type='json')
+        service.service_request(URL, client_info=self.cli_info,
+                                response_body_type='json')
+        assert len(self.httplib.requests) == 2
+
+    def test_async_fresh_response_reused(self):
+        httplib = AsyncDummyHTTP(
+            [provider_info_response({'cache-control': 'max-age=600'})])
+        service = factory('ProviderInfoDiscovery', httplib=httplib,
+                          conf={'cache': self.cache})
+        loop = asyncio.new_event_loop()
+        try:
+            for _ in range(2):
+                resp = loop.run_until_complete(service.async_service_request(
+                    URL, client_info=self.client_info(),
+                    response_body_type='json'))
+                assert resp['issuer'] == ISS
+        finally:
+            loop.close()
+        assert len(httplib.requests) == 1
@@ -0,0 +1,175 @@
+import threading
+import time
+
+import pytest
+import responses
+
+from oiccli.client_info import ClientInfo
+from oiccli.key_refresh import KeyRefresher
+from oiccli.key_refresh import RefreshingKeyBundle
+from oiccli.oauth2.service import factory
+from oicmsg.key_bundle import KeyBundle
+
+__author__ = 'Roland Hedberg'
+
+JWKS_URL = 'https://example.com/jwks.json'
+
+
+def sym_key(kid):
+    return {"kty": "oct", "use": "sig", "kid": kid,
+            "k": "c3VwZXJzZWNyZXQtc2lnbmluZy1rZXk"}
+
+
+class DummyBundle(RefreshingKeyBundle):
+    """
+    Returns a new set of keys on each fetch instead of fetching them.
+    """
+
+    def __init__(self, kids, **kwargs):
+        RefreshingKeyBundle.__init__(self, source=JWKS_URL, **kwargs)
+        self.kids = kids
+        self.fetches = 0
+        self.block = None
+
+    def _fetch_remote(self):
+        self.fetches += 1
+        if self.block:
+            self.block.wait()
+        if not self.kids:
+            raise Exception('Fetch failed')
+        return KeyBundle(keys=[sym_key(k) for k in self.kids.pop(0)]), True
+
+
+class TestRefreshingKeyBundle(object):
+    @pytest.fixture(autouse=True)
+    def create_bundle(self):
+        self.kb = DummyBundle([['a'], ['b']], cache_time=300)
+
+    def test_first_fetch(self):
+        assert [k.kid for k in self.kb.keys()] == ['a']
+        assert self.kb.fetches == 1
+        # Not fetched again while fresh
+        self.kb.keys()
+        assert self.kb.fetches == 1
+
+    def test_stale_while_revalidate(self):
+        self.kb.keys()
+        self.kb.time_out = time.time() - 1
+        self.kb.block = threading.Event()
+        # The old keys are returned while the new ones are fetched
+        assert [k.kid for k in self.kb.keys()] == ['a']
+        self.kb.block.set()
+        while self.kb._updating or self.kb._pending:
+            time.sleep(0.01)
+        assert set([k.kid for k in self.kb.keys()]) == {'a', 'b'}
+        assert self.kb.fetches == 2
+
+    def test_unknown_kid(self):
+        self.kb.keys()
+        assert self.kb.get_key_with_kid('b').kid == 'b'
+        assert self.kb.fetches == 2
+        # Rate limited
+        assert self.kb.get_key_with_kid('c') is None
+        assert self.kb.fetches == 2
+
+    def test_failed_fetch_keeps_keys(self):
+        self.kb.kids = [['a']]
+        self.kb.keys()
+        self.kb.update()
+        assert [k.kid for k in self.kb.keys()] == ['a']
+        assert self.kb.next_try > time.time()
+
+    def test_single_flight(self):
+        self.kb.block = threading.Event()
+        _threads = [threading.Thread(target=self.kb.update) for _ in range(5)]
+        for _thread in _threads:
+            _thread.start()
+        time.sleep(0.1)
+        self.kb.block.set()
+        for _thread in _threads:
+            _thread.join()
+        assert self.kb.fetches == 1
+
+    def test_removed_keys(self):
+        self.kb.kids = [['a'], ['b'], ['b']]
+        self.kb.update()
+        self.kb.update()
+        # Kept for a while, as inactive
+        assert [(k.kid, bool(k.inactive_since)) for k in self.kb._keys] == [
+            ('b', False), ('a', True)]
+        self.kb.remove_after = 0
+        self.kb.update()
+        assert [k.kid for k in self.kb._keys] == ['b']
+
+
+def test_not_modified():
+    kb = RefreshingKeyBundle(source=JWKS_URL)
+    with responses.RequestsMock() as rsps:
+        rsps.add(responses.GET, JWKS_URL,
+                 json={'keys': [sym_key('a'), sym_key('b')]},
+                 headers={'ETag': '"1"'})
+        rsps.add(responses.GET, JWKS_URL, status=304)
+        assert kb.update()
+        assert not kb.update()
+        assert rsps.calls[1].request.headers['If-None-Match'] == '"1"'
+
+    assert sorted([k.kid for k in kb._keys]) == ['a', 'b']
+    assert not [k for k in kb._keys if k.inactive_since]
+    assert kb.etag == '"1"'
+    assert kb.time_out > time.time()
+
+
+def test_refresher_due():
+    refresher = KeyRefresher(margin=30)
+    kb = DummyBundle([['a'], ['b']], cache_time=300, refresher=refresher)
+    # Never fetched
+    assert refresher.refresh() == 1
+    assert refresher.due() == []
+    assert refresher.due(now=kb.time_out - 30) == [kb]
+
+
+def test_client_info_key_refresher():
+    refresher = KeyRefresher()
+    _keys = {'url': {'https://example.com': JWKS_URL}}
+    cli_info = ClientInfo(config={'keys': _keys}, key_refresher=refresher)
+    assert len(refresher.bundles) == 1
+    assert cli_info.keyjar.issuer_keys['https://example.com'][0] is \
+        refresher.bundles[0]
+
+
+def test_discovered_jwks_uri():
+    refresher = KeyRefresher()
+    cli_info = ClientInfo(config={'issuer': 'https://example.com'},
+                          key_refresher=refresher)
+    cli_info.service = {}
+    service = factory('ProviderInfoDiscovery')
+    resp = {'issuer': 'https://example.com', 'jwks_uri': JWKS_URL}
+    service.do_post_parse_response(resp, cli_info)
+    assert len(refresher.bundles) == 1
+    assert refresher.bundles[0].source == JWKS_URL
+    assert cli_info.keyjar.issuer_keys['https://example.com'] == \
+        refresher.bundles
+
+    # Discovered again, the same bundle is used
+    service.do_post_parse_response(resp, cli_info)
+    assert len(cli_info.keyjar.issuer_keys['https://example.com']) == 1
+
+
+def test_discovered_jwks():
+    cli_info = ClientInfo(config={'issuer': 'https://example.com'})
+    cli_info.service = {}
+    service = factory('ProviderInfoDiscovery')
+    resp = {'issuer': 'https://example.com',
+            'jwks': {'keys': [sym_key('a')]}}
+    for _ in range(2):
+        service.do_post_parse_response(resp, cli_info)
+    assert len(cli_info.keyjar.issuer_keys['https://example.com']) == 1
+
+    # jwks_uri wins over jwks
+    cli_info = ClientInfo(config={'issuer': 'https://example.com'})
+    cli_info.service = {}
+    resp['jwks_uri'] = JWKS_URL
+    service.do_post_parse_response(resp, cli_info)
+    _kbs = cli_info.keyjar.issuer_keys['https://example.com']
+    assert len(_kbs) == 1
+    assert _kbs[0].source == JWKS_URL
@@ -0,0 +1,102 @@
+import pytest
+
+from oiccli.cache import ProviderInfoCache
+from oiccli.client_auth import CLIENT_AUTHN_METHOD
+from oiccli.client_pool import ClientPool
+from oiccli.client_pool import deep_size
+from oiccli.events import EventStore
+from oiccli.metrics import METRICS
+from oiccli.state_store import MemoryStore
+from oicmsg.oic import ProviderConfigurationResponse
+
+__author__ = 'Roland Hedberg'
+
+ISSUERS = ['https://op{}.example.com'.format(i) for i in range(4)]
+
+
+def client_config(issuer):
+    return {'client_id': 'client_id', 'client_secret': 'password',
+            'redirect_uris': ['https://example.com/cli/authz_cb']}
+
+
+class TestClientPool(object):
+    @pytest.fixture(autouse=True)
+    def create_pool(self):
+        self.cache = ProviderInfoCache()
+        self.pool = ClientPool(config_loader=client_config, max_clients=2,
+                               provider_info_cache=self.cache)
+
+    def test_lazy(self):
+        assert len(self.pool) == 0
+        client = self.pool[ISSUERS[0]]
+        assert client.client_info.issuer == ISSUERS[0]
+        assert self.pool[ISSUERS[0]] is client
+
+    def test_unknown_issuer(self):
+        pool = ClientPool(configs={ISSUERS[0]: client_config(ISSUERS[0])})
+        assert pool.get(ISSUERS[0])
+        with pytest.raises(KeyError):
+            pool.get(ISSUERS[1])
+
+    def test_shared_session(self):
+        _cli0 = self.pool[ISSUERS[0]]
+        _cli1 = self.pool[ISSUERS[1]]
+        assert _cli0.http is not _cli1.http
+        assert _cli0.http.session is self.pool.session
+        assert _cli1.http.session is self.pool.session
+
+    def test_lru(self):
+        self.pool[ISSUERS[0]]
+        self.pool[ISSUERS[1]]
+        self.pool[ISSUERS[0]]
+        self.pool[ISSUERS[2]]
+        assert set(self.pool.issuers()) == {ISSUERS[0], ISSUERS[2]}
+
+    def test_memory_budget(self):
+        pool = ClientPool(config_loader=client_config, memory_budget=1)
+        pool[ISSUERS[0]]
+        pool[ISSUERS[1]]
+        # Always keeps at least one
+        assert pool.issuers() == [ISSUERS[1]]
+        assert pool.measure() > 0
+
+    def test_cached_provider_info(self):
+        _pcr = ProviderConfigurationResponse(
+            issuer=ISSUERS[0], token_endpoint=ISSUERS[0] + '/token')
+        self.cache.set(ISSUERS[0] + '/.well-known/openid-configuration',
+                       _pcr, {'cache-control': 'max-age=600'})
+        client = self.pool[ISSUERS[0]]
+        assert client.client_info.provider_info == _pcr
+        assert client.client_info.provider_info is not _pcr
+        assert client.service['accesstoken'].endpoint == \
+            ISSUERS[0] + '/token'
+
+    def test_shared_state_store(self):
+        pool = ClientPool(config_loader=client_config,
+                          state_store=MemoryStore(), max_clients=1)
+        client = pool[ISSUERS[0]]
+        client.client_info.state_db['state'] = {'code': 'code'}
+        pool[ISSUERS[1]]
+        assert ISSUERS[0] not in pool
+        # The state survives the client being removed
+        assert pool[ISSUERS[0]].client_info.state_db['state'] == {
+            'code': 'code'}
+
+    def test_shared_not_measured(self):
+        events = EventStore()
+        pool = ClientPool(config_loader=client_config, events=events)
+        assert pool[ISSUERS[0]].events is events
+        _exclude = pool._exclude()
+        for obj in [events, METRICS, CLIENT_AUTHN_METHOD, pool.session]:
+            assert id(obj) in _exclude
+
+    def test_pool_connections(self):
+        pool = ClientPool(config_loader=client_config, max_clients=500)
+        _adapter = pool.session.get_adapter('https://op.example.com')
+        assert _adapter._pool_connections == 500
+
+
+def test_deep_size():
+    _shared = ['x' * 1000]
+    assert deep_size({'a': _shared}) > 1000
+    assert deep_size({'a': _shared}, exclude={id(_shared)}) < 1000
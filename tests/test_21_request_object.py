@@ -0,0 +1,89 @@
+import pytest
+
+from oiccli.exception import ConfigurationError
+from oiccli.oic.request_object import RequestObjectStore
+from oiccli.oic.request_object import RequestURIApp
+from oiccli.state_store import MemoryStore
+
+__author__ = 'Roland Hedberg'
+
+BASE_URL = 'https://example.com/requests/'
+
+
+class StartResponse(object):
+    def __call__(self, status, headers):
+        self.status = status
+        self.headers = dict(headers)
+
+
+class TestRequestObjectStore(object):
+    @pytest.fixture(autouse=True)
+    def create_store(self):
+        self.store = RequestObjectStore(BASE_URL)
+
+    def test_add(self):
+        _uri = self.store.add('a.b.c')
+        assert _uri.startswith(BASE_URL)
+        assert self.store.get(self.store.name_from_uri(_uri)) == 'a.b.c'
+        # Every request object gets its own URI
+        assert self.store.add('a.b.c') != _uri
+
+    def test_registered_uri(self):
+        _uri = self.store.add('a.b.c', BASE_URL + 'ro#foo')
+        assert _uri.startswith(BASE_URL + 'ro/')
+        assert self.store.get(self.store.name_from_uri(_uri)) == 'a.b.c'
+        # Concurrent requests don't overwrite each other
+        _uri2 = self.store.add('d.e.f', BASE_URL + 'ro#foo')
+        assert _uri2 != _uri
+        assert self.store.get(self.store.name_from_uri(_uri)) == 'a.b.c'
+        assert self.store.get(self.store.name_from_uri(_uri2)) == 'd.e.f'
+        with pytest.raises(ValueError):
+            self.store.add('a.b.c', 'https://example.org/ro.jwt')
+
+    def test_base_url(self):
+        assert RequestObjectStore(
+            'https://example.com/requests').base_url == BASE_URL
+        for url in ['', 'requests/', '/requests/', 'http://example.com/',
+                    'https:///requests/']:
+            with pytest.raises(ConfigurationError):
+                RequestObjectStore(url)
+
+    def test_expired(self):
+        _uri = self.store.add('a.b.c', now=1000)
+        assert self.store.get(self.store.name_from_uri(_uri)) is None
+
+    def test_one_time(self):
+        store = RequestObjectStore(BASE_URL, db=MemoryStore(), one_time=True)
+        _name = store.name_from_uri(store.add('a.b.c'))
+        assert store.get(_name) == 'a.b.c'
+        assert store.get(_name) is None
+
+
+class TestRequestURIApp(object):
+    @pytest.fixture(autouse=True)
+    def create_app(self):
+        self.store = RequestObjectStore(BASE_URL)
+        self.app = RequestURIApp(self.store, prefix='requests')
+
+    def test_found(self):
+        _uri = self.store.add('a.b.c')
+        start_response = StartResponse()
+        _body = self.app({'REQUEST_METHOD': 'GET',
+                          'PATH_INFO': '/requests/{}'.format(
+                              self.store.name_from_uri(_uri))},
+                         start_response)
+        assert start_response.status == '200 OK'
+        assert start_response.headers['Content-Type'] == 'application/jwt'
+        assert _body == [b'a.b.c']
+
+    def test_not_found(self):
+        start_response = StartResponse()
+        self.app({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/requests/xyz.jwt'},
+                 start_response)
+        assert start_response.status == '404 Not Found'
+
+    def test_method(self):
+        start_response = StartResponse()
+        self.app({'REQUEST_METHOD': 'POST', 'PATH_INFO': '/requests/xyz.jwt'},
+                 start_response)
+        assert start_response.status == '405 Method Not Allowed'
@@ -0,0 +1,110 @@
+import threading
+
+import pytest
+
+from oiccli.breaker import CLOSED
+from oiccli.breaker import CircuitBreaker
+from oiccli.breaker import HALF_OPEN
+from oiccli.breaker import HostGuard
+from oiccli.breaker import OPEN
+from oiccli.exception import CircuitOpen
+from oiccli.exception import HostBusy
+
+__author__ = 'Roland Hedberg'
+
+URL = 'https://op.example.org/token'
+
+
+class Response(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000
+
+    def __call__(self):
+        return self.now
+
+
+def fail():
+    raise IOError('connection refused')
+
+
+class TestCircuitBreaker(object):
+    @pytest.fixture(autouse=True)
+    def create_breaker(self):
+        self.clock = Clock()
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10,
+                                      slow_call_time=5, clock=self.clock)
+
+    def test_open(self):
+        self.breaker.record(0.1, response=Response(500))
+        assert self.breaker.state == CLOSED
+        self.breaker.record(0.1, error=IOError())
+        assert self.breaker.state == OPEN
+        assert not self.breaker.allow()
+
+    def test_success_resets(self):
+        self.breaker.record(0.1, response=Response(502))
+        self.breaker.record(0.1, response=Response(400))
+        self.breaker.record(0.1, response=Response(503))
+        assert self.breaker.state == CLOSED
+
+    def test_slow(self):
+        self.breaker.record(6, response=Response(200))
+        self.breaker.record(6, response=Response(200))
+        assert self.breaker.state == OPEN
+
+    def test_half_open(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        self.clock.now += 10
+        assert self.breaker.allow()
+        assert self.breaker.state == HALF_OPEN
+        # Only one trial request at a time
+        assert not self.breaker.allow()
+        self.breaker.failure()
+        assert self.breaker.state == OPEN
+
+        self.clock.now += 10
+        assert self.breaker.allow()
+        self.breaker.success()
+        assert self.breaker.state == CLOSED
+
+
+class TestHostGuard(object):
+    def test_circuit_open(self):
+        guard = HostGuard(failure_threshold=1)
+        with pytest.raises(IOError):
+            guard.call(URL, fail)
+        with pytest.raises(CircuitOpen):
+            guard.call(URL, Response, 200)
+        # Other hosts are not affected
+        assert guard.call('https://op.example.com', Response, 200)
+        assert guard.stats()['op.example.org']['state'] == OPEN
+
+    def test_in_flight(self):
+        guard = HostGuard(max_in_flight=1)
+        _started = threading.Event()
+        _release = threading.Event()
+
+        def slow():
+            _started.set()
+            _release.wait()
+            return Response(200)
+
+        _thread = threading.Thread(target=guard.call, args=(URL, slow))
+        _thread.start()
+        _started.wait()
+        try:
+            assert guard.stats()['op.example.org']['in_flight'] == 1
+            with pytest.raises(HostBusy):
+                guard.call(URL, Response, 200)
+        finally:
+            _release.set()
+            _thread.join()
+
+        assert guard.call(URL, Response, 200).status_code == 200
+        assert guard.stats()['op.example.org']['busy'] == 1
@@ -0,0 +1,92 @@
+import gc
+import threading
+
+from oiccli.metrics import Metrics
+from oiccli.metrics import label_key
+
+__author__ = 'Roland Hedberg'
+
+
+def test_label_key():
+    assert label_key(None) == ()
+    assert label_key({'status': 200, 'host': 'op.example.com'}) == (
+        ('host', 'op.example.com'), ('status', '200'))
+
+
+def test_counters_threads():
+    metrics = Metrics()
+
+    def count():
+        for _ in range(1000):
+            metrics.inc('requests', {'host': 'op.example.com'})
+
+    threads = [threading.Thread(target=count) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert metrics.get('requests', host='op.example.com') == 4000
+    assert metrics.get('requests', host='other.example.com') == 0
+
+
+def test_threads_gone():
+    metrics = Metrics(buckets=(0.1, 1))
+
+    def record():
+        metrics.inc('requests')
+        metrics.observe('duration', 0.5)
+
+    for _ in range(10):
+        thread = threading.Thread(target=record)
+        thread.start()
+        thread.join()
+    del thread
+    gc.collect()
+
+    assert metrics.get('requests') == 10
+    assert metrics.histograms()[('duration', ())]['count'] == 10
+    # The counters of the threads have been added to the total
+    assert metrics._shards == []
+
+    metrics.reset()
+    assert metrics.get('requests') == 0
+
+
+def test_histogram():
+    metrics = Metrics(buckets=(0.1, 1))
+    for value in [0.05, 0.1, 0.5, 2]:
+        metrics.observe('duration', value, {'service': 'userinfo'})
+
+    _hist = metrics.histograms()[('duration', (('service', 'userinfo'),))]
+    assert _hist['buckets'] == [(0.1, 2), (1, 3), (float('inf'), 4)]
+    assert _hist['count'] == 4
+    assert _hist['sum'] == 2.65
+
+
+def test_prometheus():
+    metrics = Metrics(buckets=(1,))
+    metrics.inc('requests_total', {'service': 'token', 'outcome': 'ok'})
+    metrics.observe('duration_seconds', 0.5, {'service': 'token'})
+
+    assert metrics.prometheus().split('\n') == [
+        '# TYPE oiccli_requests_total counter',
+        'oiccli_requests_total{outcome="ok",service="token"} 1',
+        '# TYPE oiccli_duration_seconds histogram',
+        'oiccli_duration_seconds_bucket{service="token",le="1"} 1',
+        'oiccli_duration_seconds_bucket{service="token",le="+Inf"} 1',
+        'oiccli_duration_seconds_sum{service="token"} 0.5',
+        'oiccli_duration_seconds_count{service="token"} 1',
+        '']
+
+    metrics.reset()
+    assert metrics.prometheus() == ''
+
+
+def test_callback():
+    recorded = []
+    metrics = Metrics(callback=lambda *args: recorded.append(args))
+    metrics.inc('requests', {'host': 'op.example.com'})
+    metrics.observe('duration', 0.2)
+    assert recorded == [('counter', 'requests', {'host': 'op.example.com'}, 1),
+                        ('histogram', 'duration', {}, 0.2)]
@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+from oiccli.tracing import NO_SPAN
+from oiccli.tracing import OpenTelemetryTracer
+from oiccli.tracing import Tracer
+from oiccli.tracing import otel_trace
+from oiccli.tracing import traced
+
+__author__ = 'Roland Hedberg'
+
+
+class Traced(object):
+    def __init__(self, tracer=None):
+        self.tracer = tracer
+
+    def _span(self, name, **attributes):
+        if self.tracer is None:
+            return NO_SPAN
+        return self.tracer.span(name, attributes)
+
+    @traced('work')
+    def work(self, fail=False):
+        with self._span('step', fail=fail):
+            if fail:
+                raise ValueError('failed')
+        return 'done'
+
+    @traced('async_work')
+    async def async_work(self):
+        await asyncio.sleep(0)
+        return self.work()
+
+
+class Override(Traced):
+    @traced('work')
+    def work(self, fail=False):
+        return Traced.work(self, fail)
+
+
+def test_spans():
+    tracer = Tracer()
+    assert Traced(tracer).work() == 'done'
+
+    step, work = tracer.spans()
+    assert step.name == 'step'
+    assert step.parent is work
+    assert step.attributes == {'fail': False}
+    assert work.parent is None
+    assert work.start <= step.start <= step.end <= work.end
+    assert tracer.current() is None
+
+
+def test_error():
+    tracer = Tracer()
+    with pytest.raises(ValueError):
+        Traced(tracer).work(fail=True)
+    assert [s.error for s in tracer.spans()] == ['failed', 'failed']
+    assert [s.error_type for s in tracer.spans()] == ['ValueError',
+                                                      'ValueError']
+    assert tracer.spans()[1].to_dict()['error'] == 'ValueError: failed'
+
+
+def test_no_tracer():
+    assert Traced().work() == 'done'
+
+
+def test_override():
+    tracer = Tracer()
+    Override(tracer).work()
+    assert [s.name for s in tracer.spans()] == ['step', 'work']
+
+
+def test_coroutine():
+    tracer = Tracer()
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(Traced(tracer).async_work()) == 'done'
+    finally:
+        loop.close()
+    assert [s.name for s in tracer.spans()] == ['step', 'work', 'async_work']
+    assert tracer.spans()[1].parent.name == 'async_work'
+
+
+def test_bounded_and_callback():
+    finished = []
+    tracer = Tracer(max_spans=2, callback=finished.append)
+    for _ in range(2):
+        Traced(tracer).work()
+    assert len(tracer.spans()) == 2
+    assert len(finished) == 4
+
+
+@pytest.mark.skipif(otel_trace is None, reason='opentelemetry not installed')
+def test_opentelemetry():
+    tracer = OpenTelemetryTracer()
+    assert Traced(tracer).work() == 'done'
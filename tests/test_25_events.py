@@ -0,0 +1,129 @@
+import json
+import os
+import socket
+import threading
+import time
+
+from oiccli.events import EventStore
+from oiccli.events import FileExporter
+from oiccli.events import SocketExporter
+from oiccli.events import summarize
+
+__author__ = 'Roland Hedberg'
+
+
+class Response(object):
+    def __init__(self, status_code, text, headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {"content-type": "text/plain"}
+        self.url = 'https://op.example.com/token'
+
+
+def test_summarize():
+    _resp = Response(200, 'x' * 100, {'content-type': 'application/json'})
+    _summary = summarize(_resp, max_size=10)
+    assert _summary == {'status_code': 200, 'url': _resp.url,
+                        'text': 'x' * 10 + '...',
+                        'headers': {'content-type': 'application/json'}}
+
+    assert summarize({'access_token': 'secret', 'foo': 'bar'}) == {
+        'access_token': '<REDACTED>', 'foo': 'bar'}
+    assert summarize('state=abc&client_secret=xyz') == \
+        'state=abc&client_secret=<REDACTED>'
+
+
+def test_ring_buffer():
+    store = EventStore(max_events=2)
+    for i in range(3):
+        store.store('Response', 'response {}'.format(i), ref=str(i))
+    assert len(store) == 2
+    assert [e.ref for e in store.events()] == ['1', '2']
+    assert store.events('Other') == []
+
+
+def test_sampling_and_types():
+    store = EventStore(sample_rate=0)
+    store.store('Response', 'foo')
+    assert len(store) == 0
+
+    store = EventStore(types=['HTTP response'])
+    store.store('Response', 'foo')
+    store.store('HTTP response', Response(200, 'foo'))
+    assert [e.typ for e in store.events()] == ['HTTP response']
+
+
+def test_file_export(tmpdir):
+    _name = os.path.join(str(tmpdir), 'events.jsonl')
+    store = EventStore(exporter=FileExporter(_name))
+    store.store('Response', {'foo': 'bar'}, ref='ref')
+    store.close()
+
+    _lines = open(_name).readlines()
+    assert len(_lines) == 1
+    _event = json.loads(_lines[0])
+    assert _event['type'] == 'Response'
+    assert _event['data'] == {'foo': 'bar'}
+    assert _event['ref'] == 'ref'
+
+
+def test_socket_export():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    received = []
+
+    def _receive():
+        conn, _ = server.accept()
+        received.append(conn.makefile().readline())
+        conn.close()
+
+    thread = threading.Thread(target=_receive)
+    thread.start()
+
+    store = EventStore(exporter=SocketExporter(*server.getsockname()))
+    store.store('Response', 'foo')
+    store.close()
+    thread.join(5)
+    server.close()
+
+    assert json.loads(received[0])['data'] == 'foo'
+
+
+class BlockingExporter(object):
+    def __init__(self):
+        self.exporting = threading.Event()
+        self.release = threading.Event()
+        self.exported = []
+
+    def export(self, event):
+        self.exporting.set()
+        self.release.wait(5)
+        self.exported.append(event)
+
+    def close(self):
+        pass
+
+
+def test_close_stuck_exporter():
+    exporter = BlockingExporter()
+    store = EventStore(exporter=exporter, queue_size=1)
+    store.store('Response', 'first')
+    exporter.exporting.wait(5)
+    # Fills the queue
+    store.store('Response', 'second')
+    store.store('Response', 'third')
+    assert store.dropped == 1
+
+    _start = time.time()
+    store.close(timeout=0.2)
+    assert time.time() - _start < 1
+
+    _thread = threading.enumerate()
+    exporter.release.set()
+    for thread in _thread:
+        if thread.name == 'oiccli-events':
+            thread.join(5)
+            assert not thread.is_alive()
+    # The event that was waiting is not exported
+    assert [e['data'] for e in exporter.exported] == ['first']